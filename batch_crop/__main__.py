@@ -0,0 +1,585 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Command-line interface to batch_crop
+
+Running ``python -m batch_crop`` without a command launches the GUI. The
+other commands run without a display and take the region to crop from an INI
+file saved with the GUI's ``Save Coordinates`` button.
+
+"""
+
+import argparse
+import os
+import sys
+from collections import Counter
+from typing import Callable, List, Optional, Tuple
+
+from PIL import Image
+
+from batch_crop.batch_crop import get_ratios_from_file, run_gui, Rendition, \
+    list_matching_files, read_image_header, ImageHeader
+from batch_crop.archive import ARCHIVE_FORMATS, ArchiveWriter, is_archive, \
+    list_archive_members, get_member_output_path, split_member_path
+from batch_crop.backends import available_backends, parse_backend_spec, \
+    DEFAULT_BACKEND
+from batch_crop.catalog import Catalog
+from batch_crop.contact import ContactSheet
+from batch_crop.report import Failure, get_failed_paths, save_report
+from batch_crop.writer import FSYNC_POLICIES, OutputWriter
+
+
+# Common names for Pillow formats that Pillow itself does not recognize
+FORMAT_ALIASES = {"jpg": "jpeg", "tif": "tiff"}
+
+# Multipliers for the suffixes accepted by parse_size
+SIZE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_rendition(text: str) -> Rendition:
+    """Parse a rendition given as ``NAME:MAX_DIMEN[:FORMAT[:QUALITY]]``
+
+    >>> parse_rendition("thumb:256:png")
+    Rendition(name='thumb', max_dimen=256, format='png', quality=75)
+    >>> parse_rendition("web:1024:JPG:90")
+    Rendition(name='web', max_dimen=1024, format='jpeg', quality=90)
+
+    The format must be one that Pillow can save.
+
+    Args:
+        text: The rendition description
+
+    Returns:
+        The described rendition
+
+    Raises:
+        argparse.ArgumentTypeError: If ``text`` is not a valid description
+
+    """
+    parts = text.split(":")
+    if not 2 <= len(parts) <= 4:
+        raise argparse.ArgumentTypeError(
+            "'{}' is not of the form NAME:MAX_DIMEN[:FORMAT[:QUALITY]]"
+            .format(text))
+    try:
+        numbers = [int(parts[1])] + [int(part) for part in parts[3:]]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "'{}' has a non-integer size or quality".format(text))
+    formats = [parse_save_format(part) for part in parts[2:3]]
+    return Rendition(parts[0], numbers[0], *formats, *numbers[1:])
+
+
+def parse_save_format(text: str) -> str:
+    """Parse the name of a format that Pillow can save
+
+    >>> parse_save_format("JPG")
+    'jpeg'
+
+    Args:
+        text: The format name, in any case, or one of :py:data:`FORMAT_ALIASES`
+
+    Returns:
+        The lowercase Pillow name of the format
+
+    Raises:
+        argparse.ArgumentTypeError: If Pillow cannot save ``text``
+
+    """
+    name = text.lower()
+    name = FORMAT_ALIASES.get(name, name)
+    Image.init()
+    if name.upper() not in Image.SAVE:
+        raise argparse.ArgumentTypeError(
+            "'{}' is not a format Pillow can save".format(text))
+    return name
+
+
+def parse_size(text: str) -> int:
+    """Parse a number of bytes with an optional ``K``, ``M``, ``G``, or ``T``
+
+    >>> parse_size("1.5G")
+    1610612736
+
+    Args:
+        text: The size
+
+    Returns:
+        The size in bytes
+
+    Raises:
+        argparse.ArgumentTypeError: If ``text`` is not a valid size
+
+    """
+    multiplier = SIZE_SUFFIXES.get(text[-1:].upper(), 1)
+    number = text[:-1] if multiplier > 1 else text
+    try:
+        return int(float(number) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError("'{}' is not a size".format(text))
+
+
+def parse_backend(text: str) -> str:
+    """Check a choice of backend for all images or per extension
+
+    >>> parse_backend("*=pillow")
+    '*=pillow'
+
+    Args:
+        text: The choice. See
+            :py:meth:`batch_crop.backends.parse_backend_spec`.
+
+    Returns:
+        ``text``, unchanged
+
+    Raises:
+        argparse.ArgumentTypeError: If ``text`` names an unknown or
+            unavailable backend
+
+    """
+    try:
+        parse_backend_spec(text)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    return text
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Create the parser for the command-line arguments
+
+    Returns:
+        The argument parser
+
+    """
+    parser = argparse.ArgumentParser(
+        prog="batch_crop",
+        description="Crop images in bulk to the same relative region")
+    parser.add_argument("--catalog", default=None, metavar="PATH",
+                        help="SQLite file remembering directory listings and "
+                             "image headers between runs. Created if "
+                             "missing.")
+    commands = parser.add_subparsers(dest="command")
+
+    crop = commands.add_parser(
+        "crop", help="Crop all matching images in directories")
+    crop.add_argument("dirs", nargs="*", metavar="DIR",
+                      help="Directory, or tar or zip archive, of images to "
+                           "crop. Not needed with --retry-failed.")
+    crop.add_argument("--coors", required=True,
+                      help="INI file of coordinates saved from the GUI")
+    crop.add_argument("--ext", default=None,
+                      help="Extension of images to crop, e.g. '.arw'. Not "
+                           "needed with --retry-failed.")
+    crop.add_argument("--workers", type=int, default=None,
+                      help="Number of images to crop concurrently. Defaults "
+                           "to the number of CPUs.")
+    crop.add_argument("--ram-budget", type=parse_size, default=None,
+                      help="Memory the crops may use at once, e.g. '16G'. "
+                           "Defaults to 3/4 of the free memory.")
+    crop.add_argument("--overwrite", action="store_true",
+                      help="Re-crop images whose crops already exist")
+    crop.add_argument("--max-size", type=int, default=None,
+                      help="Shrink crops to fit within this many pixels. "
+                           "Images are decoded at reduced resolution where "
+                           "possible.")
+    crop.add_argument("--fsync", choices=FSYNC_POLICIES, default="batch",
+                      help="When to flush outputs to disk: after each 'file', "
+                           "after each 'batch' of --fsync-batch files, or "
+                           "'never'")
+    crop.add_argument("--fsync-batch", type=int, default=64,
+                      help="Number of files per batch for '--fsync batch'")
+    crop.add_argument("--archive", default=None, metavar="BASE",
+                      help="Store crops in archives named BASE-00000.tar, "
+                           "etc. with an index in BASE.index.json instead of "
+                           "next to the images")
+    crop.add_argument("--archive-format", choices=ARCHIVE_FORMATS,
+                      default="tar", help="Format of the archives")
+    crop.add_argument("--shard-files", type=int, default=None,
+                      help="Start a new archive after this many files")
+    crop.add_argument("--shard-size", type=parse_size, default=None,
+                      help="Start a new archive before exceeding this size, "
+                           "e.g. '4G'")
+    crop.add_argument("--rendition", type=parse_rendition, action="append",
+                      default=[], metavar="NAME:MAX[:FORMAT[:QUALITY]]",
+                      help="Also save a downscaled copy of each crop. May be "
+                           "repeated.")
+    crop.add_argument("--backend", type=parse_backend,
+                      default=DEFAULT_BACKEND, metavar="SPEC",
+                      help="Backend to crop with, 'auto', or a choice per "
+                           "extension such as '.jpg=vips,*=pillow'. "
+                           "Available: {}".format(
+                               ", ".join(available_backends())))
+    crop.add_argument("--contact-sheet", default=None, metavar="BASE",
+                      help="Also tile the crops into labelled pages named "
+                           "BASE-001.jpg, etc. for checking at a glance")
+    crop.add_argument("--sheet-columns", type=int, default=8,
+                      help="Thumbnails per row of each contact sheet")
+    crop.add_argument("--sheet-rows", type=int, default=6,
+                      help="Rows per contact sheet")
+    crop.add_argument("--sheet-cell", type=int, default=192,
+                      help="Size of each contact sheet thumbnail, in pixels")
+    crop.add_argument("--pipeline", action="store_true",
+                      help="Decode and encode in separate pools of worker "
+                           "processes, passing crops through shared memory "
+                           "sized to fit --ram-budget. Uses the default "
+                           "backend and ignores --workers, --retries, and "
+                           "--timeout.")
+    crop.add_argument("--decode-workers", type=int, default=None,
+                      help="With --pipeline, number of decode processes. "
+                           "Defaults to 3/4 of the CPUs.")
+    crop.add_argument("--encode-workers", type=int, default=None,
+                      help="With --pipeline, number of encode processes. "
+                           "Defaults to the remaining CPUs.")
+    crop.add_argument("--stacks", action="store_true",
+                      help="Crop every frame of multi-frame images, one "
+                           "frame at a time, into multi-frame outputs. Other "
+                           "images are skipped. Only --workers, --max-size, "
+                           "--overwrite, and --sequences apply.")
+    crop.add_argument("--sequences", action="store_true",
+                      help="With --stacks, also crop runs of consecutively "
+                           "numbered images of the same size, such as "
+                           "z0001.tif, z0002.tif, etc., as stacks")
+    crop.add_argument("--retries", type=int, default=2,
+                      help="Number of times to retry an image after a "
+                           "transient I/O error")
+    crop.add_argument("--timeout", type=float, default=None,
+                      help="Give up on an image after this many seconds")
+    crop.add_argument("--error-report", default=None, metavar="PATH",
+                      help="Save the images that failed to this JSON file")
+    crop.add_argument("--retry-failed", default=None, metavar="REPORT",
+                      help="Only crop the images listed in this error "
+                           "report, then update it with those that failed "
+                           "again (unless --error-report is given)")
+    crop.add_argument("--plan", action="store_true",
+                      help="Only read image headers and report suspect "
+                           "crops and estimated memory and time")
+    crop.add_argument("--plan-csv", default=None, metavar="PATH",
+                      help="With --plan, save every planned crop to this CSV "
+                           "file")
+    crop.add_argument("--calibration", default=None, metavar="PATH",
+                      help="With --plan, estimate time from throughputs "
+                           "saved by 'benchmark --json'")
+
+    benchmark = commands.add_parser(
+        "benchmark", help="Compare how fast each backend crops sample images")
+    benchmark.add_argument("dirs", nargs="+", metavar="DIR",
+                           help="Directory, or tar or zip archive, of sample "
+                                "images")
+    benchmark.add_argument("--coors", required=True,
+                           help="INI file of coordinates saved from the GUI")
+    benchmark.add_argument("--ext", required=True,
+                           help="Extension of images to crop, e.g. '.arw'")
+    benchmark.add_argument("--backend", action="append",
+                           choices=available_backends(),
+                           help="Backend to compare. May be repeated. "
+                                "Defaults to all available backends.")
+    benchmark.add_argument("--repeat", type=int, default=3,
+                           help="Number of times to crop each image")
+    benchmark.add_argument("--max-size", type=int, default=None,
+                           help="Shrink crops to fit within this many pixels")
+    benchmark.add_argument("--json", default=None, metavar="PATH",
+                           help="Also save the results to this JSON file")
+
+    serve = commands.add_parser(
+        "serve", help="Serve crops over HTTP from a pool of warm workers")
+    serve.add_argument("--host", default="127.0.0.1",
+                       help="Address to listen on")
+    serve.add_argument("--port", type=int, default=8000,
+                       help="Port to listen on")
+    serve.add_argument("--workers", type=int, default=None,
+                       help="Number of worker processes. Defaults to the "
+                            "number of CPUs.")
+    serve.add_argument("--cache-size", type=int, default=256,
+                       help="Number of recent crops to cache")
+    serve.add_argument("--root", default=None,
+                       help="Allow cropping files inside this directory by "
+                            "path. Without it, only uploads are cropped.")
+
+    watch = commands.add_parser(
+        "watch", help="Crop new images as they appear in directories")
+    watch.add_argument("dirs", nargs="+", metavar="DIR",
+                       help="Directory to watch")
+    watch.add_argument("--coors", required=True,
+                       help="INI file of coordinates saved from the GUI")
+    watch.add_argument("--ext", required=True,
+                       help="Extension of images to crop, e.g. '.arw'")
+    watch.add_argument("--settle", type=float, default=2.0,
+                       help="Seconds a file must be unchanged before cropping")
+    watch.add_argument("--interval", type=float, default=1.0,
+                       help="Seconds between checks for new files")
+    watch.add_argument("--workers", type=int, default=4,
+                       help="Number of images to crop concurrently")
+    watch.add_argument("--existing", action="store_true",
+                       help="Also crop images already present but not yet "
+                            "cropped")
+    watch.add_argument("--poll", action="store_true",
+                       help="Scan directories even if inotify is available")
+    watch.add_argument("--rendition", type=parse_rendition, action="append",
+                       default=[], metavar="NAME:MAX[:FORMAT[:QUALITY]]",
+                       help="Also save a downscaled copy of each crop. May be "
+                            "repeated.")
+    return parser
+
+
+def list_inputs(paths: List[str], extension: str,
+                catalog: Optional[Catalog] = None) -> List[Tuple[str, str]]:
+    """List the images to crop in directories and archives
+
+    Images in archives are named by member paths, and their crops are saved
+    in a directory next to the archive.
+
+    Args:
+        paths: Directories and tar or zip archives to search
+        extension: Lower-case extension of images to crop
+        catalog: If given, directories are listed through the catalog
+
+    Returns:
+        Pairs of input path and output path
+
+    """
+    inputs = []
+    for path in paths:
+        if is_archive(path):
+            inputs.extend((member, get_member_output_path(member))
+                          for member in list_archive_members(path, extension))
+        else:
+            images = catalog.list_files(path, extension) if catalog \
+                else list_matching_files(path, extension)
+            inputs.extend((image, image + "_cropped.jpg") for image in images)
+    return inputs
+
+
+def run_plan(args: argparse.Namespace, paths: List[Tuple[str, str]],
+             read_header: Callable[[str], ImageHeader]) -> int:
+    """Plan the ``crop`` command without cropping
+
+    Suspect crops are listed, followed by the estimated totals.
+
+    Args:
+        args: Parsed command-line arguments
+        paths: Pairs of input path and output path that would be cropped
+        read_header: Reads an image's header
+
+    Returns:
+        Exit code, ``1`` if any crop is suspect
+
+    """
+    from batch_crop.benchmark import load_results
+    from batch_crop.plan import get_throughputs, plan_crops, save_plan, \
+        summarize_plan
+    from batch_crop.schedule import get_default_budget
+
+    throughputs = None
+    if args.calibration is not None:
+        throughputs = get_throughputs(load_results(args.calibration))
+    crops = plan_crops(get_ratios_from_file(args.coors), paths,
+                       args.max_size, throughputs, read_header)
+    for crop in crops:
+        if crop.problem is not None:
+            print("{}: {} (box {})".format(crop.in_path, crop.problem,
+                                           crop.box))
+    if args.plan_csv is not None:
+        save_plan(crops, args.plan_csv)
+    summary = summarize_plan(crops, args.workers or os.cpu_count() or 1,
+                             args.ram_budget or get_default_budget())
+    print(summary)
+    return 1 if summary.problems else 0
+
+
+def run_stacks(args: argparse.Namespace) -> int:
+    """Run the ``crop`` command with ``--stacks``
+
+    Args:
+        args: Parsed command-line arguments
+
+    Returns:
+        Exit code, ``1`` if any stack failed to crop
+
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from batch_crop.stacks import crop_stack, list_stacks
+
+    stacks = [(in_paths, out_path) for path in args.dirs
+              for in_paths, out_path in list_stacks(path, args.ext.lower(),
+                                                    args.sequences)
+              if args.overwrite or not os.path.exists(out_path)]
+    box_ratio = get_ratios_from_file(args.coors)
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(crop_stack, box_ratio, in_paths, out_path,
+                                   args.max_size)
+                   for in_paths, out_path in stacks]
+        for (in_paths, out_path), future in zip(stacks, futures):
+            try:
+                frames = future.result()
+            except Exception as error:  # pylint: disable=broad-except
+                failed += 1
+                print("Failed to crop '{}': {}".format(in_paths[0], error))
+            else:
+                print("Cropped {} frames to '{}'".format(frames, out_path))
+    print("Cropped {} of {} stacks".format(len(stacks) - failed,
+                                           len(stacks)))
+    return 1 if failed else 0
+
+
+def run_crop(args: argparse.Namespace,
+             catalog: Optional[Catalog] = None) -> int:
+    """Run the ``crop`` command
+
+    Args:
+        args: Parsed command-line arguments
+        catalog: If given, images are listed and their headers read through
+            the catalog
+
+    Returns:
+        Exit code, ``1`` if any image failed to crop
+
+    """
+    from batch_crop.schedule import crop_files
+
+    read_header = catalog.read_image_header if catalog \
+        else read_image_header
+    if args.retry_failed is not None:
+        paths = get_failed_paths(args.retry_failed)
+    else:
+        paths = list_inputs(args.dirs, args.ext.lower(), catalog)
+    if args.archive is None and not args.overwrite:
+        paths = [(path, out) for path, out in paths
+                 if not os.path.exists(out)]
+    if args.plan:
+        return run_plan(args, paths, read_header)
+
+    if args.archive is not None:
+        sources = args.dirs or [(split_member_path(path) or (path,))[0]
+                                for path, _ in paths]
+        root = os.path.commonpath([
+            os.path.abspath(path if os.path.isdir(path)
+                            else os.path.dirname(path))
+            for path in sources])
+        writer = ArchiveWriter(args.archive, args.archive_format,
+                               args.shard_files, args.shard_size, root)
+    else:
+        writer = OutputWriter(args.fsync, args.fsync_batch)
+        for out_dir in {os.path.dirname(out) for _, out in paths}:
+            os.makedirs(out_dir or ".", exist_ok=True)
+
+    contact_sheet = None
+    if args.contact_sheet is not None:
+        contact_sheet = ContactSheet(args.contact_sheet, args.sheet_columns,
+                                     args.sheet_rows, args.sheet_cell)
+    failures = []  # type: List[Failure]
+    backends = Counter()  # type: Counter
+    box_ratio = get_ratios_from_file(args.coors)
+    if args.pipeline:
+        from batch_crop.pipeline import crop_files_pipelined
+        results = crop_files_pipelined(
+            box_ratio, paths, args.decode_workers, args.encode_workers,
+            args.rendition, args.max_size, writer,
+            contact_sheet=contact_sheet, budget=args.ram_budget)
+    else:
+        results = crop_files(box_ratio, paths, args.ram_budget, args.workers,
+                             args.rendition, max_dimen=args.max_size,
+                             writer=writer, backend=args.backend,
+                             read_header=read_header, retries=args.retries,
+                             timeout=args.timeout,
+                             contact_sheet=contact_sheet)
+    for job, future in results:
+        error = future.exception()
+        if error is not None:
+            failures.append(Failure.from_error(job.in_path, job.out_path,
+                                               error))
+            print("Failed to crop '{}': {}".format(job.in_path, error))
+        else:
+            backends[future.result().backend] += 1
+    print(writer.close())
+    if contact_sheet is not None:
+        print("Saved {} contact sheets".format(len(contact_sheet.close())))
+    if backends:
+        print("Backends used: {}".format(", ".join(
+            "{} ({})".format(name, count)
+            for name, count in sorted(backends.items()))))
+    print("Cropped {} of {} images".format(len(paths) - len(failures),
+                                           len(paths)))
+    report = args.error_report or args.retry_failed
+    if report is not None:
+        save_report(failures, report)
+        if failures:
+            print("Failures saved to '{0}'. Pass '--retry-failed {0}' to "
+                  "retry them.".format(report))
+    return 1 if failures else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Run the command described by ``argv``
+
+    Args:
+        argv: Command-line arguments, excluding the program name. Defaults to
+            ``sys.argv[1:]``.
+
+    Returns:
+        Exit code
+
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    if args.command == "crop" and args.retry_failed is None and \
+            (not args.dirs or args.ext is None):
+        parser.error("crop needs DIR and --ext unless --retry-failed is "
+                     "given")
+    if args.command == "crop" and args.stacks and \
+            args.retry_failed is not None:
+        parser.error("--stacks cannot be combined with --retry-failed")
+    if args.command is None:
+        run_gui(args.catalog)
+    elif args.command == "crop" and args.stacks:
+        return run_stacks(args)
+    elif args.command == "crop":
+        if args.catalog is None:
+            return run_crop(args)
+        with Catalog(args.catalog) as catalog:
+            return run_crop(args, catalog)
+    elif args.command == "benchmark":
+        from batch_crop.benchmark import benchmark_backends, format_results, \
+            save_results
+        results = benchmark_backends(
+            [path for path, _ in list_inputs(args.dirs, args.ext.lower())],
+            get_ratios_from_file(args.coors), args.backend, args.repeat,
+            args.max_size)
+        print(format_results(results))
+        if args.json is not None:
+            save_results(results, args.json)
+    elif args.command == "serve":
+        from batch_crop.serve import serve
+        serve(args.host, args.port, args.workers, args.cache_size, args.root)
+    elif args.command == "watch":
+        # Imported here so the GUI does not pay for unused modules
+        from batch_crop.watch import CropWatcher
+        box_ratio = get_ratios_from_file(args.coors)
+        watcher = CropWatcher(args.dirs, box_ratio, args.ext,
+                              settle_time=args.settle,
+                              poll_interval=args.interval,
+                              max_workers=args.workers,
+                              process_existing=args.existing,
+                              use_inotify=not args.poll,
+                              renditions=args.rendition)
+        watcher.run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
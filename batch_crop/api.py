@@ -0,0 +1,166 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Crop images held in memory, for use by other programs
+
+These functions accept the bytes of an image file, a binary file object, a
+NumPy array of pixels, or a path, and return the encoded crop in memory
+rather than writing it to a file. For example, a web service can crop an
+upload with:
+
+.. code-block:: python
+
+   from batch_crop.api import crop_bytes
+
+   jpeg = crop_bytes(request_body, (0.1, 0.1, 0.9, 0.9))
+
+"""
+
+import io
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+from batch_crop.batch_crop import crop_image, downscale_image, encode_image, \
+    get_save_exif, open_image, DEFAULT_QUALITY
+
+
+# Anything that can be cropped by this module
+Source = Union[bytes, bytearray, memoryview, BinaryIO, np.ndarray, str]
+
+
+def load_source(source: Source,
+                box_ratio: Optional[Tuple[float, float, float, float]] = None,
+                max_dimen: Optional[int] = None) -> Image:
+    """Open an image from any supported in-memory source
+
+    Args:
+        source: Bytes of an image file, a binary file object positioned at
+            the start of an image file, an array of pixels in the form
+            accepted by ``Image.fromarray``, or the path to an image file
+        box_ratio: The region that will be cropped from the image
+        max_dimen: The largest dimension the cropped region will be shrunk
+            to. With ``box_ratio``, allows decoding at a reduced resolution as
+            described by :py:meth:`batch_crop.batch_crop.open_image`.
+
+    Returns:
+        The image
+
+    """
+    if isinstance(source, np.ndarray):
+        return Image.fromarray(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    return open_image(source, box_ratio, max_dimen)
+
+
+# pylint: disable=too-many-arguments
+def crop_to_buffer(source: Source,
+                   box_ratio: Tuple[float, float, float, float],
+                   image_format: str = "jpeg", quality: int = DEFAULT_QUALITY,
+                   max_dimen: Optional[int] = None) -> io.BytesIO:
+    """Crop an image and encode the crop into a buffer
+
+    The crop is made by :py:meth:`batch_crop.batch_crop.crop_image`, so EXIF
+    orientation is honored as it is for files.
+
+    Args:
+        source: The image to crop. See :py:meth:`load_source`.
+        box_ratio: Region to crop. See :doc:`units`
+        image_format: Pillow format name to encode the crop as
+        quality: Encoder quality, for formats that support one
+        max_dimen: If given, the crop is shrunk so that neither dimension
+            exceeds this
+
+    Returns:
+        Buffer holding the encoded crop, positioned at its start
+
+    """
+    image = load_source(source, box_ratio, max_dimen)
+    cropped = crop_image(box_ratio, image)
+    if max_dimen is not None:
+        cropped = downscale_image(cropped, max_dimen)
+    return io.BytesIO(encode_image(cropped, image_format, quality,
+                                   **get_save_exif(image)))
+
+
+def crop_bytes(source: Source, box_ratio: Tuple[float, float, float, float],
+               image_format: str = "jpeg", quality: int = DEFAULT_QUALITY,
+               max_dimen: Optional[int] = None) -> bytes:
+    """Crop an image and return the encoded crop
+
+    Args:
+        source: The image to crop. See :py:meth:`load_source`.
+        box_ratio: Region to crop. See :doc:`units`
+        image_format: Pillow format name to encode the crop as
+        quality: Encoder quality, for formats that support one
+        max_dimen: If given, the crop is shrunk so that neither dimension
+            exceeds this
+
+    Returns:
+        The encoded crop
+
+    """
+    return crop_to_buffer(source, box_ratio, image_format, quality,
+                          max_dimen).getvalue()
+
+
+def submit_crops(sources: Iterable[Source],
+                 box_ratio: Tuple[float, float, float, float],
+                 executor: Executor, **options) -> List[Future]:
+    """Start cropping many images on an executor
+
+    Since file objects and arrays cannot be shared between processes cheaply,
+    ``executor`` would usually be a ``ThreadPoolExecutor``. Pillow and rawpy
+    release the GIL while decoding and encoding, so the crops still run in
+    parallel.
+
+    Args:
+        sources: The images to crop. See :py:meth:`load_source`.
+        box_ratio: Region to crop. See :doc:`units`
+        executor: Runs the crops
+        options: Passed to :py:meth:`crop_bytes`
+
+    Returns:
+        A future for each source, in order, whose result is the encoded crop
+
+    """
+    return [executor.submit(crop_bytes, source, box_ratio, **options)
+            for source in sources]
+
+
+def crop_many(sources: Iterable[Source],
+              box_ratio: Tuple[float, float, float, float],
+              max_workers: Optional[int] = None, **options) -> Iterator[bytes]:
+    """Crop many images in parallel, yielding the crops in order
+
+    Args:
+        sources: The images to crop. See :py:meth:`load_source`.
+        box_ratio: Region to crop. See :doc:`units`
+        max_workers: Number of images to crop at once. Defaults to
+            ``ThreadPoolExecutor``'s default.
+        options: Passed to :py:meth:`crop_bytes`
+
+    Returns:
+        Iterator of the encoded crops, in the same order as ``sources``
+
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in submit_crops(sources, box_ratio, executor, **options):
+            yield future.result()
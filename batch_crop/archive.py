@@ -0,0 +1,702 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Read images from and store crops in tar or zip archives
+
+Images inside an archive can be cropped without first extracting them. Such
+an image is named by a member path of the form ``archive.tar::dir/img1.ARW``
+(see :py:meth:`split_member_path`), which
+:py:meth:`batch_crop.batch_crop.open_image` and
+:py:meth:`batch_crop.batch_crop.read_image_header` accept in place of a file
+path. Members of uncompressed tar archives are read straight from their
+position in the archive, and zip members are streamed through ``zipfile``.
+Only members of compressed tar archives are decompressed into memory. Each
+process keeps such an archive open (see :py:class:`CompressedTar`), and
+:py:meth:`batch_crop.schedule.make_jobs` starts the members of each one in
+archive order, so that every worker process decompresses it in a single
+forward pass.
+
+Writing one small file per crop is slow on many filesystems, and the files
+often end up archived anyway. An :py:class:`ArchiveWriter` can be used
+anywhere an :py:class:`batch_crop.writer.OutputWriter` can. It appends each
+encoded crop directly to an archive, starting a new archive (a shard) once
+the current one holds enough files or bytes.
+
+Alongside the shards, a JSON index maps each input image to the archive
+members holding its outputs:
+
+.. code-block:: json
+
+   {"format": "tar",
+    "shards": ["crops-00000.tar"],
+    "inputs": {"images/img1.ARW": [
+        {"archive": "crops-00000.tar", "member": "img1.ARW_cropped.jpg"}]}}
+
+"""
+
+import atexit
+import functools
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Tuple, Union
+
+from batch_crop.writer import WriteStats, write_atomic
+
+
+# Accepted values for the archive format of ArchiveWriter
+ARCHIVE_FORMATS = ("tar", "zip")
+
+# Separates the archive path from the member name in a member path
+MEMBER_SEPARATOR = "::"
+
+# Fixed sizes, in bytes, of the zip local file header, central directory
+# entry, and end of central directory record
+ZIP_LOCAL_HEADER_SIZE = 30
+ZIP_CENTRAL_HEADER_SIZE = 46
+ZIP_END_SIZE = 22
+
+
+class ArchiveMember(NamedTuple):
+    """Where an image is stored within an archive
+
+    Attributes:
+        name: Name of the member within the archive
+        size: Size of the member, in bytes
+        offset: Position of the member's data within an uncompressed tar
+            archive, or ``None`` if it cannot be read directly
+
+    """
+    name: str
+    size: int
+    offset: Optional[int]
+
+
+class MemberFile(io.RawIOBase):
+    """Read-only, seekable view of a stretch of a file
+
+    Attributes:
+        name (str): Name of the archive member, so that the image's format can
+            be determined from its extension
+
+    """
+
+    def __init__(self, path: str, member: ArchiveMember) -> None:
+        super().__init__()
+        self.name = member.name
+        self._file = open(path, "rb")
+        self._start = member.offset
+        self._size = member.size
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        count = max(0, min(len(buffer), self._size - self._position))
+        if count == 0:
+            return 0
+        self._file.seek(self._start + self._position)  # type: ignore
+        count = self._file.readinto(memoryview(buffer)[:count])
+        self._position += count
+        return count
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position,
+                io.SEEK_END: self._size}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        self._file.close()
+        super().close()
+
+
+class CompressedTar:
+    """Compressed tar archive kept open between reads of its members
+
+    A compressed tar can only be read from the start, so reopening it for
+    each member would decompress the archive once per member. Instead, the
+    open decompressor is kept along with its position: reading members in
+    archive order only ever moves forward, while reading an earlier member
+    decompresses the archive again from the start. The last member read is
+    also kept, since each image's header is read before the image is
+    decoded.
+
+    Attributes:
+        path (str): Path to the archive
+
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._archive = None  # type: Optional[tarfile.TarFile]
+        self._lock = threading.Lock()
+        self._last = None  # type: Optional[Tuple[str, bytes]]
+
+    def _open(self) -> tarfile.TarFile:
+        if self._archive is None:
+            self._archive = tarfile.open(self.path, "r:*")
+        return self._archive
+
+    def members(self) -> List[tarfile.TarInfo]:
+        """List the archive's members
+
+        Returns:
+            Header of each member, in archive order
+
+        """
+        with self._lock:
+            return self._open().getmembers()
+
+    def read(self, name: str) -> bytes:
+        """Read the contents of a member
+
+        Args:
+            name: Name of the member
+
+        Returns:
+            The member's contents
+
+        Raises:
+            KeyError: If the archive has no such member
+
+        """
+        with self._lock:
+            if self._last is None or self._last[0] != name:
+                member = self._open().extractfile(name)
+                if member is None:
+                    raise KeyError(name)
+                self._last = (name, member.read())
+            return self._last[1]
+
+    def close(self) -> None:
+        """Close the archive file
+
+        The archive is reopened if any member is read afterwards.
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            if self._archive is not None:
+                self._archive.close()
+                self._archive = None
+            self._last = None
+
+
+# Number of compressed tar archives each process keeps open
+OPEN_COMPRESSED_TARS = 4
+
+# Open compressed tar archives by path and process ID, least recently used
+# first. Forked worker processes would otherwise share the parent's file
+# positions.
+_compressed_tars = OrderedDict()  # type: OrderedDict
+_compressed_tars_lock = threading.Lock()
+
+
+def open_compressed_tar(path: str) -> CompressedTar:
+    """Get the open :py:class:`CompressedTar` for an archive
+
+    Only :py:data:`OPEN_COMPRESSED_TARS` archives are kept open in each
+    process. Opening another closes the least recently used.
+
+    Args:
+        path: Path to the archive
+
+    Returns:
+        The open archive
+
+    """
+    key = path, os.getpid()
+    with _compressed_tars_lock:
+        if key in _compressed_tars:
+            _compressed_tars.move_to_end(key)
+            return _compressed_tars[key]
+        archive = CompressedTar(path)
+        _compressed_tars[key] = archive
+        while len(_compressed_tars) > OPEN_COMPRESSED_TARS:
+            _compressed_tars.popitem(last=False)[1].close()
+    return archive
+
+
+def close_compressed_tars() -> None:
+    """Close every compressed tar archive this process has open
+
+    Returns:
+        None
+
+    """
+    with _compressed_tars_lock:
+        while _compressed_tars:
+            _compressed_tars.popitem()[1].close()
+
+
+atexit.register(close_compressed_tars)
+
+
+class NamedBytesIO(io.BytesIO):
+    """In-memory file that, like a real file, has a ``name``"""
+
+    def __init__(self, data: bytes, name: str) -> None:
+        super().__init__(data)
+        self.name = name
+
+
+def is_archive(path: str) -> bool:
+    """Check whether a path is a tar or zip archive
+
+    Args:
+        path: The path to check
+
+    Returns:
+        ``True`` if ``path`` is a file that is a tar or zip archive
+
+    """
+    return os.path.isfile(path) and \
+        (zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+
+def split_member_path(path: str) -> Optional[Tuple[str, str]]:
+    """Split a member path into the archive path and member name
+
+    >>> split_member_path("shoot.tar::day1/img1.ARW")
+    ('shoot.tar', 'day1/img1.ARW')
+    >>> split_member_path("images/img1.ARW") is None
+    True
+
+    Args:
+        path: A member path or an ordinary file path
+
+    Returns:
+        ``(archive_path, member_name)``, or ``None`` if ``path`` is not a
+        member path
+
+    """
+    archive_path, separator, name = path.partition(MEMBER_SEPARATOR)
+    if not separator or not name:
+        return None
+    return archive_path, name
+
+
+@functools.lru_cache(maxsize=16)
+def read_archive_index(archive_path: str) -> Dict[str, ArchiveMember]:
+    """Read the locations of the files in an archive
+
+    Only the archive's index is read: the central directory of a zip, or the
+    member headers of a tar. The result is cached, so each process reads each
+    archive's index once.
+
+    Args:
+        archive_path: Path to the archive
+
+    Returns:
+        Maps the name of each regular file in the archive to its location
+
+    """
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            return {info.filename: ArchiveMember(info.filename, info.file_size,
+                                                 None)
+                    for info in archive.infolist() if not info.is_dir()}
+    try:
+        with tarfile.open(archive_path, "r:") as archive:
+            return {info.name: ArchiveMember(info.name, info.size,
+                                             info.offset_data)
+                    for info in archive.getmembers() if info.isfile()}
+    except tarfile.ReadError:
+        compressed = open_compressed_tar(archive_path)
+        return {info.name: ArchiveMember(info.name, info.size, None)
+                for info in compressed.members() if info.isfile()}
+
+
+def list_archive_members(archive_path: str, extension: str) -> List[str]:
+    """List the member paths of the files in an archive with an extension
+
+    Outputs of previous crops are excluded, as in
+    :py:meth:`batch_crop.batch_crop.list_matching_files`.
+
+    Args:
+        archive_path: Path to the archive
+        extension: Lower-case extension, including the leading ``.``
+
+    Returns:
+        Member paths of the matching files, in archive order
+
+    """
+    # Imported here because batch_crop.batch_crop imports this module
+    from batch_crop.batch_crop import is_crop_output
+    return [archive_path + MEMBER_SEPARATOR + name
+            for name in read_archive_index(archive_path)
+            if name.lower().endswith(extension) and
+            not is_crop_output(name)]
+
+
+def get_streamed_archive(path: str) -> Optional[str]:
+    """Get the compressed tar archive that an image is a member of
+
+    Members of such archives are best read in archive order. See
+    :py:class:`CompressedTar`.
+
+    >>> get_streamed_archive("images/img1.ARW") is None
+    True
+
+    Args:
+        path: Member path or ordinary file path of the image
+
+    Returns:
+        Path to the archive, or ``None`` if ``path`` is not a member of a
+        compressed tar archive or the archive cannot be read
+
+    """
+    split = split_member_path(path)
+    if split is None:
+        return None
+    archive_path, name = split
+    try:
+        member = read_archive_index(archive_path).get(name)
+        if member is None or member.offset is not None or \
+                zipfile.is_zipfile(archive_path):
+            return None
+    except (OSError, tarfile.TarError, zipfile.BadZipFile):
+        return None
+    return archive_path
+
+
+def get_member_output_path(path: str) -> str:
+    """Get where to save the crop of an archive member as an ordinary file
+
+    Crops are saved in a directory next to the archive, mirroring the
+    archive's structure. Components of the member name that could escape that
+    directory, such as ``..``, are dropped.
+
+    >>> get_member_output_path("shoot.tar::day1/img1.ARW")
+    'shoot.tar_cropped/day1/img1.ARW_cropped.jpg'
+
+    Args:
+        path: Member path of the image. See :py:meth:`split_member_path`.
+
+    Returns:
+        Path to save the crop to
+
+    """
+    archive_path, name = split_member_path(path)  # type: ignore
+    parts = [part for part in name.split("/") if part not in ("", ".", "..")]
+    return os.path.join(archive_path + "_cropped", *parts) + "_cropped.jpg"
+
+
+def open_member(path: str) -> BinaryIO:
+    """Open a file inside an archive for reading
+
+    Args:
+        path: Member path of the file. See :py:meth:`split_member_path`.
+
+    Returns:
+        Binary file object for the member, whose ``name`` is the member name
+
+    Raises:
+        KeyError: If the archive has no such member
+
+    """
+    archive_path, name = split_member_path(path)  # type: ignore
+    member = read_archive_index(archive_path)[name]
+    if member.offset is not None:
+        return io.BufferedReader(MemberFile(archive_path, member))
+    if zipfile.is_zipfile(archive_path):
+        # The member stays readable after the ZipFile itself is closed
+        with zipfile.ZipFile(archive_path) as archive:
+            return archive.open(name)  # type: ignore
+    compressed = open_compressed_tar(archive_path)
+    return NamedBytesIO(compressed.read(name), name)
+
+
+def round_up(size: int, multiple: int) -> int:
+    """Round a size up to a multiple
+
+    >>> round_up(513, tarfile.BLOCKSIZE)
+    1024
+
+    Args:
+        size: The size to round
+        multiple: What to round to a multiple of
+
+    Returns:
+        The smallest multiple of ``multiple`` that is at least ``size``
+
+    """
+    return -(-size // multiple) * multiple
+
+
+def get_member_size(archive_format: str, name: str, size: int) -> int:
+    """Get the space a member takes up in an archive, including its headers
+
+    >>> get_member_size("tar", "img1.ARW_cropped.jpg", 1000)
+    1536
+    >>> get_member_size("zip", "img1.ARW_cropped.jpg", 1000)
+    1116
+
+    Args:
+        archive_format: One of :py:data:`ARCHIVE_FORMATS`
+        name: Name of the member
+        size: Size of the member's data
+
+    Returns:
+        Bytes the member adds to an archive, not counting
+        :py:meth:`get_end_size`
+
+    """
+    encoded = name.encode("utf-8")
+    if archive_format == "zip":
+        return ZIP_LOCAL_HEADER_SIZE + ZIP_CENTRAL_HEADER_SIZE + \
+            2 * len(encoded) + size
+    header = tarfile.BLOCKSIZE
+    if len(encoded) > tarfile.LENGTH_NAME or len(encoded) != len(name):
+        # Long or non-ASCII names are stored in an extra header and record
+        header += tarfile.BLOCKSIZE + \
+            round_up(len(encoded) + 32, tarfile.BLOCKSIZE)
+    return header + round_up(size, tarfile.BLOCKSIZE)
+
+
+def get_archive_size(archive_format: str, members_size: int) -> int:
+    """Get the size of a finished archive
+
+    >>> get_archive_size("tar", 1536)
+    10240
+    >>> get_archive_size("zip", 1116)
+    1138
+
+    Args:
+        archive_format: One of :py:data:`ARCHIVE_FORMATS`
+        members_size: Total of :py:meth:`get_member_size` for its members
+
+    Returns:
+        Size of the archive once its end-of-archive marker is written. Tar
+        archives end with two empty blocks and are padded to a whole record.
+
+    """
+    if archive_format == "zip":
+        return members_size + ZIP_END_SIZE
+    return round_up(members_size + 2 * tarfile.BLOCKSIZE, tarfile.RECORDSIZE)
+
+
+class ArchiveWriter:
+    """Append outputs to sharded tar or zip archives
+
+    Attributes:
+        base_path (str): Shards are saved as ``{base_path}-{number}.{format}``
+            and the index as ``{base_path}.index.json``
+        archive_format (str): One of :py:data:`ARCHIVE_FORMATS`
+        max_members (Optional[int]): Number of files after which a new shard
+            is started
+        max_bytes (Optional[int]): Largest size of a shard, including the
+            archive's headers and padding. An output too large to fit even
+            in an empty shard is given a shard of its own.
+        root (Optional[str]): Members are named by their output path relative
+            to this directory. If ``None``, only the file name is used.
+        index (Dict[str, List[Dict[str, str]]]): Maps each input path to the
+            archive members holding its outputs
+
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, base_path: str, archive_format: str = "tar",
+                 max_members: Optional[int] = None,
+                 max_bytes: Optional[int] = None,
+                 root: Optional[str] = None) -> None:
+        """Prepare to write archives
+
+        No shard is created until the first output is written.
+
+        Args:
+            base_path: Path, without extension, to name the shards and index
+                after
+            archive_format: One of :py:data:`ARCHIVE_FORMATS`
+            max_members: Number of files after which a new shard is started
+            max_bytes: Largest size of a shard, including the archive's
+                headers and padding
+            root: Members are named by their output path relative to this
+                directory. If ``None``, only the file name is used.
+
+        Raises:
+            ValueError: If ``archive_format`` is not a known format
+
+        """
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError("Unknown archive format '{}'".format(
+                archive_format))
+        self.base_path = base_path
+        self.archive_format = archive_format
+        self.max_members = max_members
+        self.max_bytes = max_bytes
+        self.root = root
+        self.index = {}  # type: Dict[str, List[Dict[str, str]]]
+        self._shards = []  # type: List[str]
+        self._archive = None  # type: Union[None, tarfile.TarFile, zipfile.ZipFile]
+        self._temp_path = ""
+        self._shard_members = 0
+        self._shard_bytes = 0
+        self._files = 0
+        self._bytes = 0
+        self._seconds = 0.0
+        self._lock = threading.Lock()
+
+    def write(self, data: bytes, path: str, source: Optional[str] = None) \
+            -> None:
+        """Append an output to the current shard
+
+        Args:
+            data: The encoded output
+            path: The path the output would have been saved to, which names
+                its member
+            source: Path of the input the output was made from. Defaults to
+                ``path``.
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            start = time.perf_counter()
+            member = self.member_name(path)
+            size = get_member_size(self.archive_format, member, len(data))
+            if self._archive is not None and self._shard_full(size):
+                self._close_shard()
+            if self._archive is None:
+                self._open_shard()
+
+            if isinstance(self._archive, tarfile.TarFile):
+                tar_info = tarfile.TarInfo(member)
+                tar_info.size = len(data)
+                tar_info.mtime = int(time.time())
+                self._archive.addfile(tar_info, io.BytesIO(data))
+            elif isinstance(self._archive, zipfile.ZipFile):
+                zip_info = zipfile.ZipInfo(member, time.localtime()[:6])
+                # Crops are already compressed, so storing them is fastest
+                self._archive.writestr(zip_info, data, zipfile.ZIP_STORED)
+
+            self.index.setdefault(source or path, []).append(
+                {"archive": os.path.basename(self._shards[-1]),
+                 "member": member})
+            self._shard_members += 1
+            self._shard_bytes += size
+            self._files += 1
+            self._bytes += len(data)
+            self._seconds += time.perf_counter() - start
+
+    def member_name(self, path: str) -> str:
+        """Get the name of the archive member for an output
+
+        >>> ArchiveWriter("crops").member_name("/images/img1.ARW_cropped.jpg")
+        'img1.ARW_cropped.jpg'
+
+        Args:
+            path: The path the output would have been saved to
+
+        Returns:
+            The member name, always with ``/`` separators
+
+        """
+        if self.root is None:
+            name = os.path.basename(path)
+        else:
+            name = os.path.relpath(path, self.root)
+        return name.replace(os.sep, "/")
+
+    def close(self) -> WriteStats:
+        """Finish the current shard and save the index
+
+        Returns:
+            Totals of the data written
+
+        """
+        with self._lock:
+            if self._archive is not None:
+                self._close_shard()
+            index = {"format": self.archive_format,
+                     "shards": [os.path.basename(path)
+                                for path in self._shards],
+                     "inputs": self.index}
+            write_atomic(json.dumps(index, indent=1).encode("utf-8"),
+                         self.base_path + ".index.json")
+        return WriteStats(self._files, self._bytes, self._seconds)
+
+    def __enter__(self) -> "ArchiveWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _shard_full(self, incoming: int) -> bool:
+        """Check whether the next output belongs in a new shard
+
+        Args:
+            incoming: Size of the next output in the archive. See
+                :py:meth:`get_member_size`.
+
+        Returns:
+            ``True`` if a new shard should be started
+
+        """
+        if self._shard_members == 0:
+            return False
+        if self.max_members is not None and \
+                self._shard_members >= self.max_members:
+            return True
+        return self.max_bytes is not None and get_archive_size(
+            self.archive_format, self._shard_bytes + incoming) > self.max_bytes
+
+    def _open_shard(self) -> None:
+        """Start the next shard under a temporary name
+
+        Returns:
+            None
+
+        """
+        path = "{}-{:05d}.{}".format(self.base_path, len(self._shards),
+                                     self.archive_format)
+        dir_path, name = os.path.split(os.path.abspath(path))
+        self._temp_path = os.path.join(dir_path, "." + name + ".tmp")
+        if self.archive_format == "tar":
+            self._archive = tarfile.open(self._temp_path, "w")
+        else:
+            self._archive = zipfile.ZipFile(self._temp_path, "w")
+        self._shards.append(path)
+        self._shard_members = 0
+        self._shard_bytes = 0
+
+    def _close_shard(self) -> None:
+        """Finish the current shard and move it to its final name
+
+        Returns:
+            None
+
+        """
+        self._archive.close()  # type: ignore
+        self._archive = None
+        os.replace(self._temp_path, self._shards[-1])
@@ -0,0 +1,569 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Interchangeable engines for decoding, cropping, and encoding images
+
+Each :py:class:`Backend` decodes an image into its own in-memory frame type,
+crops a region from the frame, shrinks it, and encodes it. The available
+backends are:
+
+* ``pillow``: The default, using Pillow and rawpy exactly as
+  :py:meth:`batch_crop.batch_crop.crop_file` does. Reported as
+  ``pillow-simd`` when the SIMD-accelerated Pillow fork is installed.
+* ``numpy``: Crops, rotates, and shrinks NumPy arrays, using Pillow and rawpy
+  only to decode and encode.
+* ``vips``: Uses libvips through the optional ``pyvips`` package, which only
+  decodes the cropped region of many formats. Not used for RAW images.
+
+A backend can be chosen for all images or per extension with a
+specification such as ``.jpg=vips,.arw=pillow,*=numpy`` (see
+:py:meth:`choose_backend`). Which is fastest depends on the format and the
+machine, so compare them with :py:mod:`batch_crop.benchmark`.
+
+"""
+
+import abc
+import importlib.metadata
+import os
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import rawpy
+from PIL import Image
+
+from batch_crop.archive import split_member_path
+from batch_crop.batch_crop import coor_to_box, crop_image, downscale_image, \
+    encode_image, get_decode_scale, get_orientation, get_raw_size, \
+    get_rendition_path, open_image, open_source, orient_box_ratio, \
+    ratios_to_coors, render_crop, Rendition, DEFAULT_QUALITY
+from batch_crop.formats import RAW_DECODER, RAW_EXTENSIONS
+from batch_crop.quad import Quad, Region
+from batch_crop.writer import write_atomic
+
+try:
+    import pyvips  # type: ignore
+except (ImportError, OSError):  # pragma: no cover
+    pyvips = None
+
+
+def is_pillow_simd() -> bool:
+    """Check whether the installed Pillow is the SIMD-accelerated fork
+
+    Both distributions install the ``PIL`` package under the same version
+    numbers, so the installed distribution is checked instead.
+
+    Returns:
+        ``True`` if the ``Pillow-SIMD`` distribution is installed
+
+    """
+    try:
+        importlib.metadata.distribution("Pillow-SIMD")
+    except importlib.metadata.PackageNotFoundError:
+        return False
+    return True
+
+
+class RenderResult(NamedTuple):
+    """Outputs produced for one image
+
+    Attributes:
+        backend: Name of the backend that produced them
+        outputs: Pairs of output path and encoded output. Empty if the
+            outputs have already been written.
+
+    """
+    backend: str
+    outputs: List[Tuple[str, bytes]]
+
+
+class Backend(abc.ABC):
+    """Decodes, crops, shrinks, and encodes images
+
+    Subclasses implement :py:meth:`decode`, :py:meth:`crop`,
+    :py:meth:`shrink`, and :py:meth:`encode` for their own frame type, and
+    :py:meth:`render` combines them.
+
+    Attributes:
+        name (str): Identifies the backend
+
+    """
+
+    name = ""
+
+    @classmethod
+    def is_available(cls) -> bool:
+        """Check whether the backend's libraries are installed
+
+        Returns:
+            ``True`` if the backend can be used
+
+        """
+        return True
+
+    def supports(self, path: str) -> bool:  # pylint: disable=unused-argument
+        """Check whether the backend can decode an image
+
+        Args:
+            path: Path or member path of the image
+
+        Returns:
+            ``True`` if the backend can decode the image
+
+        """
+        return True
+
+    @abc.abstractmethod
+    def decode(self, path: str, box_ratio: Tuple[float, float, float, float],
+               max_dimen: Optional[int]) -> Any:
+        """Decode an image, possibly at reduced resolution
+
+        See :py:meth:`batch_crop.batch_crop.open_image` for the meaning of
+        ``box_ratio`` and ``max_dimen``.
+
+        Args:
+            path: Path or member path of the image
+            box_ratio: The region that will be cropped from the image
+            max_dimen: The largest dimension the cropped region will be
+                shrunk to
+
+        Returns:
+            The decoded frame
+
+        """
+
+    @abc.abstractmethod
+    def crop(self, frame: Any, box_ratio: Tuple[float, float, float, float]) \
+            -> Any:
+        """Crop a region from a frame, making it upright
+
+        Args:
+            frame: The decoded frame
+            box_ratio: Region to crop, relative to the upright image
+
+        Returns:
+            The upright cropped frame
+
+        """
+
+    @abc.abstractmethod
+    def shrink(self, frame: Any, max_dimen: int) -> Any:
+        """Shrink a frame so that neither dimension exceeds ``max_dimen``
+
+        Args:
+            frame: The frame to shrink
+            max_dimen: Largest width or height the result may have
+
+        Returns:
+            The shrunk frame, or ``frame`` if it already fits
+
+        """
+
+    @abc.abstractmethod
+    def encode(self, frame: Any, image_format: str, quality: int) -> bytes:
+        """Encode a frame into an image file
+
+        Args:
+            frame: The frame to encode
+            image_format: Pillow-style format name, such as ``jpeg``
+            quality: Encoder quality
+
+        Returns:
+            The encoded image
+
+        """
+
+    # pylint: disable=too-many-arguments
+    def render(self, box_ratio: Tuple[float, float, float, float],
+               in_path: str, out_path: str,
+               renditions: Sequence[Rendition] = (),
+               max_dimen: Optional[int] = None) -> List[Tuple[str, bytes]]:
+        """Produce the outputs :py:meth:`batch_crop.batch_crop.render_crop`
+        would, using this backend
+
+        Args:
+            box_ratio: Region to crop. See :doc:`units`
+            in_path: Path or member path of the image to crop
+            out_path: Path the cropped image is to be saved to
+            renditions: Downscaled copies of the crop to encode as well
+            max_dimen: If given, the crop is shrunk so that neither dimension
+                exceeds this
+
+        Returns:
+            Pairs of output path and encoded output, starting with the crop
+
+        """
+        decode_dimen = None
+        if max_dimen is not None:
+            decode_dimen = max([max_dimen] + [r.max_dimen for r in renditions])
+        cropped = self.crop(self.decode(in_path, box_ratio, decode_dimen),
+                            box_ratio)
+        if max_dimen is not None:
+            cropped = self.shrink(cropped, max_dimen)
+        outputs = [(out_path,
+                    self.encode(cropped, "jpeg", DEFAULT_QUALITY))]
+        for rendition in sorted(renditions, key=lambda r: r.max_dimen,
+                                reverse=True):
+            cropped = self.shrink(cropped, rendition.max_dimen)
+            outputs.append((get_rendition_path(out_path, rendition),
+                            self.encode(cropped, rendition.format,
+                                        rendition.quality)))
+        return outputs
+
+
+class PillowBackend(Backend):
+    """The default backend, using Pillow and rawpy
+
+    Frames are Pillow images. Unlike the other backends, EXIF metadata is
+    carried over to the outputs.
+
+    """
+
+    name = "pillow-simd" if is_pillow_simd() else "pillow"
+
+    def decode(self, path: str, box_ratio: Tuple[float, float, float, float],
+               max_dimen: Optional[int]) -> Image:
+        return open_image(path, box_ratio, max_dimen)
+
+    def crop(self, frame: Image, box_ratio: Tuple[float, float, float, float]) \
+            -> Image:
+        return crop_image(box_ratio, frame)
+
+    def shrink(self, frame: Image, max_dimen: int) -> Image:
+        return downscale_image(frame, max_dimen)
+
+    def encode(self, frame: Image, image_format: str, quality: int) -> bytes:
+        return encode_image(frame, image_format, quality)
+
+    def render(self, box_ratio: Tuple[float, float, float, float],
+               in_path: str, out_path: str,
+               renditions: Sequence[Rendition] = (),
+               max_dimen: Optional[int] = None) -> List[Tuple[str, bytes]]:
+        return render_crop(box_ratio, in_path, out_path, renditions, max_dimen)
+
+
+class Frame(NamedTuple):
+    """Pixels of an image along with how to make them upright
+
+    Attributes:
+        pixels: The pixels, as stored
+        orientation: EXIF orientation of the pixels
+
+    """
+    pixels: Any
+    orientation: int
+
+
+class NumpyBackend(Backend):
+    """Backend that crops, rotates, and shrinks NumPy arrays
+
+    Frames are :py:class:`Frame` tuples of ``(height, width[, channels])``
+    arrays. Cropping takes a view of the decoded array rather than a copy.
+    Palette and bilevel images are decoded to RGB, or RGBA if they have
+    transparency, so that the arrays hold colors rather than palette indices.
+
+    """
+
+    name = "numpy"
+
+    def decode(self, path: str, box_ratio: Tuple[float, float, float, float],
+               max_dimen: Optional[int]) -> Frame:
+        source, decoder = open_source(path)
+        try:
+            if decoder != RAW_DECODER:
+                image = open_image(source, box_ratio, max_dimen)
+                orientation = get_orientation(image)
+                if image.mode in ("1", "P"):
+                    image = image.convert("RGBA" if "transparency" in
+                                          image.info else "RGB")
+                return Frame(np.asarray(image), orientation)
+            with rawpy.imread(source) as raw:
+                half_size = max_dimen is not None and get_decode_scale(
+                    get_raw_size(raw), box_ratio, max_dimen) <= 0.5
+                # Already upright, as postprocess() applies the flip
+                return Frame(raw.postprocess(half_size=half_size), 1)
+        finally:
+            if not isinstance(source, str):
+                source.close()
+
+    def crop(self, frame: Frame, box_ratio: Tuple[float, float, float, float]) \
+            -> Frame:
+        pixels, orientation = frame
+        height, width = pixels.shape[:2]
+        box_ratio = orient_box_ratio(box_ratio, orientation)
+        left, upper, right, lower = (
+            int(round(value)) for value in
+            coor_to_box(ratios_to_coors((width, height), box_ratio)))
+        cropped = pixels[max(0, upper):max(0, lower),
+                         max(0, left):max(0, right)]
+        return Frame(orient_array(cropped, orientation), 1)
+
+    def shrink(self, frame: Frame, max_dimen: int) -> Frame:
+        pixels = frame.pixels
+        height, width = pixels.shape[:2]
+        largest = max(height, width)
+        if largest <= max_dimen:
+            return frame
+        new_height = max(1, round(height * max_dimen / largest))
+        new_width = max(1, round(width * max_dimen / largest))
+
+        # Average blocks of pixels, then sample to the exact size
+        factor = largest // max_dimen
+        if factor >= 2:
+            height, width = height // factor, width // factor
+            blocks = pixels[:height * factor, :width * factor].reshape(
+                (height, factor, width, factor) + pixels.shape[2:])
+            pixels = blocks.mean(axis=(1, 3)).round().astype(pixels.dtype)
+        rows = (np.arange(new_height) * height // new_height)
+        cols = (np.arange(new_width) * width // new_width)
+        return Frame(pixels[rows][:, cols], 1)
+
+    def encode(self, frame: Frame, image_format: str, quality: int) -> bytes:
+        return encode_image(Image.fromarray(np.ascontiguousarray(frame.pixels)),
+                            image_format, quality)
+
+
+def orient_array(pixels: np.ndarray, orientation: int) -> np.ndarray:
+    """Make an array of pixels stored with an EXIF orientation upright
+
+    This is the NumPy equivalent of
+    :py:meth:`batch_crop.batch_crop.orient_image`. The result is a view of
+    ``pixels`` where possible.
+
+    Args:
+        pixels: Array of shape ``(height, width[, channels])``
+        orientation: EXIF orientation of the pixels
+
+    Returns:
+        The upright pixels
+
+    """
+    swapped = np.swapaxes(pixels, 0, 1)
+    return {2: pixels[:, ::-1],
+            3: pixels[::-1, ::-1],
+            4: pixels[::-1],
+            5: swapped,
+            6: swapped[:, ::-1],
+            7: swapped[::-1, ::-1],
+            8: swapped[::-1]}.get(orientation, pixels)
+
+
+class VipsBackend(Backend):
+    """Backend using libvips, which decodes only the region being cropped
+
+    Frames are :py:class:`Frame` tuples of ``pyvips.Image`` objects. Only
+    files that libvips opens directly are supported, so RAW images and
+    archive members are left to other backends.
+
+    """
+
+    name = "vips"
+
+    # Rotations and flips that make a libvips image upright, by orientation
+    ORIENT_OPERATIONS = {2: ("flip", "horizontal"),
+                         3: ("rot", "d180"),
+                         4: ("flip", "vertical"),
+                         5: ("rot", "d90", "flip", "horizontal"),
+                         6: ("rot", "d90"),
+                         7: ("rot", "d90", "flip", "vertical"),
+                         8: ("rot", "d270")}
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return pyvips is not None
+
+    def supports(self, path: str) -> bool:
+        _, ext = os.path.splitext(path)
+        return ext.lower() not in RAW_EXTENSIONS and \
+            split_member_path(path) is None
+
+    def decode(self, path: str, box_ratio: Tuple[float, float, float, float],
+               max_dimen: Optional[int]) -> Frame:
+        image = pyvips.Image.new_from_file(path)
+        orientation = image.get("orientation") \
+            if image.get_typeof("orientation") else 1
+        if max_dimen is not None and image.get("vips-loader").startswith(
+                "jpeg"):
+            scale = get_decode_scale(
+                (image.width, image.height),
+                orient_box_ratio(box_ratio, orientation), max_dimen)
+            shrink = max([1] + [factor for factor in (2, 4, 8)
+                                if scale <= 1 / factor])
+            if shrink > 1:
+                image = pyvips.Image.new_from_file(path, shrink=shrink)
+        return Frame(image, orientation)
+
+    def crop(self, frame: Frame, box_ratio: Tuple[float, float, float, float]) \
+            -> Frame:
+        image, orientation = frame
+        box_ratio = orient_box_ratio(box_ratio, orientation)
+        left, upper, right, lower = (
+            int(round(value)) for value in
+            coor_to_box(ratios_to_coors((image.width, image.height),
+                                        box_ratio)))
+        left, upper = max(0, left), max(0, upper)
+        right, lower = min(image.width, right), min(image.height, lower)
+        image = image.crop(left, upper, max(1, right - left),
+                           max(1, lower - upper))
+        operations = self.ORIENT_OPERATIONS.get(orientation, ())
+        for operation, argument in zip(operations[::2], operations[1::2]):
+            image = getattr(image, operation)(argument)
+        return Frame(image, 1)
+
+    def shrink(self, frame: Frame, max_dimen: int) -> Frame:
+        image = frame.pixels
+        largest = max(image.width, image.height)
+        if largest <= max_dimen:
+            return frame
+        return Frame(image.resize(max_dimen / largest), 1)
+
+    def encode(self, frame: Frame, image_format: str, quality: int) -> bytes:
+        image = frame.pixels
+        if image.get_typeof("orientation"):
+            image = image.copy()
+            image.remove("orientation")
+        form = image_format.lower()
+        suffix = {"jpeg": ".jpg", "tiff": ".tif"}.get(form, "." + form)
+        return image.write_to_buffer(suffix, Q=quality)
+
+
+# All backends, by name
+BACKENDS = {backend.name: backend for backend in
+            (PillowBackend(), NumpyBackend(), VipsBackend())}
+
+# Name of the backend used when none is chosen
+DEFAULT_BACKEND = PillowBackend.name
+
+
+def available_backends() -> List[str]:
+    """List the backends whose libraries are installed
+
+    Returns:
+        Names of the usable backends, starting with the default
+
+    """
+    return [name for name, backend in BACKENDS.items()
+            if backend.is_available()]
+
+
+def parse_backend_spec(spec: str) -> Dict[str, str]:
+    """Parse a choice of backend for all images or per extension
+
+    >>> parse_backend_spec(".JPG=numpy,*=pillow")
+    {'.jpg': 'numpy', '*': 'pillow'}
+    >>> parse_backend_spec("numpy")
+    {'*': 'numpy'}
+
+    Args:
+        spec: Either a backend name, ``auto``, or comma-separated pairs of
+            ``extension=backend`` where an extension of ``*`` matches any
+            image
+
+    Returns:
+        Maps lower-case extensions, or ``*``, to backend names
+
+    Raises:
+        ValueError: If a backend is unknown or not installed
+
+    """
+    choices = {}
+    for part in spec.split(","):
+        ext, _, name = part.rpartition("=")
+        choices[(ext or "*").lower()] = name
+    for name in choices.values():
+        if name != "auto" and name not in available_backends():
+            raise ValueError("Backend '{}' is not available. Choose from: {}"
+                             .format(name, ", ".join(available_backends())))
+    return choices
+
+
+def choose_backend(path: str, spec: str = DEFAULT_BACKEND) -> Backend:
+    """Choose the backend to crop an image with
+
+    With ``auto``, libvips is used where it is installed and supports the
+    image, and Pillow otherwise. A chosen backend that does not support the
+    image also falls back to Pillow.
+
+    Args:
+        path: Path or member path of the image
+        spec: Backend choice. See :py:meth:`parse_backend_spec`.
+
+    Returns:
+        The backend
+
+    """
+    choices = parse_backend_spec(spec)
+    _, ext = os.path.splitext(path)
+    name = choices.get(ext.lower(), choices.get("*", DEFAULT_BACKEND))
+    if name == "auto":
+        name = VipsBackend.name if VipsBackend.is_available() \
+            else DEFAULT_BACKEND
+    backend = BACKENDS[name]
+    return backend if backend.supports(path) else BACKENDS[DEFAULT_BACKEND]
+
+
+# pylint: disable=too-many-arguments
+def render(box_ratio: Region, in_path: str,
+           out_path: str, renditions: Sequence[Rendition] = (),
+           max_dimen: Optional[int] = None,
+           backend: str = DEFAULT_BACKEND) -> RenderResult:
+    """Produce an image's outputs with the chosen backend
+
+    Args:
+        box_ratio: Region to crop. See :doc:`units`. A
+            :py:class:`batch_crop.quad.Quad` is always cropped with Pillow.
+        in_path: Path or member path of the image to crop
+        out_path: Path the cropped image is to be saved to
+        renditions: Downscaled copies of the crop to encode as well
+        max_dimen: If given, the crop is shrunk so that neither dimension
+            exceeds this
+        backend: Backend choice. See :py:meth:`parse_backend_spec`.
+
+    Returns:
+        The outputs and the name of the backend that produced them
+
+    """
+    if isinstance(box_ratio, Quad):
+        # Only Pillow can rectify a quad
+        return RenderResult(DEFAULT_BACKEND, render_crop(
+            box_ratio, in_path, out_path, renditions, max_dimen))
+    chosen = choose_backend(in_path, backend)
+    return RenderResult(chosen.name, chosen.render(
+        box_ratio, in_path, out_path, renditions, max_dimen))
+
+
+def crop_with_backend(box_ratio: Region,
+                      in_path: str, out_path: str,
+                      renditions: Sequence[Rendition] = (),
+                      max_dimen: Optional[int] = None,
+                      backend: str = DEFAULT_BACKEND) -> RenderResult:
+    """Crop an image with the chosen backend and save the outputs
+
+    Like :py:meth:`batch_crop.batch_crop.crop_file`, outputs are written
+    atomically.
+
+    Accepts the same arguments as :py:meth:`render`.
+
+    Returns:
+        The name of the backend that produced the outputs, with no outputs
+        since they have been written
+
+    """
+    result = render(box_ratio, in_path, out_path, renditions, max_dimen,
+                    backend)
+    for path, data in result.outputs:
+        write_atomic(data, path)
+    return RenderResult(result.backend, [])
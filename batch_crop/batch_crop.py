@@ -19,17 +19,92 @@
 
 """
 
+import atexit
+import io
+import math
 import os
 from os.path import isfile, join
 import configparser
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 import tkinter as tk
 from tkinter.filedialog import askopenfilename, asksaveasfilename
 from tkinter import messagebox
-from typing import Tuple, List
+from typing import Tuple, List, NamedTuple, Sequence, Iterator, Union, \
+    BinaryIO, Optional, TYPE_CHECKING
 
 import rawpy
-from PIL import Image, ImageTk
+from PIL import Image, ImageTk, UnidentifiedImageError
+
+from batch_crop.archive import ArchiveWriter, open_member, split_member_path
+from batch_crop.formats import get_decoder, get_opener, map_file, \
+    RAW_DECODER
+from batch_crop.quad import get_bounds, order_corners, quad_from_coors, \
+    rectify, rotate_box, Quad, Region
+from batch_crop.writer import OutputWriter, write_atomic
+
+if TYPE_CHECKING:  # pragma: no cover
+    # Only for annotations, since batch_crop.catalog imports this module
+    from batch_crop.catalog import Catalog  # pylint: disable=cyclic-import
+
+# EXIF tag that stores how the sensor data must be transformed for display
+ORIENTATION_TAG = 0x0112
+
+# Transposes that bring an image stored with each EXIF orientation upright
+ORIENTATION_TRANSPOSES = {2: Image.FLIP_LEFT_RIGHT,
+                          3: Image.ROTATE_180,
+                          4: Image.FLIP_TOP_BOTTOM,
+                          5: Image.TRANSPOSE,
+                          6: Image.ROTATE_270,
+                          7: Image.TRANSVERSE,
+                          8: Image.ROTATE_90}
+
+# Encoder quality used when none is requested. This is Pillow's own JPEG
+# default, so crops encode as they did when saved without a quality.
+DEFAULT_QUALITY = 75
+
+# File extensions to use for outputs of each Pillow format
+FORMAT_EXTENSIONS = {"jpeg": "jpg", "tiff": "tif"}
+
+# Milliseconds a selection must stay unchanged before cropping starts in the
+# background
+SPECULATE_DELAY_MS = 500
+
+# Milliseconds between checks for whether a batch crop has finished
+CROP_POLL_INTERVAL_MS = 100
+
+
+class ImageHeader(NamedTuple):
+    """Properties of an image that can be read without decoding its pixels
+
+    Attributes:
+        format: Name of the image's format, for example ``JPEG`` or ``RAW``
+        size: Size of the image as :py:meth:`open_image` would return it
+        orientation: EXIF orientation that :py:meth:`get_orientation` would
+            report for the opened image
+
+    """
+    format: str
+    size: Tuple[int, int]
+    orientation: int
+
+
+class Rendition(NamedTuple):
+    """A downscaled copy of a crop to save alongside the crop
+
+    Attributes:
+        name: Suffix that distinguishes this rendition's file, for example
+            ``web`` or ``thumb``
+        max_dimen: Largest width or height the rendition may have. Crops that
+            are already small enough are not enlarged.
+        format: Pillow format name to save the rendition as
+        quality: Encoder quality, for formats that support one
+
+    """
+    name: str
+    max_dimen: int
+    format: str = "jpeg"
+    quality: int = DEFAULT_QUALITY
 
 
 def display_block(title: str, content: str) -> None:
@@ -80,12 +155,33 @@ class BatchCropper(tk.Frame):
         image_tk (ImageTk.PhotoImage): Image to display to the user for crop
             region selection
         to_crop (List[str]): The paths of all images to crop
+        catalog (Optional[batch_crop.catalog.Catalog]): Catalog that
+            directories are listed through, if any
         start_x (float): x-coordinate of one corner of the selected region
         start_y (float): y-coordinate of one corner of the selected region
         end_x (float): x-coordinate of the opposing corner of the selection
         end_y (float): y-coordinate of the opposing corner of the selection
         rect (tk.Canvas): Displayed rectangle that demarcates the selected
             region to crop
+        quad_corners (List[Tuple[float, float]]): Corners of a rotated or
+            four-point selection, clockwise from the top-left once all four
+            are chosen. Empty when the selection is an ordinary rectangle.
+        polygon (tk.Canvas): Displayed outline of the corners in
+            :py:attr:`quad_corners`
+        quad_mode (tk.BooleanVar): Whether clicks choose the four corners of
+            the region instead of dragging out a rectangle
+        angle (tk.DoubleVar): Clockwise rotation, in degrees, of a dragged
+            rectangle
+        speculate (tk.BooleanVar): Whether to start cropping in the
+            background once the selection settles
+        speculative (Optional[batch_crop.speculate.SpeculativeCropper]):
+            Stages crops in the background while :py:attr:`speculate` is set
+        speculate_job (Optional[str]): Pending Tkinter timer that starts
+            background cropping
+        filmstrip (Optional[batch_crop.filmstrip.Filmstrip]): Window
+            previewing the region on every image, if opened
+        cropping (Optional[Future]): Batch crop running in the background,
+            which resolves to the failures to report
         orig_size(Tuple[float, float]): The original size of the loaded image,
             stored as ``(width, height)``
         canvas (tk.Canvas): Where the image is displayed to the user
@@ -101,19 +197,29 @@ class BatchCropper(tk.Frame):
         label_dir_label (tk.Label): Displays the label for the directory
         label_ext (tk.Label): Displays the extension of images to crop
         label_ext_label (tk.Label): Displays the label for the extension
+        check_quad (tk.Checkbutton): Toggles :py:attr:`quad_mode`
+        label_angle (tk.Label): Displays the label for the rotation
+        spin_angle (tk.Spinbox): Sets :py:attr:`angle`
+        check_speculate (tk.Checkbutton): Toggles :py:attr:`speculate`
+        button_preview (tk.Button): Opens a
+            :py:class:`batch_crop.filmstrip.Filmstrip` previewing the
+            selected region on every image to crop
 
     """
 
     # INSPIRATION: fhdrsdg https://stackoverflow.com/a/29797178
-    def __init__(self, window: tk.Tk) -> None:
+    def __init__(self, window: tk.Tk,
+                 catalog: Optional["Catalog"] = None) -> None:
         """Setup attributes and build main user interface dialog
 
         Args:
             window: Root window on which to build the main UI
+            catalog: If given, directories are listed through this catalog
 
         """
         tk.Frame.__init__(self, window)
         self.window = window
+        self.catalog = catalog
 
         # Initialize instance fields for later
         self.scale_factor = 1  # type: float
@@ -124,6 +230,15 @@ class BatchCropper(tk.Frame):
         self.end_x = -1  # type: float
         self.end_y = -1  # type: float
         self.rect = None  # type: ignore
+        self.quad_corners = []  # type: List[Tuple[float, float]]
+        self.polygon = None  # type: ignore
+        self.quad_mode = tk.BooleanVar(self.window, False)
+        self.angle = tk.DoubleVar(self.window, 0.0)
+        self.speculate = tk.BooleanVar(self.window, False)
+        self.speculative = None  # type: ignore
+        self.speculate_job = None  # type: Optional[str]
+        self.filmstrip = None  # type: ignore
+        self.cropping = None  # type: Optional[Future]
         self.orig_size = -1, -1  # type: Tuple[float, float]
 
         self.canvas = tk.Canvas(self.window, width=500, height=500)
@@ -148,6 +263,8 @@ class BatchCropper(tk.Frame):
                                         command=BatchCropper.callback_license)
         self.button_quit = tk.Button(self.window, text="Quit",
                                      command=BatchCropper.callback_quit)
+        self.button_preview = tk.Button(self.window, text="Preview All Images",
+                                        command=self.callback_preview)
 
         self.label_instructions = tk.Label(self.window, text="Select an Image")
         self.label_dir = tk.Label(self.window, text="")
@@ -156,6 +273,19 @@ class BatchCropper(tk.Frame):
         self.label_ext = tk.Label(self.window, text="")
         self.label_ext_label = tk.Label(self.window,
                                         text="Extension of Images to Crop: ")
+        self.check_quad = tk.Checkbutton(self.window,
+                                         text="Select Four Corners",
+                                         variable=self.quad_mode,
+                                         command=self.callback_quad_mode)
+        self.label_angle = tk.Label(self.window, text="Rotation (degrees): ")
+        self.spin_angle = tk.Spinbox(self.window, from_=-45, to=45,
+                                     increment=0.5, width=6,
+                                     textvariable=self.angle,
+                                     command=self.callback_rotate)
+        self.spin_angle.bind("<Return>", lambda _: self.callback_rotate())
+        self.check_speculate = tk.Checkbutton(
+            self.window, text="Crop in Background", variable=self.speculate,
+            command=self.callback_speculate)
 
         # Arrange UI elements
         self.label_instructions.grid(row=0, column=0, columnspan=2)
@@ -174,6 +304,12 @@ class BatchCropper(tk.Frame):
         self.button_license.grid(row=8, column=0)
         self.button_quit.grid(row=9, column=0)
 
+        self.check_quad.grid(row=10, column=0)
+        self.label_angle.grid(row=11, column=0)
+        self.spin_angle.grid(row=11, column=1, sticky="w")
+        self.check_speculate.grid(row=12, column=0)
+        self.button_preview.grid(row=13, column=0)
+
         self.canvas.grid(row=3, column=1, rowspan=7)
 
     def callback_load_image(self) -> None:
@@ -195,16 +331,21 @@ class BatchCropper(tk.Frame):
         _, extension = os.path.splitext(chosen)
         extension = extension.lower()
         self.label_ext.configure(text=extension)
-        items = os.listdir(dir_path)
-        files = [item for item in items if isfile(join(dir_path, item))]
-        crop_names = [file for file in files
-                      if file.lower().endswith(extension)]
-        self.to_crop = [join(dir_path, name) for name in crop_names]
+        if self.catalog is not None:
+            self.to_crop = self.catalog.list_files(dir_path, extension)
+        else:
+            self.to_crop = list_matching_files(dir_path, extension)
+        if self.speculative is not None:
+            self.speculative.discard()
+        if self.filmstrip is not None and self.filmstrip.winfo_exists():
+            self.filmstrip.destroy()
 
         image_raw = open_image(chosen)
-        self.orig_size = image_raw.size
+        orientation = get_orientation(image_raw)
+        self.orig_size = oriented_size(image_raw.size, orientation)
         self.scale_factor = get_scale_factor(500, image_raw)
         image_resized = scale_image(self.scale_factor, image_raw)
+        image_resized = orient_image(image_resized, orientation)
 
         self.image_tk = self.display_image(image_resized)
         self.label_instructions.configure(text="Select Region to Crop")
@@ -239,6 +380,229 @@ class BatchCropper(tk.Frame):
 
         return coors_to_ratios(disp_size, coors)
 
+    def get_region(self) -> Region:
+        """Get the currently selected region
+
+        Returns:
+            A :py:class:`batch_crop.quad.Quad` if four corners are selected,
+            and otherwise the ``box_ratio`` from
+            :py:meth:`BatchCropper.get_coors_ratios`
+
+        """
+        if len(self.quad_corners) == 4:
+            width, height = self.orig_size
+            return quad_from_coors((width * self.scale_factor,
+                                    height * self.scale_factor),
+                                   self.quad_corners)
+        return self.get_coors_ratios()
+
+    def has_region(self) -> bool:
+        """Check whether a region is completely selected
+
+        Returns:
+            ``True`` if all four corners, or both corners of a rectangle, are
+            selected
+
+        """
+        if self.quad_corners:
+            return len(self.quad_corners) == 4
+        return self.end_x >= 0 and self.end_y >= 0
+
+    def set_region(self, region: Region) -> None:
+        """Select and display a region as if the user had selected it
+
+        Args:
+            region: A ``box_ratio`` or :py:class:`batch_crop.quad.Quad`
+
+        Returns:
+            None
+
+        """
+        if isinstance(region, Quad):
+            width, height = self.orig_size
+            self.start_x, self.start_y, self.end_x, self.end_y = -1, -1, -1, -1
+            self.quad_corners = region.to_coors((width * self.scale_factor,
+                                                 height * self.scale_factor))
+            self.draw_quad()
+        else:
+            self.quad_corners = []
+            self.canvas.delete(self.polygon)
+            self.set_coors_ratios(region)
+            self.replace_rect(self.start_x, self.start_y)
+            self.resize_rect(self.start_x, self.start_y, self.end_x,
+                             self.end_y)
+        self.region_changed()
+
+    def draw_quad(self) -> None:
+        """Display the corners in :py:attr:`quad_corners` as an outline
+
+        The outline replaces any rectangle, and is closed once all four
+        corners are chosen.
+
+        Returns:
+            None
+
+        """
+        self.canvas.delete(self.rect)
+        self.canvas.delete(self.polygon)
+        points = list(self.quad_corners)
+        if len(points) == 4:
+            points.append(points[0])
+        elif len(points) == 1:
+            points.append(points[0])
+        self.polygon = self.canvas.create_line(
+            *[value for point in points for value in point], fill="red")
+
+    def callback_quad_mode(self) -> None:
+        """Clear the selection when switching how regions are selected
+
+        Returns:
+            None
+
+        """
+        self.quad_corners = []
+        self.start_x, self.start_y, self.end_x, self.end_y = -1, -1, -1, -1
+        self.canvas.delete(self.rect)
+        self.canvas.delete(self.polygon)
+        if self.quad_mode.get():
+            self.label_instructions.configure(text="Click Corner 1 of 4")
+        else:
+            self.label_instructions.configure(text="Select Region to Crop")
+        self.region_changed()
+
+    def callback_rotate(self) -> None:
+        """Rotate a dragged-out rectangle by :py:attr:`angle`
+
+        The rotated rectangle is stored in :py:attr:`quad_corners`. At an
+        angle of ``0``, the plain rectangle is restored.
+
+        Returns:
+            None
+
+        """
+        if self.quad_mode.get() or self.end_x < 0 or self.end_y < 0:
+            return
+        try:
+            angle = self.angle.get()
+        except tk.TclError:
+            return
+        if angle:
+            self.quad_corners = rotate_box(
+                (self.start_x, self.start_y, self.end_x, self.end_y), angle)
+            self.draw_quad()
+        else:
+            self.quad_corners = []
+            self.canvas.delete(self.polygon)
+            self.replace_rect(self.start_x, self.start_y)
+            self.resize_rect(self.start_x, self.start_y, self.end_x,
+                             self.end_y)
+        self.region_changed()
+
+    def region_changed(self) -> None:
+        """Act on a newly completed selection
+
+        Background cropping is scheduled with
+        :py:meth:`BatchCropper.schedule_speculation`, and any open
+        :py:class:`batch_crop.filmstrip.Filmstrip` shows the new region.
+
+        Returns:
+            None
+
+        """
+        self.schedule_speculation()
+        if self.filmstrip is not None and self.filmstrip.winfo_exists():
+            self.filmstrip.set_region(self.get_region()
+                                      if self.has_region() else None)
+
+    def callback_preview(self) -> None:
+        """Open a filmstrip of all images to crop, with the region drawn on
+
+        Any filmstrip already open is replaced. An error dialog is displayed
+        if no image is loaded.
+
+        Returns:
+            None
+
+        """
+        # Imported here because batch_crop.filmstrip imports this module
+        from batch_crop.filmstrip import Filmstrip
+
+        if len(self.to_crop) == 0:  # pylint: disable=len-as-condition
+            messagebox.showerror("Error", "Please load an image first.")
+            return
+        if self.filmstrip is not None and self.filmstrip.winfo_exists():
+            self.filmstrip.destroy()
+        self.filmstrip = Filmstrip(
+            self.window, self.to_crop,
+            self.get_region() if self.has_region() else None)
+
+    def callback_speculate(self) -> None:
+        """Start or stop cropping in the background
+
+        Turning :py:attr:`speculate` on creates a
+        :py:class:`batch_crop.speculate.SpeculativeCropper` and stages the
+        current selection, if any. Turning it off discards all staged work.
+
+        Returns:
+            None
+
+        """
+        # Imported here because batch_crop.speculate imports this module
+        from batch_crop.speculate import SpeculativeCropper
+
+        if self.speculate.get():
+            if self.speculative is None:
+                self.speculative = SpeculativeCropper()
+                atexit.register(self.speculative.close)
+            self.schedule_speculation()
+        elif self.speculative is not None:
+            self.cancel_speculation()
+            self.speculative.discard()
+
+    def schedule_speculation(self) -> None:
+        """Start cropping in the background once the selection settles
+
+        Cropping starts after :py:data:`SPECULATE_DELAY_MS`, unless the
+        selection changes first.
+
+        Returns:
+            None
+
+        """
+        if not self.speculate.get() or self.speculative is None or \
+                not self.to_crop or not self.has_region():
+            return
+        self.cancel_speculation()
+        self.speculate_job = self.window.after(SPECULATE_DELAY_MS,
+                                               self.start_speculation)
+
+    def cancel_speculation(self) -> None:
+        """Stop background cropping from starting, and pause any underway
+
+        Crops already staged are kept in case the selection does not change.
+
+        Returns:
+            None
+
+        """
+        if self.speculate_job is not None:
+            self.window.after_cancel(self.speculate_job)
+            self.speculate_job = None
+        if self.speculative is not None:
+            self.speculative.pause()
+
+    def start_speculation(self) -> None:
+        """Stage crops of all images to the current selection
+
+        Returns:
+            None
+
+        """
+        self.speculate_job = None
+        if self.has_region():
+            self.speculative.stage(self.get_region(), [
+                (path, path + "_cropped.jpg") for path in self.to_crop])
+
     def set_coors_ratios(self, box_ratio: Tuple[float, float, float, float]) \
             -> None:
         """Set the coordinates of the selected region from ratios
@@ -270,9 +634,10 @@ class BatchCropper(tk.Frame):
         file. This coordinates can be later loaded using
         :py:meth:`BatchCropper.callback_load_coors`.
 
-        The coordinates are actually saved as a ``box_ratio``, which is
-        generated by :py:meth:`BatchCropper.get_coors_ratios`. The file is
-        created and saved by :py:meth:`save_ratios_to_file`.
+        The coordinates are actually saved as a ``box_ratio`` or
+        :py:class:`batch_crop.quad.Quad`, which is generated by
+        :py:meth:`BatchCropper.get_region`. The file is created and saved by
+        :py:meth:`save_ratios_to_file`.
 
         Error dialogs are displayed if no image is loaded or if no region
         is selected.
@@ -284,11 +649,11 @@ class BatchCropper(tk.Frame):
         if len(self.to_crop) == 0:  # pylint: disable=len-as-condition
             messagebox.showerror("Error", "Please load an image first.")
             return
-        if self.end_x < 0 or self.end_y < 0:
+        if not self.has_region():
             messagebox.showerror("Error", "Please select a region first.")
             return
 
-        box_ratio = self.get_coors_ratios()
+        box_ratio = self.get_region()
         path = asksaveasfilename(title="Save Coordinates File",
                                  defaultextension=".ini",
                                  initialdir=os.path.dirname(self.to_crop[0]))
@@ -307,8 +672,9 @@ class BatchCropper(tk.Frame):
         configuration file cannot be parsed.
 
         The configuration file is read with :py:meth:`get_ratios_from_file`,
-        which yields a ``box_ratio`` (see :doc:`units`) that is then loaded
-        using :py:meth:`BatchCropper.set_coors_ratios`.
+        which yields a ``box_ratio`` (see :doc:`units`) or
+        :py:class:`batch_crop.quad.Quad` that is then loaded using
+        :py:meth:`BatchCropper.set_region`.
 
         Returns:
             None
@@ -329,15 +695,15 @@ class BatchCropper(tk.Frame):
                                  format(path))
             return
 
-        self.set_coors_ratios(ratios)
-        self.replace_rect(self.start_x, self.start_y)
-        self.resize_rect(self.start_x, self.start_y, self.end_x, self.end_y)
+        self.set_region(ratios)
 
     def callback_mouse_down(self, event) -> None:
         """Start drawing out a rectangle
 
         The rectangle is started using
-        :py:meth:`BatchCropper.replace_rect`.
+        :py:meth:`BatchCropper.replace_rect`. In :py:attr:`quad_mode`, a
+        corner is chosen instead, starting a new set of corners if four are
+        already chosen. Any background cropping is paused.
 
         This callback is meant to be bound using
         Tkinter to the mouse move event. Tkinter will then pass the
@@ -352,6 +718,15 @@ class BatchCropper(tk.Frame):
             None
 
         """
+        self.cancel_speculation()
+        if self.quad_mode.get():
+            if len(self.quad_corners) == 4:
+                self.quad_corners = []
+            self.quad_corners.append((event.x, event.y))
+            self.draw_quad()
+            return
+        self.quad_corners = []
+        self.canvas.delete(self.polygon)
         self.start_x = event.x
         self.start_y = event.y
         self.end_x = -1
@@ -398,7 +773,8 @@ class BatchCropper(tk.Frame):
         cur_x = event.x
         cur_y = event.y
 
-        if self.end_x == -1 and self.end_y == -1:
+        if not self.quad_mode.get() and self.end_x == -1 and \
+                self.end_y == -1:
             self.resize_rect(self.start_x, self.start_y, cur_x, cur_y)
 
     @staticmethod
@@ -467,6 +843,11 @@ class BatchCropper(tk.Frame):
         needed ``event`` parameter as it calls this method whenever the mouse
         button is released.
 
+        In :py:attr:`quad_mode`, the corners are put in order once all four
+        are chosen. Otherwise, the rectangle is rotated by :py:attr:`angle`.
+        Once the region is complete, :py:meth:`BatchCropper.region_changed`
+        is called.
+
         Args:
             event: The event from Tkinter that has attributes ``.x`` and ``.y``
                 that hold the coordinates of the cursor when mouse released
@@ -475,9 +856,20 @@ class BatchCropper(tk.Frame):
             None
 
         """
-        self.end_x = event.x
-        self.end_y = event.y
+        if self.quad_mode.get():
+            if len(self.quad_corners) < 4:
+                self.label_instructions.configure(
+                    text="Click Corner {} of 4".format(
+                        len(self.quad_corners) + 1))
+                return
+            self.quad_corners = order_corners(self.quad_corners)
+            self.draw_quad()
+        else:
+            self.end_x = event.x
+            self.end_y = event.y
+            self.callback_rotate()
         self.label_instructions.configure(text="Re-select Region or Crop All")
+        self.region_changed()
 
     def callback_crop(self) -> None:
         """Trigger the cropping of all images
@@ -489,7 +881,7 @@ class BatchCropper(tk.Frame):
             None
 
         """
-        if self.end_x is None or self.end_y is None:
+        if not self.has_region():
             messagebox.showerror("Error", "Please select a region to crop.")
         else:
             self.crop_all_files()
@@ -500,14 +892,28 @@ class BatchCropper(tk.Frame):
         Validates that the user has selected a region.
 
         No validation is performed on :py:attr:`to_crop`. The user is asked to
-        confirm, skip, or abort before any file is over-written.
+        confirm, skip, or abort before any file is over-written. Once every
+        file has been decided on, the files are cropped in parallel by
+        :py:func:`crop_collecting_failures` on a background thread, so the
+        window stays responsive. :py:meth:`poll_cropping` checks on it from
+        the Tkinter main loop.
 
-        Each file is cropped using :py:meth:`crop_file`
+        Crops already staged in the background for the same region are moved
+        into place first, and only the rest are cropped.
+
+        A file that fails to crop does not stop the others. Once all are
+        done, any failures are listed in a new window.
 
         Returns:
             None
 
         """
+        if self.cropping is not None:
+            messagebox.showinfo("Cropping", "The images are still being "
+                                            "cropped.")
+            return
+
+        paths = []
         for path in self.to_crop:
             new_path = path + "_cropped.jpg"
             if os.path.exists(new_path):
@@ -519,13 +925,85 @@ class BatchCropper(tk.Frame):
                 if choice is None:
                     return
                 if choice:
-                    crop_file(self.get_coors_ratios(), path, new_path)
+                    paths.append((path, new_path))
             else:
-                crop_file(self.get_coors_ratios(), path, new_path)
+                paths.append((path, new_path))
+
+        region = self.get_region()
+        total = len(paths)
+        if self.speculative is not None:
+            self.cancel_speculation()
+            paths = self.speculative.commit(region, paths)
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.cropping = executor.submit(crop_collecting_failures, region,
+                                        paths)
+        executor.shutdown(wait=False)
+        self.button_submit.config(state=tk.DISABLED)
+        self.window.after(CROP_POLL_INTERVAL_MS, self.poll_cropping, total)
+
+    def poll_cropping(self, total: int) -> None:
+        """Report the failures of the batch crop once it has finished
+
+        Checks again after :py:data:`CROP_POLL_INTERVAL_MS` while
+        :py:attr:`cropping` is still running.
 
+        Args:
+            total: Number of images the batch crop was started with
 
-def crop_file(box_ratio: Tuple[float, float, float, float],
-              in_path: str, out_path: str) -> None:
+        Returns:
+            None
+
+        """
+        if self.cropping is None:
+            return
+        if not self.cropping.done():
+            self.window.after(CROP_POLL_INTERVAL_MS, self.poll_cropping, total)
+            return
+        cropping, self.cropping = self.cropping, None
+        self.button_submit.config(state=tk.NORMAL)
+        error = cropping.exception()
+        if error is not None:
+            messagebox.showerror("Error", "Cropping failed: {}".format(error))
+            return
+        failures = cropping.result()
+        if failures:
+            display_block("Crop Errors", "{} of {} images failed to crop:\n\n"
+                          "{}".format(len(failures), total,
+                                      "\n".join(sorted(failures))))
+
+
+def crop_collecting_failures(box_ratio: Region,
+                             paths: Sequence[Tuple[str, str]]) -> List[str]:
+    """Crop files in parallel and describe those that failed
+
+    The files are cropped by :py:func:`batch_crop.schedule.crop_files`,
+    which keeps the decodes within the available memory.
+
+    Args:
+        box_ratio: Region to crop, as for :py:func:`crop_file`
+        paths: Pairs of input and output paths to crop
+
+    Returns:
+        One ``path: error`` line for each file that could not be cropped
+
+    """
+    # Imported here because batch_crop.schedule imports this module
+    from batch_crop.schedule import crop_files
+
+    failures = []
+    for job, future in crop_files(box_ratio, paths):
+        error = future.exception()
+        if error is not None:
+            failures.append("{}: {}".format(job.in_path, error))
+    return failures
+
+
+# pylint: disable=too-many-arguments
+def crop_file(box_ratio: Region, in_path: str, out_path: str,
+              renditions: Sequence[Rendition] = (),
+              max_dimen: Optional[int] = None,
+              writer: Optional[Union[OutputWriter, ArchiveWriter]] = None) \
+        -> None:
     """Save a copy of an image cropped to a specified region
 
     Crops the image at ``in_path`` to the same relative region as the user
@@ -537,41 +1015,308 @@ def crop_file(box_ratio: Tuple[float, float, float, float],
     No validation is performed on ``in_path``.
 
     The cropped image is formatted as a JPEG and saved to ``out_path``. Any
-    existing file at ``out_path`` may be overwritten.
+    existing file at ``out_path`` may be overwritten, but only once the new
+    crop is completely written, so an interrupted crop never leaves a
+    truncated file behind.
 
-    The cropped image is created using :py:meth:`crop_image`.
+    The outputs are produced by :py:meth:`render_crop` and written by
+    ``writer``, or by :py:meth:`batch_crop.writer.write_atomic` if no writer
+    is given.
 
     Args:
         box_ratio: A ``box_ratio`` (See :doc:`units`) that describes the region
             to crop
         in_path: The path of the image to crop
         out_path: The path of the file to save the cropped image to
+        renditions: Downscaled copies of the crop to save as well
+        max_dimen: If given, the saved crop is shrunk so that neither
+            dimension exceeds this
+        writer: Writes the outputs in the background, for example a
+            :py:class:`batch_crop.writer.OutputWriter` or a
+            :py:class:`batch_crop.archive.ArchiveWriter`
 
     Returns:
         ``True`` if cropping should continue, ``False`` otherwise.
 
     """
-    to_crop = open_image(in_path)
+    for path, data in render_crop(box_ratio, in_path, out_path, renditions,
+                                  max_dimen):
+        if writer is None:
+            write_atomic(data, path)
+        else:
+            writer.write(data, path, in_path)
+
+
+def render_crop(box_ratio: Region, in_path: str, out_path: str,
+                renditions: Sequence[Rendition] = (),
+                max_dimen: Optional[int] = None) -> List[Tuple[str, bytes]]:
+    """Crop an image and encode the outputs :py:meth:`crop_file` would save
+
+    The crop is created using :py:meth:`crop_image`. Since the crop is
+    already upright, any EXIF metadata from the original is preserved with
+    its orientation reset to normal.
+
+    Each of ``renditions`` is also encoded, for the path given by
+    :py:meth:`get_rendition_path`. They are all made from the same in-memory
+    crop by :py:meth:`make_renditions`, so the image is only decoded once.
+
+    If ``max_dimen`` is given, the image may be decoded at a reduced
+    resolution, as described in :py:meth:`open_image`, since the full
+    resolution would be discarded anyway.
+
+    Args:
+        box_ratio: A ``box_ratio`` (See :doc:`units`) that describes the region
+            to crop
+        in_path: The path of the image to crop
+        out_path: The path the cropped image is to be saved to
+        renditions: Downscaled copies of the crop to encode as well
+        max_dimen: If given, the crop is shrunk so that neither dimension
+            exceeds this
+
+    Returns:
+        Pairs of output path and encoded output, starting with the crop
+
+    """
+    decode_dimen = None
+    if max_dimen is not None:
+        decode_dimen = max([max_dimen] + [r.max_dimen for r in renditions])
+    to_crop = open_image(in_path, box_ratio, decode_dimen)
     cropped = crop_image(box_ratio, to_crop)
-    cropped.save(out_path, "jpeg")
+    if max_dimen is not None:
+        cropped = downscale_image(cropped, max_dimen)
+    exif = get_save_exif(to_crop)
+    outputs = [(out_path, encode_image(cropped, "jpeg", **exif))]
+    for rendition, image in make_renditions(cropped, renditions):
+        outputs.append((get_rendition_path(out_path, rendition),
+                        encode_image(image, rendition.format,
+                                     rendition.quality, **exif)))
+    return outputs
+
+
+def make_renditions(image: Image, renditions: Sequence[Rendition]) \
+        -> Iterator[Tuple[Rendition, Image]]:
+    """Generate downscaled copies of an image
+
+    Renditions are produced from largest to smallest, and each is scaled
+    down from the previous one rather than from ``image``. This way the
+    smaller renditions are cheap, and most of the shrinking is done by
+    ``Image.reduce``, which averages blocks of pixels, before a final
+    high-quality resize to the exact size.
 
+    Args:
+        image: The image to make renditions of
+        renditions: The renditions to make, in any order
+
+    Returns:
+        Iterator of each rendition paired with its image, from largest to
+        smallest
+
+    """
+    current = image
+    for rendition in sorted(renditions, key=lambda r: r.max_dimen,
+                            reverse=True):
+        current = downscale_image(current, rendition.max_dimen)
+        yield rendition, current
+
+
+def downscale_image(image: Image, max_dimen: int) -> Image:
+    """Shrink an image so that neither dimension exceeds ``max_dimen``
+
+    The aspect ratio is preserved. Images that already fit are returned
+    unchanged.
+
+    Args:
+        image: The image to shrink
+        max_dimen: Largest width or height the result may have
 
-def crop_image(box_ratio: Tuple[float, float, float, float], image: Image):
+    Returns:
+        The shrunk image
+
+    """
+    largest = max(image.size)
+    if largest <= max_dimen:
+        return image
+    scale = max_dimen / largest
+    width, height = (max(1, round(dimen * scale)) for dimen in image.size)
+    factor = largest // max_dimen
+    if factor >= 2:
+        image = image.reduce(factor)
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def get_rendition_path(out_path: str, rendition: Rendition) -> str:
+    """Get the path to save a rendition of the crop saved at ``out_path``
+
+    >>> get_rendition_path("img1.ARW_cropped.jpg", Rendition("web", 1600))
+    'img1.ARW_cropped_web.jpg'
+
+    Args:
+        out_path: Path that the full-size crop is saved to
+        rendition: The rendition to get the path of
+
+    Returns:
+        Path for the rendition
+
+    """
+    root, _ = os.path.splitext(out_path)
+    form = rendition.format.lower()
+    return "{}_{}.{}".format(root, rendition.name,
+                             FORMAT_EXTENSIONS.get(form, form))
+
+
+def crop_image(box_ratio: Region, image: Image):
     """Generate a copy of an image cropped to a specified region
 
+    ``box_ratio`` is interpreted relative to the image as it is displayed,
+    which for images with an EXIF orientation differs from how the pixels are
+    stored. Rather than rotating the whole image upright, the box is mapped
+    into the stored orientation with :py:meth:`orient_box_ratio` and only the
+    cropped region is transposed.
+
+    A :py:class:`batch_crop.quad.Quad` is cropped to its bounding box, which
+    is then rectified by :py:meth:`batch_crop.quad.rectify`.
+
     Args:
-        box_ratio: A ``box_ratio`` (See :doc:`units`) that defines the region to
-            crop
+        box_ratio: A ``box_ratio`` (See :doc:`units`) or
+            :py:class:`batch_crop.quad.Quad` that defines the region to crop
         image: The image to crop
 
     Returns:
-        The cropped image
+        The cropped image, upright
 
     """
+    if isinstance(box_ratio, Quad):
+        left, upper, _, _ = box_ratio.bounds
+        width, height = oriented_size(image.size, get_orientation(image))
+        # Image.crop rounds the bounds to whole pixels
+        offset_x, offset_y = round(left * width), round(upper * height)
+        return rectify(crop_image(box_ratio.bounds, image),
+                       [(x - offset_x, y - offset_y)
+                        for x, y in box_ratio.to_coors((width, height))])
+    orientation = get_orientation(image)
+    box_ratio = orient_box_ratio(box_ratio, orientation)
     box_coor = ratios_to_coors(image.size, box_ratio)
     box = coor_to_box(box_coor)
     cropped = image.crop(box)
-    return cropped
+    return orient_image(cropped, orientation)
+
+
+def get_orientation(image: Image) -> int:
+    """Get the EXIF orientation of an image
+
+    Args:
+        image: The image to inspect
+
+    Returns:
+        The orientation, from ``1`` to ``8``. Images without a valid
+        orientation are reported as ``1`` (normal).
+
+    """
+    orientation = image.getexif().get(ORIENTATION_TAG, 1)
+    return orientation if orientation in range(1, 9) else 1
+
+
+def oriented_size(size: Tuple[float, float], orientation: int) \
+        -> Tuple[float, float]:
+    """Get the displayed size of an image from its stored size
+
+    >>> oriented_size((300, 200), 6)
+    (200, 300)
+
+    Args:
+        size: Size of the image as stored
+        orientation: EXIF orientation of the image
+
+    Returns:
+        Size of the image once it is upright
+
+    """
+    width, height = size
+    if orientation >= 5:
+        return height, width
+    return width, height
+
+
+def orient_image(image: Image, orientation: int) -> Image:
+    """Transpose an image stored with an EXIF orientation to be upright
+
+    Args:
+        image: The image, in its stored orientation
+        orientation: EXIF orientation of the image
+
+    Returns:
+        The upright image. This is ``image`` itself if no transpose is needed.
+
+    """
+    if orientation in ORIENTATION_TRANSPOSES:
+        return image.transpose(ORIENTATION_TRANSPOSES[orientation])
+    return image
+
+
+def orient_box_ratio(box_ratio: Tuple[float, float, float, float],
+                     orientation: int) -> Tuple[float, float, float, float]:
+    """Map a ``box_ratio`` on the upright image into its stored orientation
+
+    >>> orient_box_ratio((0.1, 0.2, 0.5, 0.6), 6)
+    (0.2, 0.9, 0.6, 0.5)
+
+    Args:
+        box_ratio: ``box_ratio`` relative to the image as displayed
+        orientation: EXIF orientation of the image
+
+    Returns:
+        ``box_ratio`` that selects the same pixels from the image as stored
+
+    """
+    x1, y1, x2, y2 = box_ratio
+    start_x, start_y = orient_point_ratio((x1, y1), orientation)
+    end_x, end_y = orient_point_ratio((x2, y2), orientation)
+    return start_x, start_y, end_x, end_y
+
+
+def orient_point_ratio(point: Tuple[float, float], orientation: int) \
+        -> Tuple[float, float]:
+    """Map a point, as ratios, on the upright image into its stored orientation
+
+    Args:
+        point: ``(x, y)``, each a ratio, relative to the image as displayed
+        orientation: EXIF orientation of the image
+
+    Returns:
+        ``(x, y)`` relative to the image as stored
+
+    """
+    x, y = point
+    mapped = {2: (1 - x, y),
+              3: (1 - x, 1 - y),
+              4: (x, 1 - y),
+              5: (y, x),
+              6: (y, 1 - x),
+              7: (1 - y, 1 - x),
+              8: (1 - y, x)}
+    return mapped.get(orientation, (x, y))
+
+
+def get_save_exif(image: Image) -> dict:
+    """Get keyword arguments that carry ``image``'s EXIF data to a saved crop
+
+    The orientation, if any, is reset to normal because crops are made
+    upright by :py:meth:`crop_image`.
+
+    Args:
+        image: The original image that was cropped
+
+    Returns:
+        Keyword arguments for ``Image.save``. Empty if ``image`` has no EXIF
+        data.
+
+    """
+    exif = image.getexif()
+    if not exif:
+        return {}
+    if ORIENTATION_TAG in exif:
+        exif[ORIENTATION_TAG] = 1
+    return {"exif": exif.tobytes()}
 
 
 def scale_image(scale_factor: float, image_raw: Image) -> Image:
@@ -692,8 +1437,7 @@ def ratios_to_coors(image_size: Tuple[float, float],
     return x1, y1, x2, y2
 
 
-def gen_ratios_config(box_ratio: Tuple[float, float, float, float]) \
-        -> configparser.ConfigParser:
+def gen_ratios_config(box_ratio: Region) -> configparser.ConfigParser:
     """Create the configuration that stores the provided box
 
     The configuration is stored under the section ``crop-coordinates`` in the
@@ -709,15 +1453,25 @@ def gen_ratios_config(box_ratio: Tuple[float, float, float, float]) \
 
     substituting ``{...}`` for the value of the variable in braces.
 
+    A :py:class:`batch_crop.quad.Quad` is instead stored under the section
+    ``crop-quad``, with its corners in order as ``x1``, ``y1``, ..., ``x4``,
+    ``y4``.
+
     Args:
-        box_ratio: The box_ratio to generate a configuration for
+        box_ratio: The box_ratio or quad to generate a configuration for
 
     Returns:
         The configuration
 
     """
-    start_x, start_y, end_x, end_y = box_ratio
     config = configparser.ConfigParser()
+    if isinstance(box_ratio, Quad):
+        config["crop-quad"] = {}
+        for number, (x, y) in enumerate(box_ratio.corners, start=1):
+            config["crop-quad"]["x{}".format(number)] = str(x)
+            config["crop-quad"]["y{}".format(number)] = str(y)
+        return config
+    start_x, start_y, end_x, end_y = box_ratio
     config["crop-coordinates"] = {"start_x": str(start_x),
                                   "start_y": str(start_y),
                                   "end_x": str(end_x),
@@ -725,8 +1479,7 @@ def gen_ratios_config(box_ratio: Tuple[float, float, float, float]) \
     return config
 
 
-def save_ratios_to_file(box_ratio: Tuple[float, float, float, float],
-                        path: str) -> None:
+def save_ratios_to_file(box_ratio: Region, path: str) -> None:
     """Save the configuration for the ``box_ratio`` to the specified INI file
 
     The configuration is generated by :py:meth:`gen_coors_config`.
@@ -750,7 +1503,7 @@ def save_ratios_to_file(box_ratio: Tuple[float, float, float, float],
         config.write(configfile)
 
 
-def get_ratios_from_file(path: str) -> Tuple[float, float, float, float]:
+def get_ratios_from_file(path: str) -> Region:
     """Get a ``box_ratio`` from a configuration file
 
     The configuration file should have been generated by
@@ -769,17 +1522,24 @@ def get_ratios_from_file(path: str) -> Tuple[float, float, float, float]:
     return get_ratios_from_config(config)
 
 
-def get_ratios_from_config(config: configparser.ConfigParser) \
-        -> Tuple[float, float, float, float]:
+def get_ratios_from_config(config: configparser.ConfigParser) -> Region:
     """Get a ``box_ratio`` from a configuration
 
     Args:
         config: INI configuration describing the ``box_ratio`` to read
 
     Returns:
-        ``box_ratio`` described by the configuration
+        ``box_ratio`` described by the configuration, or a
+        :py:class:`batch_crop.quad.Quad` if the configuration has a
+        ``crop-quad`` section
 
     """
+    if config.has_section("crop-quad"):
+        quad_conf = config["crop-quad"]
+        return Quad(tuple(  # type: ignore
+            (quad_conf.getfloat("x{}".format(number)),
+             quad_conf.getfloat("y{}".format(number)))
+            for number in range(1, 5)))
     coor_conf = config["crop-coordinates"]
     # Remember these are ratios
     start_x = coor_conf.getfloat("start_x")
@@ -790,49 +1550,351 @@ def get_ratios_from_config(config: configparser.ConfigParser) \
     return start_x, start_y, end_x, end_y
 
 
-def open_image(path: str) -> Image:
+def open_image(path: Union[str, BinaryIO],
+               box_ratio: Optional[Region] = None,
+               max_dimen: Optional[int] = None) -> Image:
     """Attempt to open an image, using a method appropriate for the format
 
-    Supported image types: RAW / ARW and those supported by Pillow.
-    Errors are not handled. Format is determined by file extension.
+    Supported image types: RAW / ARW, those supported by Pillow, and those
+    registered with :py:meth:`batch_crop.formats.register_format`. Errors are
+    not handled. Paths are opened with :py:meth:`open_source`, and the format
+    is detected from the contents as described in
+    :py:mod:`batch_crop.formats`, using the extension, which for a file
+    object is taken from its ``name`` attribute, only to break ties. File
+    objects of unrecognized formats without a name are tried with Pillow
+    first and then as RAW. Images inside tar or zip archives can be opened
+    using a member path, as described in :py:mod:`batch_crop.archive`.
+
+    If ``box_ratio`` and ``max_dimen`` are given, the caller promises to only
+    use the region ``box_ratio`` shrunk to fit within ``max_dimen``. The
+    image may then be decoded at a reduced resolution, which is much faster:
+    JPEGs at 1/2, 1/4, or 1/8 scale using Pillow's ``draft`` mode and RAW
+    images at half size. The region is still at least ``max_dimen`` in its
+    largest dimension. Since a ``box_ratio`` is relative, it selects the same
+    region of the smaller image. A :py:class:`batch_crop.quad.Quad` is
+    treated as its bounding box.
 
     Args:
-        path: Path to the image. Must correctly point to a supported image
+        path: Path to the image, or a binary file object positioned at the
+            start of the image. Must correctly point to a supported image
             type.
+        box_ratio: The region that will be cropped from the image
+        max_dimen: The largest dimension the cropped region will be shrunk to
 
     Returns:
         A Pillow Image object loaded from ``path``
 
     """
+    if box_ratio is not None:
+        box_ratio = get_bounds(box_ratio)
+    if isinstance(path, str):
+        source, decoder = open_source(path)
+        if isinstance(source, str) or decoder == RAW_DECODER:
+            try:
+                return open_raw_image(source, box_ratio, max_dimen)
+            finally:
+                if not isinstance(source, str):
+                    source.close()
+        try:
+            image = draft_image(get_opener(decoder)(source), box_ratio,
+                                max_dimen)
+            if split_member_path(path) is not None:
+                image.load()
+        except BaseException:
+            source.close()
+            raise
+        if split_member_path(path) is not None:
+            source.close()
+        # A mapped file stays mapped until the image is garbage collected,
+        # since Pillow decodes it lazily
+        return image
+
+    name = getattr(path, "name", None)
+    _, ext = os.path.splitext(name if isinstance(name, str) else "")
+    decoder = get_decoder(path, ext.lower())
+    if decoder is None:
+        try:
+            image = Image.open(path)
+        except UnidentifiedImageError:
+            path.seek(0)
+            return open_raw_image(path, box_ratio, max_dimen)
+        return draft_image(image, box_ratio, max_dimen)
+    if decoder == RAW_DECODER:
+        return open_raw_image(path, box_ratio, max_dimen)
+    return draft_image(get_opener(decoder)(path), box_ratio, max_dimen)
+
+
+def open_source(path: str) -> Tuple[Union[str, BinaryIO], str]:
+    """Open an image file once and detect how to decode it
+
+    Files are mapped into memory with :py:meth:`batch_crop.formats.map_file`
+    and images in archives are opened as file objects. The decoder is chosen
+    from the contents by :py:meth:`batch_crop.formats.get_decoder`. A RAW
+    file's mapping is then closed and its path returned instead, since rawpy
+    copies a file object into memory whole but reads a path itself.
+
+    Args:
+        path: Path to the image, or a member path of an image in an archive
+
+    Returns:
+        The opened image, which the caller must close, or ``path`` for a RAW
+        file, and the name of its decoder
+
+    Raises:
+        batch_crop.formats.UnknownFormatError: If the image is empty or its
+            contents do not match its RAW extension
+
+    """
+    in_archive = split_member_path(path) is not None
+    source = open_member(path) if in_archive else map_file(path)
     _, ext = os.path.splitext(path)
-    ext = ext.lower()
-    if ext in (".arw", ".raw"):
-        image = open_raw_image(path)
-    else:
-        image = Image.open(path)
+    try:
+        decoder = get_decoder(source, ext.lower())  # type: ignore
+    except BaseException:
+        source.close()
+        raise
+    if decoder == RAW_DECODER and not in_archive:
+        source.close()
+        return path, decoder
+    return source, decoder  # type: ignore
+
+
+def draft_image(image: Image,
+                box_ratio: Optional[Tuple[float, float, float, float]],
+                max_dimen: Optional[int]) -> Image:
+    """Configure a lazily-opened image to decode at a reduced resolution
+
+    See :py:meth:`open_image` for the meaning of the arguments. Formats other
+    than JPEG ignore the request and decode at full resolution.
+
+    Args:
+        image: Image opened by ``Image.open`` and not yet loaded
+        box_ratio: The region that will be cropped from the image
+        max_dimen: The largest dimension the cropped region will be shrunk to
+
+    Returns:
+        ``image``
 
+    """
+    if box_ratio is None or max_dimen is None:
+        return image
+    box_ratio = orient_box_ratio(box_ratio, get_orientation(image))
+    scale = get_decode_scale(image.size, box_ratio, max_dimen)
+    if scale < 1:
+        width, height = image.size
+        image.draft(image.mode, (math.ceil(width * scale),
+                                 math.ceil(height * scale)))
     return image
 
 
-def open_raw_image(path: str) -> Image:
+def get_decode_scale(size: Tuple[int, int],
+                     box_ratio: Tuple[float, float, float, float],
+                     max_dimen: int) -> float:
+    """Get the smallest scale at which an image may be decoded
+
+    At this scale, the region ``box_ratio`` still has a largest dimension of
+    ``max_dimen``.
+
+    >>> get_decode_scale((4000, 3000), (0, 0, 0.5, 0.5), 500)
+    0.25
+
+    Args:
+        size: Size of the image
+        box_ratio: The region that will be cropped from the image
+        max_dimen: The largest dimension the cropped region will be shrunk to
+
+    Returns:
+        The scale, no more than ``1``
+
+    """
+    x1, y1, x2, y2 = box_ratio
+    width, height = size
+    largest = max(abs(x2 - x1) * width, abs(y2 - y1) * height)
+    if largest <= max_dimen:
+        return 1.0
+    return max_dimen / largest
+
+
+def open_raw_image(path: Union[str, BinaryIO],
+                   box_ratio: Optional[Tuple[float, float, float, float]] =
+                   None,
+                   max_dimen: Optional[int] = None) -> Image:
     """Open RAW-formatted image using ``rawpy``
 
-    No format checking or error handling is performed.
+    No format checking or error handling is performed. If ``box_ratio`` and
+    ``max_dimen`` allow it (see :py:meth:`open_image`), the image is decoded
+    at half size.
 
     Args:
-        path: Path to the image. Must be correct.
+        path: Path to the image, or a binary file object holding it. Must be
+            correct.
+        box_ratio: The region that will be cropped from the image
+        max_dimen: The largest dimension the cropped region will be shrunk to
 
     Returns:
         A Pillow Image object representing the image at ``path``
 
     """
     with rawpy.imread(path) as raw:
-        mat = raw.postprocess()
+        half_size = False
+        if box_ratio is not None and max_dimen is not None:
+            half_size = get_decode_scale(get_raw_size(raw), box_ratio,
+                                         max_dimen) <= 0.5
+        mat = raw.postprocess(half_size=half_size)
     return Image.fromarray(mat)
 
 
+def get_raw_size(raw: rawpy.RawPy) -> Tuple[int, int]:
+    """Get the size of the image that ``raw.postprocess()`` will produce
+
+    Only the RAW metadata is read, not the sensor data.
+
+    Args:
+        raw: The opened RAW image
+
+    Returns:
+        The size of the processed image at full resolution
+
+    """
+    sizes = raw.sizes
+    # postprocess() applies the flip, swapping dimensions for 90 degrees
+    if sizes.flip in (5, 6):
+        return sizes.height, sizes.width
+    return sizes.width, sizes.height
+
+
+def encode_image(image: Image, image_format: str = "jpeg",
+                 quality: int = DEFAULT_QUALITY, **params) -> bytes:
+    """Encode an image into the bytes of an image file
+
+    Args:
+        image: The image to encode
+        image_format: Pillow format name to encode as
+        quality: Encoder quality, for formats that support one
+        params: Additional options for ``Image.save``, such as those from
+            :py:meth:`get_save_exif`
+
+    Returns:
+        The encoded image
+
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, quality=quality, **params)
+    return buffer.getvalue()
+
+
+def read_image_header(path: Union[str, BinaryIO]) -> ImageHeader:
+    """Read an image's format, size, and orientation without decoding it
+
+    Pillow only parses the header when an image is opened, and rawpy reads
+    the size from the RAW metadata without unpacking the sensor data. Like
+    :py:meth:`open_image`, the format is detected from the contents, so an
+    image that cannot be decoded fails here rather than when it is cropped.
+
+    Args:
+        path: Path to the image, a member path of an image in an archive, or
+            a binary file object with a ``name``
+
+    Returns:
+        The image's header
+
+    """
+    if isinstance(path, str):
+        source, decoder = open_source(path)
+        if isinstance(source, str):
+            return read_source_header(source, decoder)
+        with source:
+            return read_source_header(source, decoder)
+    _, ext = os.path.splitext(getattr(path, "name", ""))
+    return read_source_header(path, get_decoder(path, ext.lower()))
+
+
+def read_source_header(source: Union[str, BinaryIO],
+                       decoder: Optional[str]) -> ImageHeader:
+    """Read the header of an image from :py:meth:`open_source`
+
+    Args:
+        source: Path to the image, or the image, positioned at its start
+        decoder: Name of the library that decodes the image, from
+            :py:meth:`batch_crop.formats.get_decoder`
+
+    Returns:
+        The image's header
+
+    """
+    if decoder == RAW_DECODER:
+        with rawpy.imread(source) as raw:
+            return ImageHeader("RAW", get_raw_size(raw), 1)
+    with get_opener(decoder)(source) as image:  # type: ignore
+        return ImageHeader(image.format, image.size, get_orientation(image))
+
+
+def is_crop_output(name: str) -> bool:
+    """Check whether a file name is that of a crop or one of its renditions
+
+    >>> is_crop_output("img1.ARW_cropped.jpg")
+    True
+    >>> is_crop_output("img1.ARW_cropped_web.webp")
+    True
+    >>> is_crop_output("img1.ARW")
+    False
+
+    Args:
+        name: Name or path of the file
+
+    Returns:
+        ``True`` if the file was saved by a crop
+
+    """
+    lower = os.path.basename(name).lower()
+    return "_cropped." in lower or "_cropped_" in lower
+
+
+def list_matching_files(dir_path: str, extension: str) -> List[str]:
+    """List the files in a directory that have an extension
+
+    Outputs of previous crops and their renditions are excluded, even if they
+    share ``extension``.
+
+    Args:
+        dir_path: Directory to search. Subdirectories are not searched.
+        extension: Lower-case extension, including the leading ``.``
+
+    Returns:
+        Paths of the matching files
+
+    """
+    items = os.listdir(dir_path)
+    files = [item for item in items if isfile(join(dir_path, item))]
+    crop_names = [file for file in files if file.lower().endswith(extension)
+                  and not is_crop_output(file)]
+    return [join(dir_path, name) for name in crop_names]
+
+
+def run_gui(catalog_path: Optional[str] = None) -> None:
+    """Launch the :py:class:`BatchCropper` GUI and block until it exits
+
+    Args:
+        catalog_path: If given, directories are listed through the
+            :py:class:`batch_crop.catalog.Catalog` stored here
+
+    Returns:
+        None
+
+    """
+    catalog = None
+    if catalog_path is not None:
+        from batch_crop.catalog import Catalog
+        catalog = Catalog(catalog_path)
+    master = tk.Tk()
+    app = BatchCropper(master, catalog)
+    app.master.title("batch_crop")  # type: ignore
+    try:
+        master.mainloop()
+    finally:
+        if catalog is not None:
+            catalog.close()
+
+
 if __name__ == "__main__":
-    MASTER = tk.Tk()
-    APP = BatchCropper(MASTER)
-    APP.master.title("batch_crop")  # type: ignore
-    MASTER.mainloop()
+    run_gui()
@@ -0,0 +1,199 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Compare how fast each backend crops sample images
+
+Each available backend from :py:mod:`batch_crop.backends` crops the same
+sample images, and the throughput is reported separately for each image
+format, since the fastest backend for JPEGs may not be fastest for RAW
+images. Outputs are encoded but not written, so disk speed does not skew the
+comparison. The results can be saved as JSON to guide the choice of
+``--backend`` on each machine.
+
+"""
+
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import rawpy
+
+from batch_crop.backends import available_backends, render, BACKENDS, \
+    DEFAULT_BACKEND
+from batch_crop.batch_crop import read_image_header
+from batch_crop.quad import Quad, Region
+
+
+class BenchmarkResult(NamedTuple):
+    """Time one backend took to crop the sample images of one format
+
+    Attributes:
+        backend: Name of the backend
+        format: Lower-case extension of the images
+        files: Number of images cropped
+        seconds: Time taken to crop them all, taking the fastest of the
+            repetitions for each image
+        megapixels: Total size of the images, in millions of pixels
+
+    """
+    backend: str
+    format: str
+    files: int
+    seconds: float
+    megapixels: float
+
+    @property
+    def throughput(self) -> float:
+        """Megapixels of input cropped per second"""
+        return self.megapixels / self.seconds if self.seconds else 0.0
+
+
+def time_render(backend: str, box_ratio: Region,
+                path: str, max_dimen: Optional[int], repeat: int) -> float:
+    """Time how long a backend takes to crop an image
+
+    Args:
+        backend: Name of the backend
+        box_ratio: Region to crop. See :doc:`units`
+        path: Path or member path of the image
+        max_dimen: If given, the crop is shrunk to fit this
+        repeat: Number of times to crop the image
+
+    Returns:
+        The fastest time, in seconds
+
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        render(box_ratio, path, path + "_cropped.jpg", max_dimen=max_dimen,
+               backend=backend)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def benchmark_backends(paths: Sequence[str],
+                       box_ratio: Region,
+                       backends: Optional[Sequence[str]] = None,
+                       repeat: int = 3, max_dimen: Optional[int] = None) \
+        -> List[BenchmarkResult]:
+    """Crop sample images with each backend and time them
+
+    Images a backend does not support are skipped for that backend. Images
+    whose headers cannot be read are skipped entirely, and each is reported on
+    standard error. Only Pillow can crop a :py:class:`batch_crop.quad.Quad`,
+    so it is the only backend timed for one.
+
+    Args:
+        paths: Paths or member paths of the sample images
+        box_ratio: Region to crop. See :doc:`units`
+        backends: Names of the backends to compare. Defaults to all available
+            backends. Ignored for a quad.
+        repeat: Number of times to crop each image with each backend
+        max_dimen: If given, crops are shrunk to fit this
+
+    Returns:
+        A result for each backend and format, ordered by format and then by
+        decreasing throughput
+
+    """
+    if isinstance(box_ratio, Quad):
+        backends = [DEFAULT_BACKEND]
+    elif backends is None:
+        backends = available_backends()
+    by_format = defaultdict(list)  # type: Dict[str, List[Tuple[str, float]]]
+    for path in paths:
+        try:
+            width, height = read_image_header(path).size
+        except (OSError, rawpy.LibRawError) as error:
+            print("Skipping '{}': {}".format(path, error), file=sys.stderr)
+            continue
+        _, ext = os.path.splitext(path)
+        by_format[ext.lower()].append((path, width * height / 1e6))
+
+    results = []
+    for image_format, images in sorted(by_format.items()):
+        group = []
+        for backend in backends:
+            supported = [(path, megapixels) for path, megapixels in images
+                         if BACKENDS[backend].supports(path)]
+            if not supported:
+                continue
+            seconds = sum(time_render(backend, box_ratio, path, max_dimen,
+                                      repeat)
+                          for path, _ in supported)
+            group.append(BenchmarkResult(
+                backend, image_format, len(supported), seconds,
+                sum(megapixels for _, megapixels in supported)))
+        group.sort(key=lambda result: result.throughput, reverse=True)
+        results.extend(group)
+    return results
+
+
+def format_results(results: Sequence[BenchmarkResult]) -> str:
+    """Lay out benchmark results as a table
+
+    Args:
+        results: The results
+
+    Returns:
+        The table, one line per result after a header line
+
+    """
+    lines = ["{:<8} {:<12} {:>6} {:>9} {:>8}".format(
+        "Format", "Backend", "Files", "Seconds", "MP/s")]
+    for result in results:
+        lines.append("{:<8} {:<12} {:>6} {:>9.3f} {:>8.1f}".format(
+            result.format, result.backend, result.files, result.seconds,
+            result.throughput))
+    return "\n".join(lines)
+
+
+def save_results(results: Sequence[BenchmarkResult], path: str) -> None:
+    """Save benchmark results as a JSON list of objects
+
+    Args:
+        results: The results
+        path: Path of the JSON file to write
+
+    Returns:
+        None
+
+    """
+    with open(path, "w") as f:
+        json.dump([dict(result._asdict(), throughput=result.throughput)
+                   for result in results], f, indent=2)
+
+
+def load_results(path: str) -> List[BenchmarkResult]:
+    """Load benchmark results saved by :py:meth:`save_results`
+
+    Args:
+        path: Path of the JSON file
+
+    Returns:
+        The results
+
+    """
+    with open(path) as f:
+        return [BenchmarkResult(*(entry[field] for field in
+                                  BenchmarkResult._fields))
+                for entry in json.load(f)]
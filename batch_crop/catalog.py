@@ -0,0 +1,234 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Remember directory listings and image headers between sessions
+
+A :py:class:`Catalog` is a SQLite database recording each file's path, size,
+modification time, and, once read, its format, dimensions, and orientation.
+Refreshing a directory only compares each file's size and modification time
+with the catalog, so headers are re-read only for new or changed files. On
+slow network shares, this makes re-opening a large directory much faster than
+reading every header again.
+
+"""
+
+import os
+import sqlite3
+import threading
+from typing import List, Optional, Set
+
+from batch_crop.archive import split_member_path
+from batch_crop.batch_crop import is_crop_output, read_image_header, \
+    ImageHeader
+
+
+# Statements that create the catalog's tables if they do not exist yet
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS images ("
+    "path TEXT PRIMARY KEY, dir TEXT NOT NULL, size INTEGER NOT NULL, "
+    "mtime_ns INTEGER NOT NULL, format TEXT, width INTEGER, height INTEGER, "
+    "orientation INTEGER)",
+    "CREATE INDEX IF NOT EXISTS images_dir ON images (dir)",
+)
+
+# Number of headers read before they are committed to the database
+COMMIT_INTERVAL = 64
+
+
+class Catalog:
+    """SQLite catalog of files and their image headers
+
+    A catalog may be shared between threads.
+
+    Attributes:
+        path (str): Path of the database file
+
+    """
+
+    def __init__(self, path: str) -> None:
+        """Open a catalog, creating it if it does not exist
+
+        Args:
+            path: Path of the database file
+
+        """
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        # Files whose rows were checked against the disk in this session
+        self._fresh = set()  # type: Set[str]
+        # Headers read but not yet committed
+        self._uncommitted = 0
+        with self._lock, self._connection:
+            for statement in SCHEMA:
+                self._connection.execute(statement)
+
+    def refresh(self, dir_path: str) -> List[str]:
+        """Bring the catalog up to date with a directory's files
+
+        New and changed files are recorded without their headers, which are
+        read when next requested. Files no longer present are forgotten.
+
+        Args:
+            dir_path: Directory to scan. Subdirectories are not scanned.
+
+        Returns:
+            Names of the files in the directory
+
+        """
+        directory = os.path.abspath(dir_path)
+        found = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    found[entry.name] = stat.st_size, stat.st_mtime_ns
+
+        with self._lock, self._connection:
+            known = {os.path.basename(path): (size, mtime_ns)
+                     for path, size, mtime_ns in self._connection.execute(
+                         "SELECT path, size, mtime_ns FROM images "
+                         "WHERE dir = ?", (directory,))}
+            self._connection.executemany(
+                "DELETE FROM images WHERE path = ?",
+                [(os.path.join(directory, name),)
+                 for name in known.keys() - found.keys()])
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO images (path, dir, size, mtime_ns) "
+                "VALUES (?, ?, ?, ?)",
+                [(os.path.join(directory, name), directory) + stat
+                 for name, stat in found.items() if known.get(name) != stat])
+            self._fresh.update(os.path.join(directory, name)
+                               for name in found)
+            self._uncommitted = 0
+        return sorted(found)
+
+    def list_files(self, dir_path: str, extension: str) -> List[str]:
+        """List the files in a directory that have an extension
+
+        This is :py:meth:`batch_crop.batch_crop.list_matching_files`, but
+        refreshes the catalog along the way.
+
+        Args:
+            dir_path: Directory to search. Subdirectories are not searched.
+            extension: Lower-case extension, including the leading ``.``
+
+        Returns:
+            Paths of the matching files
+
+        """
+        return [os.path.join(dir_path, name) for name in self.refresh(dir_path)
+                if name.lower().endswith(extension)
+                and not is_crop_output(name)]
+
+    def read_image_header(self, path: str) -> ImageHeader:
+        """Get an image's header, reading it only if not already cataloged
+
+        Files not refreshed in this session are checked against the disk with
+        one ``stat`` call first. Images inside archives are not cataloged.
+        Newly read headers are committed in batches of
+        :py:data:`COMMIT_INTERVAL`, so few are lost if the program is killed.
+
+        Args:
+            path: Path to the image, or a member path of an image in an
+                archive
+
+        Returns:
+            The image's header
+
+        """
+        if split_member_path(path) is not None:
+            return read_image_header(path)
+        path = os.path.abspath(path)
+        with self._lock:
+            if path not in self._fresh:
+                stat = os.stat(path)
+                row = self._connection.execute(
+                    "SELECT size, mtime_ns FROM images WHERE path = ?",
+                    (path,)).fetchone()
+                if row != (stat.st_size, stat.st_mtime_ns):
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO images "
+                        "(path, dir, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                        (path, os.path.dirname(path), stat.st_size,
+                         stat.st_mtime_ns))
+                self._fresh.add(path)
+            row = self._connection.execute(
+                "SELECT format, width, height, orientation FROM images "
+                "WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] is not None:
+            image_format, width, height, orientation = row
+            return ImageHeader(image_format, (width, height), orientation)
+
+        header = read_image_header(path)
+        with self._lock:
+            self._connection.execute(
+                "UPDATE images SET format = ?, width = ?, height = ?, "
+                "orientation = ? WHERE path = ?",
+                (header.format,) + tuple(header.size) + (header.orientation,
+                                                        path))
+            self._uncommitted += 1
+            if self._uncommitted >= COMMIT_INTERVAL:
+                self._connection.commit()
+                self._uncommitted = 0
+        return header
+
+    def lookup(self, path: str) -> Optional[ImageHeader]:
+        """Get an image's cataloged header without touching the disk
+
+        Args:
+            path: Path to the image
+
+        Returns:
+            The header, or ``None`` if it has not been cataloged
+
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT format, width, height, orientation FROM images "
+                "WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return ImageHeader(row[0], (row[1], row[2]), row[3])
+
+    def commit(self) -> None:
+        """Save headers read since the last commit
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            self._connection.commit()
+            self._uncommitted = 0
+
+    def close(self) -> None:
+        """Save headers read since the last commit and close the catalog
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+
+    def __enter__(self) -> "Catalog":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
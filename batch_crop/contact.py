@@ -0,0 +1,256 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tile crops into labelled contact sheets for checking a batch at a glance
+
+A :py:class:`ContactSheet` receives each crop as it is produced, shrinks it
+to a thumbnail on a background thread, and saves a page of thumbnails
+whenever one fills up. Crops still in memory are used directly, while crops
+already on disk are re-read at reduced resolution, so building the sheets
+adds little to the batch. Thumbnails appear in the order the crops finish,
+each labelled with the name of its image.
+
+"""
+
+import io
+import os
+import queue
+import threading
+from typing import List, Optional, Tuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+from batch_crop.batch_crop import encode_image
+from batch_crop.writer import write_atomic
+
+
+# Color of the space between thumbnails
+BACKGROUND = (32, 32, 32)
+
+# Color of the labels under each thumbnail
+LABEL_COLOR = (230, 230, 230)
+
+# Pixels between neighboring cells
+GAP = 4
+
+
+class ContactSheet:
+    """Build paginated contact sheets of crops in the background
+
+    Pages are saved as ``{base_path}-001.jpg``, ``{base_path}-002.jpg``, and
+    so on.
+
+    Attributes:
+        base_path (str): Path of the pages, without the page number and
+            extension
+        columns (int): Thumbnails per row
+        rows (int): Rows per page
+        cell (int): Largest width or height of each thumbnail
+        pages (List[str]): Paths of the pages saved so far
+
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, base_path: str, columns: int = 8, rows: int = 6,
+                 cell: int = 192, queue_size: int = 64) -> None:
+        """Start the thread that builds the sheets
+
+        Args:
+            base_path: Path of the pages, without the page number and
+                extension
+            columns: Thumbnails per row
+            rows: Rows per page
+            cell: Largest width or height of each thumbnail
+            queue_size: Number of crops that may wait to be shrunk
+
+        """
+        self.base_path = base_path
+        self.columns = columns
+        self.rows = rows
+        self.cell = cell
+        self.pages = []  # type: List[str]
+        self._font = ImageFont.load_default()
+        self._label_height = self._font.getbbox("Ag")[3] + 4
+        self._thumbnails = []  # type: List[Tuple[str, Image.Image]]
+        self._queue = queue.Queue(maxsize=queue_size)  # type: queue.Queue
+        self._error = None  # type: Optional[BaseException]
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, data: bytes, label: str) -> None:
+        """Add an encoded crop to the sheets
+
+        Args:
+            data: The encoded crop
+            label: Text shown under the thumbnail
+
+        Returns:
+            None
+
+        """
+        self._queue.put((data, label))
+
+    def add_file(self, path: str, label: Optional[str] = None) -> None:
+        """Add a crop saved on disk to the sheets
+
+        Args:
+            path: Path of the crop
+            label: Text shown under the thumbnail. Defaults to the file name
+                of ``path``.
+
+        Returns:
+            None
+
+        """
+        self._queue.put((path, label or os.path.basename(path)))
+
+    def close(self) -> List[str]:
+        """Save the last, partial page and stop the background thread
+
+        Returns:
+            Paths of all the pages saved
+
+        Raises:
+            Exception: The error that stopped a page from being saved, if any
+
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self.pages
+
+    def __enter__(self) -> "ContactSheet":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _run(self) -> None:
+        """Shrink queued crops and save pages until :py:meth:`close`
+
+        Crops that cannot be read, for whatever reason, are shown as blank
+        cells, so the sheets still account for every image. The queue keeps
+        being drained even after a page fails to save, so that
+        :py:meth:`add` never blocks on a dead thread.
+
+        Returns:
+            None
+
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            source, label = item
+            if isinstance(source, bytes):
+                source = io.BytesIO(source)
+            try:
+                thumbnail = self.make_thumbnail(source)
+            except Exception:  # pylint: disable=broad-except
+                thumbnail = Image.new("RGB", (self.cell, self.cell))
+            self._thumbnails.append((label, thumbnail))
+            if len(self._thumbnails) == self.columns * self.rows:
+                self._save_page()
+        if self._thumbnails:
+            self._save_page()
+
+    def make_thumbnail(self, source) -> Image.Image:
+        """Decode a crop at reduced resolution and shrink it to fit a cell
+
+        Args:
+            source: Path or binary file object of the encoded crop
+
+        Returns:
+            The thumbnail
+
+        """
+        with Image.open(source) as image:
+            image.draft("RGB", (self.cell, self.cell))
+            image = image.convert("RGB")
+        image.thumbnail((self.cell, self.cell))
+        return image
+
+    def render_page(self, thumbnails: List[Tuple[str, Image.Image]]) \
+            -> Image.Image:
+        """Tile thumbnails into a page, labelling each one
+
+        Args:
+            thumbnails: Pairs of label and thumbnail, in reading order
+
+        Returns:
+            The page
+
+        """
+        cell_width = self.cell + GAP
+        cell_height = self.cell + self._label_height + GAP
+        rows = -(-len(thumbnails) // self.columns)
+        page = Image.new("RGB", (self.columns * cell_width + GAP,
+                                 rows * cell_height + GAP), BACKGROUND)
+        draw = ImageDraw.Draw(page)
+        for index, (label, thumbnail) in enumerate(thumbnails):
+            row, column = divmod(index, self.columns)
+            left, top = GAP + column * cell_width, GAP + row * cell_height
+            width, height = thumbnail.size
+            page.paste(thumbnail, (left + (self.cell - width) // 2,
+                                   top + (self.cell - height) // 2))
+            label = fit_label(draw, label, self._font, self.cell - 4)
+            draw.text((left + 2, top + self.cell + 1), label,
+                      fill=LABEL_COLOR, font=self._font)
+        return page
+
+    def _save_page(self) -> None:
+        """Save the thumbnails gathered so far as the next page
+
+        Returns:
+            None
+
+        """
+        thumbnails, self._thumbnails = self._thumbnails, []
+        if self._error is not None:
+            return
+        path = "{}-{:03d}.jpg".format(self.base_path, len(self.pages) + 1)
+        try:
+            write_atomic(encode_image(self.render_page(thumbnails), "jpeg",
+                                      85), path)
+        except Exception as error:  # pylint: disable=broad-except
+            self._error = error
+            return
+        self.pages.append(path)
+
+
+def fit_label(draw: ImageDraw.ImageDraw, label: str,
+              font: ImageFont.ImageFont, width: int) -> str:
+    """Shorten a label from the left until it fits a width
+
+    The end of a file name usually tells images apart, so it is kept.
+
+    Args:
+        draw: Where the label will be drawn
+        label: The label
+        font: Font the label will be drawn in
+        width: Width available, in pixels
+
+    Returns:
+        The label, prefixed with ``...`` if shortened
+
+    """
+    if draw.textlength(label, font=font) <= width:
+        return label
+    while label and draw.textlength("..." + label, font=font) > width:
+        label = label[1:]
+    return "..." + label
@@ -0,0 +1,448 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Preview the selected region on every image to be cropped
+
+A :py:class:`Filmstrip` window shows all the matching images side by side
+with the selection drawn on each, so outliers stand out before the batch is
+run. Only the cells in view exist: thumbnails are decoded by a
+:py:class:`ThumbnailLoader` in background threads as cells scroll into view,
+and decodes for cells that scroll out of view before they start are
+cancelled. Thousands of images therefore cost no more than the few on
+screen.
+
+"""
+
+import os
+import queue
+import tkinter as tk
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from PIL import Image, ImageTk
+
+from batch_crop.batch_crop import coor_to_box, crop_image, downscale_image, \
+    open_image, ratios_to_coors
+from batch_crop.quad import Quad, Region
+
+
+# Milliseconds between checks for newly decoded thumbnails
+POLL_INTERVAL_MS = 50
+
+# Pixels of space around each thumbnail, with room for its label below
+CELL_PADDING = 8
+LABEL_HEIGHT = 16
+
+
+def make_thumbnail(path: str, size: int) -> Image.Image:
+    """Decode a small, upright copy of an image
+
+    JPEGs and RAW images are decoded at reduced resolution where possible,
+    as described in :py:meth:`batch_crop.batch_crop.open_image`.
+
+    Args:
+        path: Path or member path of the image
+        size: Largest width or height of the thumbnail
+
+    Returns:
+        The thumbnail
+
+    """
+    whole = 0.0, 0.0, 1.0, 1.0
+    image = open_image(path, whole, size)
+    thumbnail = downscale_image(crop_image(whole, image), size)
+    thumbnail.load()
+    return thumbnail
+
+
+def get_visible_cells(left: float, width: float, cell: int, count: int) \
+        -> range:
+    """Get the indices of the cells that are at least partly in view
+
+    >>> get_visible_cells(250, 400, 100, 1000)
+    range(2, 7)
+    >>> get_visible_cells(0, 400, 100, 3)
+    range(0, 3)
+
+    Args:
+        left: Position of the left edge of the view along the strip
+        width: Width of the view
+        cell: Width of each cell
+        count: Number of cells
+
+    Returns:
+        The indices, in order
+
+    """
+    first = max(0, int(left // cell))
+    last = min(count, int(-(-(left + width) // cell)))
+    return range(first, max(first, last))
+
+
+class ThumbnailLoader:
+    """Decode thumbnails in background threads, most recent requests only
+
+    Finished thumbnails are kept in a bounded cache. This class does not use
+    Tkinter, so results are handed over through :py:meth:`poll`, which the
+    GUI thread calls.
+
+    Attributes:
+        size (int): Largest width or height of each thumbnail
+
+    """
+
+    def __init__(self, size: int, max_workers: int = 4,
+                 cache_size: int = 512) -> None:
+        """Create a loader with nothing requested
+
+        Args:
+            size: Largest width or height of each thumbnail
+            max_workers: Number of thumbnails to decode at once
+            cache_size: Number of thumbnails to keep
+
+        """
+        self.size = size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._cache_size = cache_size
+        self._cache = OrderedDict()  # type: OrderedDict
+        # Images that could not be decoded
+        self._failed = set()  # type: Set[str]
+        self._pending = {}  # type: Dict[str, Future]
+        self._done = queue.Queue()  # type: queue.Queue
+
+    def request(self, paths: Sequence[str]) -> None:
+        """Decode the thumbnails of ``paths``, and only those
+
+        Requested decodes that have not started and are not in ``paths`` are
+        cancelled.
+
+        Args:
+            paths: Images whose thumbnails are wanted now
+
+        Returns:
+            None
+
+        """
+        wanted = set(paths)
+        for path, future in list(self._pending.items()):
+            if path not in wanted and future.cancel():
+                del self._pending[path]
+        for path in paths:
+            if path in self._cache or path in self._failed or \
+                    path in self._pending:
+                continue
+            future = self._executor.submit(make_thumbnail, path, self.size)
+            self._pending[path] = future
+            future.add_done_callback(
+                lambda done, path=path: self._done.put((path, done)))
+
+    def poll(self) -> List[str]:
+        """Collect the thumbnails finished since the last call
+
+        Must be called from the same thread as :py:meth:`request`.
+
+        Returns:
+            Paths of the images whose thumbnails, or failures, are new
+
+        """
+        finished = []
+        while True:
+            try:
+                path, future = self._done.get_nowait()
+            except queue.Empty:
+                return finished
+            if self._pending.get(path) is not future or future.cancelled():
+                continue
+            del self._pending[path]
+            if future.exception() is not None:
+                self._failed.add(path)
+            else:
+                self._cache[path] = future.result()
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+            finished.append(path)
+
+    def get(self, path: str) -> Optional[Image.Image]:
+        """Get a decoded thumbnail
+
+        Args:
+            path: Path of the image
+
+        Returns:
+            The thumbnail, or ``None`` if it is not decoded yet
+
+        """
+        thumbnail = self._cache.get(path)
+        if thumbnail is not None:
+            self._cache.move_to_end(path)
+        return thumbnail
+
+    def is_failed(self, path: str) -> bool:
+        """Check whether an image could not be decoded
+
+        Args:
+            path: Path of the image
+
+        Returns:
+            ``True`` if decoding the thumbnail raised an error
+
+        """
+        return path in self._failed
+
+    def close(self) -> None:
+        """Cancel all decodes not yet started
+
+        Returns:
+            None
+
+        """
+        for future in list(self._pending.values()):
+            future.cancel()
+        self._executor.shutdown(wait=False)
+
+
+class Filmstrip(tk.Toplevel):
+    """Scrollable window of thumbnails with the selected region drawn on each
+
+    Attributes:
+        paths (List[str]): Images shown, in order
+        region (Optional[Region]): Region drawn on each thumbnail
+        cell (int): Width of each cell, in pixels
+        loader (ThumbnailLoader): Decodes the thumbnails
+        canvas (tk.Canvas): Where the cells are drawn
+        scrollbar (tk.Scrollbar): Scrolls :py:attr:`canvas` along the strip
+
+    """
+
+    def __init__(self, master: tk.Misc, paths: Sequence[str],
+                 region: Optional[Region] = None, size: int = 160) -> None:
+        """Open the window
+
+        Args:
+            master: Window the filmstrip belongs to
+            paths: Images to show, in order
+            region: Region to draw on each thumbnail, if any
+            size: Largest width or height of each thumbnail
+
+        """
+        tk.Toplevel.__init__(self, master)
+        self.title("Preview: {} images".format(len(paths)))
+        self.paths = list(paths)
+        self.region = region
+        self.cell = size + 2 * CELL_PADDING
+        self.loader = ThumbnailLoader(size)
+        # Canvas items and Tkinter images of the cells drawn, by index
+        self._items = {}  # type: Dict[int, List[int]]
+        self._images = {}  # type: Dict[int, ImageTk.PhotoImage]
+        self._poll_job = None  # type: Optional[str]
+
+        height = self.cell + LABEL_HEIGHT
+        self.canvas = tk.Canvas(self, width=min(5, len(paths) or 1) *
+                                self.cell, height=height,
+                                scrollregion=(0, 0, len(paths) * self.cell,
+                                              height))
+        self.scrollbar = tk.Scrollbar(self, orient="horizontal",
+                                      command=self.callback_scroll)
+        self.canvas.configure(xscrollcommand=self.scrollbar.set)
+        self.canvas.pack(fill="both", expand=True)
+        self.scrollbar.pack(fill="x")
+
+        self.canvas.bind("<Configure>", lambda _: self.refresh())
+        self.canvas.bind("<MouseWheel>", self.callback_wheel)
+        self.canvas.bind("<Button-4>", self.callback_wheel)
+        self.canvas.bind("<Button-5>", self.callback_wheel)
+        self.protocol("WM_DELETE_WINDOW", self.destroy)
+        self._poll_job = self.after(POLL_INTERVAL_MS, self.poll)
+
+    def callback_scroll(self, *args) -> None:
+        """Scroll the strip from the scrollbar and draw the cells in view
+
+        Args:
+            args: Arguments from the scrollbar, passed to ``xview``
+
+        Returns:
+            None
+
+        """
+        self.canvas.xview(*args)
+        self.refresh()
+
+    def callback_wheel(self, event) -> None:
+        """Scroll the strip with the mouse wheel
+
+        Args:
+            event: The event from Tkinter, with a ``delta`` on Windows and
+                macOS, or a ``num`` of ``4`` or ``5`` on X11
+
+        Returns:
+            None
+
+        """
+        step = -1 if event.num == 4 or event.delta > 0 else 1
+        self.callback_scroll("scroll", step, "units")
+
+    def refresh(self) -> None:
+        """Draw the cells in view, forget the rest, and request thumbnails
+
+        Returns:
+            None
+
+        """
+        visible = get_visible_cells(self.canvas.canvasx(0),
+                                    self.canvas.winfo_width(), self.cell,
+                                    len(self.paths))
+        for index in list(self._items):
+            if index not in visible:
+                self.clear_cell(index)
+        self.loader.request([self.paths[index] for index in visible])
+        for index in visible:
+            if index not in self._items:
+                self.draw_cell(index)
+
+    def clear_cell(self, index: int) -> None:
+        """Remove a cell from the canvas
+
+        Args:
+            index: Index of the cell
+
+        Returns:
+            None
+
+        """
+        for item in self._items.pop(index, []):
+            self.canvas.delete(item)
+        self._images.pop(index, None)
+
+    def draw_cell(self, index: int) -> None:
+        """Draw a cell's thumbnail and region, or a placeholder
+
+        Args:
+            index: Index of the cell
+
+        Returns:
+            None
+
+        """
+        self.clear_cell(index)
+        path = self.paths[index]
+        left = index * self.cell
+        center_x = left + self.cell / 2
+        items = [self.canvas.create_text(
+            center_x, self.cell + LABEL_HEIGHT / 2,
+            text=shorten(os.path.basename(path), self.cell // 7))]
+        thumbnail = self.loader.get(path)
+        if thumbnail is None:
+            text = "Unreadable" if self.loader.is_failed(path) \
+                else "Loading..."
+            items.append(self.canvas.create_text(center_x, self.cell / 2,
+                                                 text=text))
+        else:
+            width, height = thumbnail.size
+            x = left + (self.cell - width) / 2
+            y = (self.cell - height) / 2
+            self._images[index] = ImageTk.PhotoImage(thumbnail)
+            items.append(self.canvas.create_image(
+                x, y, anchor="nw", image=self._images[index]))
+            if self.region is not None:
+                items.append(self.draw_region((x, y), (width, height)))
+        self._items[index] = items
+
+    def draw_region(self, origin: Tuple[float, float],
+                    size: Tuple[int, int]) -> int:
+        """Outline :py:attr:`region` on a thumbnail
+
+        Args:
+            origin: Canvas coordinates of the thumbnail's top-left corner
+            size: Size of the thumbnail
+
+        Returns:
+            The canvas item of the outline
+
+        """
+        x, y = origin
+        if isinstance(self.region, Quad):
+            corners = self.region.to_coors(size)
+            points = [(x + corner_x, y + corner_y)
+                      for corner_x, corner_y in corners + corners[:1]]
+            return self.canvas.create_line(
+                *[value for point in points for value in point], fill="red")
+        left, upper, right, lower = coor_to_box(ratios_to_coors(size,
+                                                                self.region))
+        return self.canvas.create_rectangle(x + left, y + upper, x + right,
+                                            y + lower, outline="red")
+
+    def set_region(self, region: Optional[Region]) -> None:
+        """Change the region drawn, without decoding anything again
+
+        Args:
+            region: The new region, if any
+
+        Returns:
+            None
+
+        """
+        self.region = region
+        for index in list(self._items):
+            self.draw_cell(index)
+
+    def poll(self) -> None:
+        """Draw newly decoded thumbnails that are in view
+
+        Runs every :py:data:`POLL_INTERVAL_MS` until the window closes.
+
+        Returns:
+            None
+
+        """
+        finished = set(self.loader.poll())
+        for index in list(self._items):
+            if self.paths[index] in finished:
+                self.draw_cell(index)
+        self._poll_job = self.after(POLL_INTERVAL_MS, self.poll)
+
+    def destroy(self) -> None:
+        """Stop decoding and close the window
+
+        Returns:
+            None
+
+        """
+        if self._poll_job is not None:
+            self.after_cancel(self._poll_job)
+            self._poll_job = None
+        self.loader.close()
+        tk.Toplevel.destroy(self)
+
+
+def shorten(text: str, length: int) -> str:
+    """Trim text from the left to fit a number of characters
+
+    >>> shorten("a_very_long_name.JPG", 10)
+    '...ame.JPG'
+
+    Args:
+        text: The text
+        length: Most characters allowed
+
+    Returns:
+        ``text``, or its end after ``...`` if it is too long
+
+    """
+    if len(text) <= length:
+        return text
+    return "..." + text[len(text) - max(0, length - 3):]
@@ -0,0 +1,294 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Detect image formats from their contents
+
+Each supported format is described by a :py:class:`FormatHandler` in
+:py:data:`FORMAT_HANDLERS`, which records the magic bytes the format's files
+start with and which library decodes them. The format of a file is detected
+from its first :py:data:`SNIFF_BYTES` bytes, so a file with the wrong
+extension is still decoded correctly, and one that is not an image fails
+before any decoder runs. Where formats share magic bytes, as TIFF does with
+TIFF-based RAW formats like ARW, the file's extension breaks the tie.
+
+Files are mapped into memory with :py:meth:`map_file`, so the detection and
+Pillow read the same pages without reopening or re-reading the file. RAW
+files are the exception: rawpy would copy a mapped file into memory whole,
+so it is given the path to read instead. New formats, including ones decoded
+by other libraries, are added with :py:meth:`register_format`.
+
+"""
+
+import io
+import mmap
+from typing import BinaryIO, Callable, List, NamedTuple, Optional, Tuple
+
+from PIL import Image
+
+
+# File extensions of RAW images, which are opened with rawpy
+RAW_EXTENSIONS = (".arw", ".raw")
+
+# Names of the libraries that decode images
+PILLOW_DECODER = "pillow"
+RAW_DECODER = "rawpy"
+
+# Number of bytes at the start of a file that formats are detected from
+SNIFF_BYTES = 16
+
+
+class UnknownFormatError(OSError):
+    """Raised when a file's contents do not match its extension's format"""
+
+
+class FormatHandler(NamedTuple):
+    """How to recognize and decode one image format
+
+    Attributes:
+        name: Name of the format
+        decoder: Library that decodes it, :py:data:`PILLOW_DECODER`,
+            :py:data:`RAW_DECODER`, or the name of another library
+        signatures: Ways the format's files may start. Each is a tuple of
+            ``(offset, magic)`` pairs that must all match.
+        extensions: Lower-case extensions of the format, including the
+            leading ``.``
+        opener: Opens an image of the format from a binary file object as a
+            Pillow image, without decoding it yet. Needed for decoders other
+            than :py:data:`PILLOW_DECODER` and :py:data:`RAW_DECODER`.
+
+    """
+    name: str
+    decoder: str
+    signatures: Tuple[Tuple[Tuple[int, bytes], ...], ...]
+    extensions: Tuple[str, ...]
+    opener: Optional[Callable[[BinaryIO], Image.Image]] = None
+
+    def matches(self, head: bytes) -> bool:
+        """Check whether a file's first bytes are of this format
+
+        Args:
+            head: The first :py:data:`SNIFF_BYTES` bytes of the file
+
+        Returns:
+            ``True`` if any signature matches
+
+        """
+        return any(all(head[offset:offset + len(magic)] == magic
+                       for offset, magic in signature)
+                   for signature in self.signatures)
+
+
+# Magic bytes at the start of TIFF files, in little- and big-endian order
+TIFF_SIGNATURES = (((0, b"II*\x00"),), ((0, b"MM\x00*"),))
+
+# Handlers of the supported formats, in the order they are tried
+FORMAT_HANDLERS = [
+    FormatHandler("JPEG", PILLOW_DECODER, (((0, b"\xff\xd8\xff"),),),
+                  (".jpg", ".jpeg", ".jpe")),
+    FormatHandler("PNG", PILLOW_DECODER, (((0, b"\x89PNG\r\n\x1a\n"),),),
+                  (".png",)),
+    FormatHandler("GIF", PILLOW_DECODER, (((0, b"GIF87a"),),
+                                          ((0, b"GIF89a"),)), (".gif",)),
+    FormatHandler("TIFF", PILLOW_DECODER, TIFF_SIGNATURES, (".tif", ".tiff")),
+    FormatHandler("BMP", PILLOW_DECODER, (((0, b"BM"),),), (".bmp",)),
+    FormatHandler("WEBP", PILLOW_DECODER, (((0, b"RIFF"), (8, b"WEBP")),),
+                  (".webp",)),
+    # Panasonic RAW files start with a variant of the TIFF header
+    FormatHandler("RAW", RAW_DECODER, TIFF_SIGNATURES + (((0, b"IIU\x00"),),),
+                  RAW_EXTENSIONS),
+]  # type: List[FormatHandler]
+
+
+def register_format(handler: FormatHandler) -> None:
+    """Add support for a format
+
+    Args:
+        handler: Describes the format. It is tried after those already
+            registered.
+
+    Returns:
+        None
+
+    """
+    FORMAT_HANDLERS.append(handler)
+
+
+class MappedFile(io.RawIOBase):
+    """Read-only binary file whose contents are mapped into memory
+
+    Reads are slices of the mapping, so they make no system calls. Unlike an
+    ``mmap`` object, this behaves like a regular file when seeking past the
+    end, which some of Pillow's format plugins do while identifying an
+    image.
+
+    Attributes:
+        name (str): Path of the file
+
+    """
+
+    def __init__(self, mapping: mmap.mmap, name: str) -> None:
+        """Wrap a mapping
+
+        Args:
+            mapping: The mapping, which is closed along with this file
+            name: Path of the file
+
+        """
+        super().__init__()
+        self.name = name
+        self._map = mapping
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        end = len(self._map) if size is None or size < 0 \
+            else self._position + size
+        data = self._map[self._position:end]
+        self._position += len(data)
+        return data
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position,
+                io.SEEK_END: len(self._map)}[whence]
+        if base + offset < 0:
+            raise ValueError("Negative seek position {}".format(base + offset))
+        self._position = base + offset
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        if not self.closed:
+            self._map.close()
+        super().close()
+
+
+def map_file(path: str) -> MappedFile:
+    """Map a file into memory, read-only
+
+    The file is closed once mapped, and the mapping is released when the
+    returned file is closed or garbage collected.
+
+    Args:
+        path: Path of the file
+
+    Returns:
+        The mapped file
+
+    Raises:
+        UnknownFormatError: If the file is empty
+
+    """
+    with open(path, "rb") as f:
+        try:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise UnknownFormatError("'{}' is empty".format(path)) from None
+    return MappedFile(mapping, path)
+
+
+def sniff_format(source: BinaryIO, ext: str = "") \
+        -> Optional[FormatHandler]:
+    """Detect the format of an image from its first bytes
+
+    >>> import io
+    >>> sniff_format(io.BytesIO(b"II*\\x00" + bytes(12)), ".arw").name
+    'RAW'
+    >>> sniff_format(io.BytesIO(b"II*\\x00" + bytes(12)), ".jpg").name
+    'TIFF'
+
+    Args:
+        source: The image, positioned at its start. The position is
+            restored afterwards.
+        ext: Lower-case extension of the image, which breaks ties between
+            formats with the same magic bytes
+
+    Returns:
+        The handler of the format, or ``None`` if no handler matches
+
+    """
+    position = source.tell()
+    head = source.read(SNIFF_BYTES)
+    source.seek(position)
+    matches = [handler for handler in FORMAT_HANDLERS
+               if handler.matches(head)]
+    for handler in matches:
+        if ext in handler.extensions:
+            return handler
+    return matches[0] if matches else None
+
+
+def get_decoder(source: BinaryIO, ext: str = "") \
+        -> Optional[str]:
+    """Choose the library to decode an image with, from its contents
+
+    Args:
+        source: The image, positioned at its start
+        ext: Lower-case extension of the image, or an empty string if not
+            known
+
+    Returns:
+        The ``decoder`` of the image's :py:class:`FormatHandler`. Images of
+        unrecognized formats are left to Pillow, which supports more formats
+        than are registered, unless the extension is unknown too, in which
+        case ``None`` is returned.
+
+    Raises:
+        UnknownFormatError: If the extension is that of a RAW format but the
+            contents are not of any known format
+
+    """
+    handler = sniff_format(source, ext)
+    if handler is not None:
+        return handler.decoder
+    if ext in RAW_EXTENSIONS:
+        raise UnknownFormatError(
+            "Contents do not match the '{}' extension".format(ext))
+    return PILLOW_DECODER if ext else None
+
+
+
+def get_opener(decoder: Optional[str]) -> Callable[[BinaryIO], Image.Image]:
+    """Get the function that opens images for a decoder as Pillow images
+
+    Args:
+        decoder: Name of the decoder, from :py:meth:`get_decoder`. Must not be
+            :py:data:`RAW_DECODER`.
+
+    Returns:
+        The ``opener`` of the first registered format with the decoder, or
+        ``Image.open`` if there is none
+
+    """
+    for handler in FORMAT_HANDLERS:
+        if handler.decoder == decoder and handler.opener is not None:
+            return handler.opener
+    return Image.open
@@ -0,0 +1,489 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Crop with separate pools of decode and encode workers
+
+In :py:meth:`batch_crop.schedule.crop_files`, each worker both decodes and
+encodes its image, so the number of processes doing each is always equal even
+though, for example, decoding a RAW image costs far more than encoding its
+JPEG crop. Here, decode workers decode and crop images, then hand the cropped
+pixels to a separate pool of encode workers, and the two pools are sized
+independently.
+
+The cropped pixels travel through a :py:class:`FrameRing`, a block of
+``multiprocessing.shared_memory`` divided into fixed-size slots, rather than
+being pickled through the pool's pipes. Each image holds one slot from decode
+to encode, so the number of slots also bounds the cropped frames in flight.
+The ring is sized to fit within the memory budget and the free space of
+``/dev/shm``, so it may have fewer slots than requested.
+
+"""
+
+import os
+import shutil
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, wait, \
+    FIRST_COMPLETED
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Deque, Dict, Iterable, Iterator, List, NamedTuple, \
+    Optional, Sequence, Tuple, Union
+
+from PIL import Image
+
+from batch_crop.archive import get_streamed_archive, ArchiveWriter
+from batch_crop.backends import DEFAULT_BACKEND, RenderResult
+from batch_crop.batch_crop import crop_image, coor_to_box, downscale_image, \
+    encode_image, get_rendition_path, get_save_exif, make_renditions, \
+    open_image, oriented_size, ratios_to_coors, read_image_header, \
+    ImageHeader, Rendition
+from batch_crop.contact import ContactSheet
+from batch_crop.quad import get_bounds, Region
+from batch_crop.schedule import Job, MemoryBudgetScheduler, \
+    get_default_budget, hand_off_outputs, make_jobs
+from batch_crop.writer import OutputWriter, write_atomic
+
+
+# Most bytes per pixel of the image modes a crop may be in, such as RGBA or
+# CMYK
+MAX_BYTES_PER_PIXEL = 4
+
+# Slot size used when no image header can be read
+FALLBACK_SLOT_BYTES = 64 * 1024 ** 2
+
+# Share of the memory budget the ring may take, leaving the rest to the
+# workers decoding and encoding
+RING_BUDGET_SHARE = 0.5
+
+# Directory backing shared memory, whose free space also limits the ring
+SHARED_MEMORY_DIR = "/dev/shm"
+
+# Shared memory blocks attached to by this process, by name
+_ATTACHED = {}  # type: Dict[str, SharedMemory]
+
+
+class FrameInfo(NamedTuple):
+    """Describes a cropped frame left in a :py:class:`FrameRing` slot
+
+    Attributes:
+        mode: Pillow mode of the pixels
+        size: Size of the frame
+        nbytes: Number of bytes of pixels in the slot
+        exif: EXIF data to save with the outputs, or ``None``
+        pixels: The pixels themselves, only if they did not fit in the slot
+
+    """
+    mode: str
+    size: Tuple[int, int]
+    nbytes: int
+    exif: Optional[bytes]
+    pixels: Optional[bytes]
+
+
+class FrameRing:
+    """Shared memory divided into equal slots for passing frames
+
+    The process that creates the ring owns the memory and hands out slots;
+    workers attach to it by :py:attr:`name`.
+
+    Attributes:
+        slots (int): Number of slots
+        slot_bytes (int): Size of each slot
+        name (str): Name workers attach to the shared memory by
+
+    """
+
+    def __init__(self, slots: int, slot_bytes: int) -> None:
+        """Create the shared memory
+
+        Args:
+            slots: Number of slots
+            slot_bytes: Size of each slot
+
+        """
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self._memory = SharedMemory(create=True, size=slots * slot_bytes)
+        self.name = self._memory.name
+        self._free = deque(range(slots))  # type: Deque[int]
+
+    def acquire(self) -> Optional[int]:
+        """Take a free slot
+
+        Returns:
+            The slot's offset into the shared memory, or ``None`` if all
+            slots are in use
+
+        """
+        if not self._free:
+            return None
+        return self._free.popleft() * self.slot_bytes
+
+    def release(self, offset: int) -> None:
+        """Return a slot taken by :py:meth:`acquire`
+
+        Args:
+            offset: The slot's offset
+
+        Returns:
+            None
+
+        """
+        self._free.append(offset // self.slot_bytes)
+
+    def close(self) -> None:
+        """Free the shared memory
+
+        Returns:
+            None
+
+        """
+        self._memory.close()
+        self._memory.unlink()
+
+    def __enter__(self) -> "FrameRing":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def attach(name: str) -> memoryview:
+    """Get the buffer of a :py:class:`FrameRing`, attaching at most once
+
+    Workers stay attached for their lifetime, so that frames can be read
+    without setting up the mapping for every image.
+
+    Args:
+        name: Name of the ring's shared memory
+
+    Returns:
+        The shared memory's buffer
+
+    """
+    if name not in _ATTACHED:
+        _ATTACHED[name] = SharedMemory(name=name)
+    buffer = _ATTACHED[name].buf
+    if buffer is None:
+        raise ValueError("shared memory '{}' is closed".format(name))
+    return buffer
+
+
+def fit_ring(slots: int, slot_bytes: int, limit: int) -> Tuple[int, int]:
+    """Shrink a ring so that it takes at most ``limit`` bytes
+
+    Slots are dropped first. If even one slot of ``slot_bytes`` does not
+    fit, a single smaller slot is used, and frames that do not fit in it are
+    passed to the encode workers directly.
+
+    >>> fit_ring(16, 100, 1000)
+    (10, 100)
+    >>> fit_ring(16, 100, 50)
+    (1, 50)
+
+    Args:
+        slots: Number of slots wanted
+        slot_bytes: Size of each slot wanted
+        limit: Largest total size of the ring
+
+    Returns:
+        The number of slots and the size of each slot
+
+    """
+    return max(1, min(slots, limit // slot_bytes)), \
+        max(1, min(slot_bytes, limit))
+
+
+def get_ring_limit(budget: Optional[int] = None) -> int:
+    """Get the largest size a :py:class:`FrameRing` may have
+
+    Args:
+        budget: Bytes of memory the whole batch may use. Defaults to
+            :py:meth:`batch_crop.schedule.get_default_budget`.
+
+    Returns:
+        :py:data:`RING_BUDGET_SHARE` of ``budget``, or the free space of
+        :py:data:`SHARED_MEMORY_DIR` if that is smaller
+
+    """
+    if budget is None:
+        budget = get_default_budget()
+    limit = int(budget * RING_BUDGET_SHARE)
+    try:
+        limit = min(limit, shutil.disk_usage(SHARED_MEMORY_DIR).free)
+    except OSError:
+        pass
+    return limit
+
+
+# pylint: disable=too-many-arguments
+def decode_frame(ring_name: str, offset: int, slot_bytes: int,
+                 box_ratio: Region, in_path: str,
+                 max_dimen: Optional[int] = None,
+                 decode_dimen: Optional[int] = None) -> FrameInfo:
+    """Decode and crop an image into a slot of a :py:class:`FrameRing`
+
+    Runs in a decode worker.
+
+    Args:
+        ring_name: Name of the ring's shared memory
+        offset: Offset of the slot to fill
+        slot_bytes: Size of the slot
+        box_ratio: Region to crop. See :doc:`units`
+        in_path: Path or member path of the image
+        max_dimen: If given, the crop is shrunk so that neither dimension
+            exceeds this
+        decode_dimen: The largest dimension any output will be shrunk to,
+            allowing a reduced-resolution decode. See
+            :py:meth:`batch_crop.batch_crop.open_image`.
+
+    Returns:
+        Where to find the cropped frame
+
+    """
+    image = open_image(in_path, box_ratio, decode_dimen)
+    cropped = crop_image(box_ratio, image)
+    if max_dimen is not None:
+        cropped = downscale_image(cropped, max_dimen)
+    exif = get_save_exif(image).get("exif")
+    pixels = cropped.tobytes()
+    if len(pixels) > slot_bytes:
+        return FrameInfo(cropped.mode, cropped.size, len(pixels), exif,
+                         pixels)
+    attach(ring_name)[offset:offset + len(pixels)] = pixels
+    return FrameInfo(cropped.mode, cropped.size, len(pixels), exif, None)
+
+
+def encode_frame(ring_name: str, offset: int, frame: FrameInfo,
+                 out_path: str, renditions: Sequence[Rendition] = (),
+                 save: bool = True) -> RenderResult:
+    """Encode the outputs of a cropped frame left in a :py:class:`FrameRing`
+
+    Runs in an encode worker. The outputs match those of
+    :py:meth:`batch_crop.batch_crop.render_crop`.
+
+    Args:
+        ring_name: Name of the ring's shared memory
+        offset: Offset of the slot holding the frame
+        frame: Describes the frame
+        out_path: Path the crop is to be saved to
+        renditions: Downscaled copies of the crop to encode as well
+        save: Whether to write the outputs atomically here rather than
+            return them
+
+    Returns:
+        The outputs, empty if they were saved
+
+    """
+    if frame.pixels is not None:
+        pixels = frame.pixels  # type: Union[bytes, memoryview]
+    else:
+        pixels = attach(ring_name)[offset:offset + frame.nbytes]
+    # Unpacks the pixels straight from the shared memory
+    cropped = Image.frombuffer(frame.mode, frame.size, pixels, "raw",
+                               frame.mode, 0, 1)
+    exif = {"exif": frame.exif} if frame.exif else {}  # type: Dict[str, Any]
+    outputs = [(out_path, encode_image(cropped, "jpeg", **exif))]
+    for rendition, image in make_renditions(cropped, renditions):
+        outputs.append((get_rendition_path(out_path, rendition),
+                        encode_image(image, rendition.format,
+                                     rendition.quality, **exif)))
+    del cropped, pixels
+    if not save:
+        return RenderResult(DEFAULT_BACKEND, outputs)
+    for path, data in outputs:
+        write_atomic(data, path)
+    return RenderResult(DEFAULT_BACKEND, [])
+
+
+def estimate_slot_bytes(box_ratio: Region,
+                        headers: Iterable[ImageHeader],
+                        max_dimen: Optional[int] = None) -> int:
+    """Find a slot size that fits the largest crop of a batch
+
+    Args:
+        box_ratio: Region to crop. See :doc:`units`
+        headers: Headers of the images, such as those read while making
+            the jobs
+        max_dimen: If given, crops are shrunk to fit this
+
+    Returns:
+        The slot size, in bytes
+
+    """
+    largest = 0
+    for header in headers:
+        # A rectified quad has no more pixels than its bounding box
+        left, upper, right, lower = coor_to_box(ratios_to_coors(
+            oriented_size(header.size, header.orientation),
+            get_bounds(box_ratio)))
+        width, height = round(right - left), round(lower - upper)
+        if max_dimen is not None and max(width, height) > max_dimen:
+            scale = max_dimen / max(width, height)
+            width, height = round(width * scale), round(height * scale)
+        largest = max(largest, width * height)
+    if not largest:
+        return FALLBACK_SLOT_BYTES
+    return largest * MAX_BYTES_PER_PIXEL
+
+
+# pylint: disable=too-many-locals,too-many-branches,too-many-statements
+def crop_files_pipelined(
+        box_ratio: Region,
+        paths: Sequence[Tuple[str, str]],
+        decode_workers: Optional[int] = None,
+        encode_workers: Optional[int] = None,
+        renditions: Sequence[Rendition] = (),
+        max_dimen: Optional[int] = None,
+        writer: Optional[Union[OutputWriter, ArchiveWriter]] = None,
+        slots: Optional[int] = None,
+        executors: Optional[Tuple[Executor, Executor]] = None,
+        contact_sheet: Optional[ContactSheet] = None,
+        budget: Optional[int] = None) -> Iterator[Tuple[Job, Future]]:
+    """Crop many files with separate decode and encode workers
+
+    This yields the same results as
+    :py:meth:`batch_crop.schedule.crop_files`, but runs each image's decode
+    and crop in one pool and its encode in another. Images are decoded
+    largest-first, and a new decode only starts once a ring slot is free, so
+    a slow encode pool holds back the decoders rather than letting cropped
+    frames pile up. Decodes are also admitted as by
+    :py:meth:`batch_crop.schedule.MemoryBudgetScheduler.next_admissible`,
+    within whatever part of the budget the ring leaves.
+
+    Args:
+        box_ratio: Region to crop. See :doc:`units`
+        paths: Pairs of input path and output path
+        decode_workers: Number of decode processes. Defaults to three
+            quarters of the CPUs, as given by :py:meth:`split_workers`.
+        encode_workers: Number of encode processes. Defaults to the rest of
+            the CPUs, and at least one.
+        renditions: Downscaled copies of each crop to save as well
+        max_dimen: If given, each crop is shrunk to fit this
+        writer: Writes the outputs, for example in the background or to
+            archives. By default, encode workers save the outputs.
+        slots: Number of frames that may be between decode and encode at
+            once. Defaults to twice the number of workers. Fewer are used if
+            the ring would not fit in memory (see :py:meth:`get_ring_limit`).
+        executors: The decode and encode executors. Defaults to new process
+            pools, shut down when cropping finishes.
+        contact_sheet: If given, each crop is added to it as its job
+            finishes
+        budget: Bytes of memory the batch may use, which limits the size of
+            the ring and the decodes running at once. Defaults to
+            :py:meth:`batch_crop.schedule.get_default_budget`.
+
+    Returns:
+        Iterator of each job paired with its finished future, whose result
+        is a :py:class:`batch_crop.backends.RenderResult` and whose exception,
+        if any, is that raised while decoding or encoding
+
+    """
+    default_decode, default_encode = split_workers(os.cpu_count() or 1)
+    decode_workers = decode_workers or default_decode
+    encode_workers = encode_workers or default_encode
+    if slots is None:
+        slots = 2 * (decode_workers + encode_workers)
+    decode_dimen = None
+    if max_dimen is not None:
+        decode_dimen = max([max_dimen] + [r.max_dimen for r in renditions])
+
+    if budget is None:
+        budget = get_default_budget()
+
+    headers = []  # type: List[ImageHeader]
+
+    def read_header(path: str) -> ImageHeader:
+        header = read_image_header(path)
+        headers.append(header)
+        return header
+
+    jobs = make_jobs(paths, read_header)
+    pending = list(jobs)
+    streams = {job: get_streamed_archive(job.in_path) for job in jobs}
+    owns_executors = executors is None
+    decode_pool, encode_pool = executors or (
+        ProcessPoolExecutor(max_workers=decode_workers),
+        ProcessPoolExecutor(max_workers=encode_workers))
+    slot_bytes = estimate_slot_bytes(box_ratio, headers, max_dimen)
+    ring = FrameRing(*fit_ring(slots, slot_bytes, get_ring_limit(budget)))
+    scheduler = MemoryBudgetScheduler(
+        max(0, budget - ring.slots * ring.slot_bytes), decode_workers,
+        decode_pool)
+    used = 0
+    decoding = {}  # type: Dict[Future, Tuple[Job, int]]
+    encoding = {}  # type: Dict[Future, Tuple[Job, int]]
+    try:
+        while pending or decoding or encoding:
+            # Queue a few decodes beyond the workers so none sits idle
+            while pending and len(decoding) < decode_workers + 1:
+                index = scheduler.next_admissible(pending, used, not decoding,
+                                                  streams)
+                if index is None:
+                    break
+                offset = ring.acquire()
+                if offset is None:
+                    break
+                job = pending.pop(index)
+                future = decode_pool.submit(
+                    decode_frame, ring.name, offset, ring.slot_bytes,
+                    box_ratio, job.in_path, max_dimen, decode_dimen)
+                decoding[future] = job, offset
+                used += job.cost
+
+            done, _ = wait(list(decoding) + list(encoding),
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in decoding:
+                    job, offset = decoding.pop(future)
+                    used -= job.cost
+                    if future.exception() is not None:
+                        ring.release(offset)
+                        yield job, future
+                        continue
+                    encoding[encode_pool.submit(
+                        encode_frame, ring.name, offset, future.result(),
+                        job.out_path, renditions, writer is None)] = \
+                        job, offset
+                else:
+                    job, offset = encoding.pop(future)
+                    ring.release(offset)
+                    hand_off_outputs(job, future, writer, contact_sheet)
+                    yield job, future
+    finally:
+        for future in list(decoding) + list(encoding):
+            future.cancel()
+        if owns_executors:
+            decode_pool.shutdown(wait=True)
+            encode_pool.shutdown(wait=True)
+        ring.close()
+
+
+def split_workers(workers: int) -> Tuple[int, int]:
+    """Divide workers between decoding and encoding by default
+
+    >>> split_workers(8)
+    (6, 2)
+
+    Args:
+        workers: Total number of workers
+
+    Returns:
+        Numbers of decode and encode workers, each at least ``1``
+
+    """
+    decode_workers = max(1, workers * 3 // 4)
+    return decode_workers, max(1, workers - decode_workers)
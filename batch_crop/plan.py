@@ -0,0 +1,317 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Plan a batch of crops from image headers alone
+
+No pixels are decoded: each image's size and orientation come from
+:py:meth:`batch_crop.batch_crop.read_image_header`, so even very large batches
+can be planned in seconds. The plan gives each output's pixel box, flags
+crops that would be empty or extend past the image, and estimates the pixels
+to decode, the peak memory, and the run time.
+
+Run times are estimated from throughputs in megapixels decoded per second per
+worker. The defaults in :py:data:`DEFAULT_THROUGHPUT` are rough; for better
+estimates, calibrate with results saved by ``python -m batch_crop benchmark
+--json`` run without ``--max-size``.
+
+"""
+
+import csv
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, \
+    Tuple
+
+import rawpy
+
+from batch_crop.batch_crop import coor_to_box, get_decode_scale, \
+    orient_box_ratio, oriented_size, ratios_to_coors, read_image_header, \
+    ImageHeader
+from batch_crop.benchmark import BenchmarkResult
+from batch_crop.formats import RAW_EXTENSIONS
+from batch_crop.quad import get_bounds, get_output_size, Quad, Region
+from batch_crop.schedule import header_footprint
+
+
+# Megapixels decoded per second by one worker, by lower-case extension, used
+# for formats without calibrated throughputs. "RAW" covers all RAW
+# extensions and "*" everything else.
+DEFAULT_THROUGHPUT = {"RAW": 15.0, "*": 40.0}
+
+# Number of headers read at once. Reading headers waits mostly on the disk.
+HEADER_THREADS = 16
+
+
+class PlannedCrop(NamedTuple):
+    """What cropping one image will produce and cost
+
+    Attributes:
+        in_path: Path of the image to crop
+        out_path: Path the crop will be saved to
+        size: Size of the upright image
+        box: Pixel bounds of the crop in the upright image, as
+            ``(left, upper, right, lower)``
+        output_size: Size of the saved crop, after any shrinking
+        decode_megapixels: Millions of pixels that will be decoded
+        cost: Estimated peak memory, in bytes
+        seconds: Estimated time to crop the image on one worker
+        problem: Why the crop is suspect, or ``None``
+
+    """
+    in_path: str
+    out_path: str
+    size: Tuple[int, int]
+    box: Tuple[int, int, int, int]
+    output_size: Tuple[int, int]
+    decode_megapixels: float
+    cost: int
+    seconds: float
+    problem: Optional[str]
+
+
+class PlanSummary(NamedTuple):
+    """Totals over a planned batch
+
+    Attributes:
+        files: Number of images in the batch
+        problems: Number of images whose crops are suspect
+        decode_megapixels: Millions of pixels that will be decoded in total
+        peak_memory: Estimated peak memory of the whole batch, in bytes
+        seconds: Estimated time to crop the whole batch
+
+    """
+    files: int
+    problems: int
+    decode_megapixels: float
+    peak_memory: int
+    seconds: float
+
+    def __str__(self) -> str:
+        return ("{} images, {} with problems\n"
+                "Decode: {:.1f} megapixels\n"
+                "Peak memory: {:.2f} GB\n"
+                "Estimated time: {:.0f} s").format(
+                    self.files, self.problems, self.decode_megapixels,
+                    self.peak_memory / 1024 ** 3, self.seconds)
+
+
+def get_throughputs(results: Sequence[BenchmarkResult],
+                    backend: Optional[str] = None) -> Dict[str, float]:
+    """Get per-format throughputs from benchmark results
+
+    Args:
+        results: Results of :py:meth:`batch_crop.benchmark.benchmark_backends`
+        backend: Backend the batch will use. Defaults to the fastest backend
+            for each format.
+
+    Returns:
+        Megapixels per second, by lower-case extension
+
+    """
+    throughputs = {}  # type: Dict[str, float]
+    for result in results:
+        if backend is None or result.backend == backend:
+            throughputs[result.format] = max(
+                throughputs.get(result.format, 0.0), result.throughput)
+    return throughputs
+
+
+def get_decode_reduction(ext: str, scale: float) -> int:
+    """Get the factor by which an image will be decoded smaller
+
+    This mirrors :py:meth:`batch_crop.batch_crop.open_image`: JPEGs are
+    decoded at 1/2, 1/4, or 1/8 size and RAW images at half size when the
+    crop allows it, while other formats are decoded at full size.
+
+    >>> get_decode_reduction(".jpg", 0.3)
+    2
+
+    Args:
+        ext: Lower-case extension of the image
+        scale: Smallest scale the image may be decoded at, from
+            :py:meth:`batch_crop.batch_crop.get_decode_scale`
+
+    Returns:
+        The factor by which each dimension is reduced
+
+    """
+    if ext in RAW_EXTENSIONS:
+        return 2 if scale <= 0.5 else 1
+    if ext in (".jpg", ".jpeg"):
+        return max(factor for factor in (1, 2, 4, 8) if scale <= 1 / factor)
+    return 1
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def plan_crop(box_ratio: Region, in_path: str,
+              out_path: str, max_dimen: Optional[int] = None,
+              throughputs: Optional[Dict[str, float]] = None,
+              read_header: Callable[[str], ImageHeader] = read_image_header) \
+        -> PlannedCrop:
+    """Plan the crop of one image from its header
+
+    Args:
+        box_ratio: Region to crop. See :doc:`units`
+        in_path: Path or member path of the image to crop
+        out_path: Path the crop will be saved to
+        max_dimen: If given, the crop will be shrunk so that neither
+            dimension exceeds this
+        throughputs: Megapixels decoded per second by one worker, by
+            lower-case extension. Missing formats use
+            :py:data:`DEFAULT_THROUGHPUT`.
+        read_header: Reads the image's header, for example from a
+            :py:class:`batch_crop.catalog.Catalog`
+
+    Returns:
+        The plan. If the header cannot be read, the plan is empty and
+        :py:attr:`PlannedCrop.problem` says why. For a
+        :py:class:`batch_crop.quad.Quad`, the box bounds the quad.
+
+    """
+    try:
+        header = read_header(in_path)
+    except (OSError, rawpy.LibRawError) as error:
+        return PlannedCrop(in_path, out_path, (0, 0), (0, 0, 0, 0), (0, 0),
+                           0.0, 0, 0.0, "unreadable: {}".format(error))
+
+    width, height = oriented_size(header.size, header.orientation)
+    # Image.crop rounds the bounds to whole pixels
+    left, upper, right, lower = (
+        int(round(value)) for value in
+        coor_to_box(ratios_to_coors((width, height), get_bounds(box_ratio))))
+    crop_width, crop_height = right - left, lower - upper
+
+    problem = None
+    if crop_width < 1 or crop_height < 1:
+        problem = "empty crop"
+    elif left < 0 or upper < 0 or right > width or lower > height:
+        problem = "crop extends past the image"
+
+    output_size = crop_width, crop_height
+    if isinstance(box_ratio, Quad) and problem != "empty crop":
+        output_size = get_output_size(box_ratio.to_coors((width, height)))
+    reduction = 1
+    if max_dimen is not None and problem != "empty crop":
+        largest = max(output_size)
+        if largest > max_dimen:
+            output_size = tuple(  # type: ignore
+                max(1, round(dimen * max_dimen / largest))
+                for dimen in output_size)
+        _, ext = os.path.splitext(in_path)
+        reduction = get_decode_reduction(ext.lower(), get_decode_scale(
+            header.size,
+            orient_box_ratio(get_bounds(box_ratio), header.orientation),
+            max_dimen))
+
+    stored_width, stored_height = header.size
+    decode_megapixels = math.ceil(stored_width / reduction) * \
+        math.ceil(stored_height / reduction) / 1e6
+    throughput = get_throughput(in_path, throughputs or {})
+    return PlannedCrop(in_path, out_path, (width, height),
+                       (left, upper, right, lower), output_size,
+                       decode_megapixels, header_footprint(header),
+                       decode_megapixels / throughput, problem)
+
+
+def get_throughput(path: str, throughputs: Dict[str, float]) -> float:
+    """Look up the throughput for an image's format
+
+    Args:
+        path: Path or member path of the image
+        throughputs: Megapixels decoded per second, by lower-case extension
+
+    Returns:
+        Megapixels decoded per second by one worker
+
+    """
+    _, ext = os.path.splitext(path)
+    ext = ext.lower()
+    if ext in throughputs:
+        return throughputs[ext]
+    return DEFAULT_THROUGHPUT["RAW" if ext in RAW_EXTENSIONS else "*"]
+
+
+def plan_crops(box_ratio: Region,
+               paths: Sequence[Tuple[str, str]],
+               max_dimen: Optional[int] = None,
+               throughputs: Optional[Dict[str, float]] = None,
+               read_header: Callable[[str], ImageHeader] = read_image_header) \
+        -> List[PlannedCrop]:
+    """Plan the crops of many images, reading headers in parallel
+
+    Args:
+        box_ratio: Region to crop. See :doc:`units`
+        paths: Pairs of input path and output path
+        max_dimen: If given, crops will be shrunk to fit this
+        throughputs: See :py:meth:`plan_crop`
+        read_header: See :py:meth:`plan_crop`
+
+    Returns:
+        A plan for each image, in the order of ``paths``
+
+    """
+    with ThreadPoolExecutor(max_workers=HEADER_THREADS) as executor:
+        return list(executor.map(
+            lambda pair: plan_crop(box_ratio, pair[0], pair[1], max_dimen,
+                                   throughputs, read_header),
+            paths))
+
+
+def summarize_plan(crops: Sequence[PlannedCrop], max_workers: int,
+                   budget: int) -> PlanSummary:
+    """Total up a planned batch
+
+    The estimates assume the batch is run as by
+    :py:meth:`batch_crop.schedule.crop_files`: largest images first, with at
+    most ``max_workers`` at once within the memory budget.
+
+    Args:
+        crops: The planned crops
+        max_workers: Number of images cropped at once
+        budget: Bytes of memory the crops may use at once
+
+    Returns:
+        The totals
+
+    """
+    costs = sorted((crop.cost for crop in crops), reverse=True)
+    peak = min(sum(costs[:max_workers]), max([budget] + costs[:1]))
+    total_seconds = sum(crop.seconds for crop in crops)
+    longest = max([0.0] + [crop.seconds for crop in crops])
+    return PlanSummary(len(crops),
+                       sum(1 for crop in crops if crop.problem is not None),
+                       sum(crop.decode_megapixels for crop in crops), peak,
+                       max(total_seconds / max_workers, longest))
+
+
+def save_plan(crops: Sequence[PlannedCrop], path: str) -> None:
+    """Save planned crops as CSV, one row per image
+
+    Args:
+        crops: The planned crops
+        path: Path of the CSV file to write
+
+    Returns:
+        None
+
+    """
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(PlannedCrop._fields)
+        for crop in crops:
+            writer.writerow(crop)
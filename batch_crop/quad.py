@@ -0,0 +1,347 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Crop rotated rectangles and four-cornered regions
+
+A :py:class:`Quad` selects a region by its four corners, so it can describe a
+rotated rectangle or a region seen in perspective, like a skewed document
+scan. To crop one, only the axis-aligned bounding box of the corners is
+cut out of the image, and that small region is rectified into an upright
+rectangle by a single transform: affine when the corners form a
+parallelogram, as for any rotated rectangle, and perspective otherwise. The
+whole image is never rotated or warped.
+
+A crop region, as accepted by
+:py:meth:`batch_crop.batch_crop.crop_image`, is either a ``box_ratio`` (see
+:doc:`units`) or a :py:class:`Quad`.
+
+"""
+
+import math
+from typing import List, NamedTuple, Sequence, Tuple, Union
+
+from PIL import Image
+
+
+# Largest distance, in pixels, between the fourth corner of a quad and the
+# corner that would complete a parallelogram, for the quad to be rectified
+# with an affine transform
+PARALLELOGRAM_TOLERANCE = 0.5
+
+Point = Tuple[float, float]
+
+
+class Quad(NamedTuple):
+    """Region of an image bounded by four corners
+
+    Attributes:
+        corners: The corners as ``(x, y)`` ratios (see :doc:`units`) of the
+            upright image, clockwise from the top-left corner of the region.
+            The top edge of the region runs from the first corner to the
+            second.
+
+    """
+    corners: Tuple[Point, Point, Point, Point]
+
+    @property
+    def bounds(self) -> Tuple[float, float, float, float]:
+        """``box_ratio`` of the smallest rectangle that holds the region"""
+        xs = [x for x, _ in self.corners]
+        ys = [y for _, y in self.corners]
+        return min(xs), min(ys), max(xs), max(ys)
+
+    def to_coors(self, image_size: Tuple[float, float]) -> List[Point]:
+        """Get the corners as coordinates
+
+        Args:
+            image_size: Size of the image that is the context for the
+                coordinates
+
+        Returns:
+            The corners, in order, as ``(x, y)`` coordinates
+
+        """
+        width, height = image_size
+        return [(x * width, y * height) for x, y in self.corners]
+
+
+Region = Union[Tuple[float, float, float, float], Quad]
+
+
+def get_bounds(region: Region) -> Tuple[float, float, float, float]:
+    """Get the ``box_ratio`` that bounds a crop region
+
+    >>> get_bounds((0.1, 0.2, 0.5, 0.6))
+    (0.1, 0.2, 0.5, 0.6)
+    >>> get_bounds(Quad(((0.2, 0.1), (0.6, 0.2), (0.5, 0.6), (0.1, 0.5))))
+    (0.1, 0.1, 0.6, 0.6)
+
+    Args:
+        region: The crop region
+
+    Returns:
+        ``region`` itself for a ``box_ratio``, and the bounds of a
+        :py:class:`Quad`
+
+    """
+    return region.bounds if isinstance(region, Quad) else region
+
+
+def order_corners(points: Sequence[Point]) -> List[Point]:
+    """Order four points clockwise, starting from the top-left one
+
+    The top-left point is the one with the smallest ``x + y``.
+
+    >>> order_corners([(10, 10), (0, 0), (0, 10), (10, 0)])
+    [(0, 0), (10, 0), (10, 10), (0, 10)]
+
+    Args:
+        points: The points, in any order
+
+    Returns:
+        The points, in order
+
+    """
+    center_x = sum(x for x, _ in points) / len(points)
+    center_y = sum(y for _, y in points) / len(points)
+    # With y increasing downward, increasing angles run clockwise
+    ordered = sorted(points, key=lambda point: math.atan2(
+        point[1] - center_y, point[0] - center_x))
+    start = min(range(len(ordered)), key=lambda i: sum(ordered[i]))
+    return ordered[start:] + ordered[:start]
+
+
+def rotate_box(box_coor: Tuple[float, float, float, float], angle: float) \
+        -> List[Point]:
+    """Rotate a rectangle about its center
+
+    >>> [(round(x), round(y)) for x, y in rotate_box((0, 0, 20, 10), 90)]
+    [(15, -5), (15, 15), (5, 15), (5, -5)]
+
+    Args:
+        box_coor: The rectangle, as a ``box_coor`` (see :doc:`units`)
+        angle: Clockwise rotation, in degrees
+
+    Returns:
+        The corners of the rotated rectangle, starting from the one that was
+        top-left and continuing clockwise
+
+    """
+    x1, y1, x2, y2 = box_coor
+    left, right = min(x1, x2), max(x1, x2)
+    upper, lower = min(y1, y2), max(y1, y2)
+    center_x, center_y = (left + right) / 2, (upper + lower) / 2
+    cos, sin = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+    return [(center_x + (x - center_x) * cos - (y - center_y) * sin,
+             center_y + (x - center_x) * sin + (y - center_y) * cos)
+            for x, y in ((left, upper), (right, upper), (right, lower),
+                         (left, lower))]
+
+
+def quad_from_coors(image_size: Tuple[float, float],
+                    corners: Sequence[Point]) -> Quad:
+    """Convert corner coordinates to a :py:class:`Quad`
+
+    >>> quad_from_coors((10, 100), [(1, 2), (5, 2), (5, 4), (1, 4)]).corners
+    ((0.1, 0.02), (0.5, 0.02), (0.5, 0.04), (0.1, 0.04))
+
+    Args:
+        image_size: Size of the image that is the context for ``corners``
+        corners: The corners, clockwise from the top-left one
+
+    Returns:
+        The quad
+
+    """
+    width, height = image_size
+    return Quad(tuple((x / width, y / height)  # type: ignore
+                      for x, y in corners))
+
+
+def distance(start: Point, end: Point) -> float:
+    """Get the distance between two points
+
+    >>> distance((0, 0), (3, 4))
+    5.0
+
+    Args:
+        start: One point
+        end: The other point
+
+    Returns:
+        The straight-line distance between them
+
+    """
+    return math.hypot(end[0] - start[0], end[1] - start[1])
+
+
+def get_output_size(corners: Sequence[Point]) -> Tuple[int, int]:
+    """Get the size of a region once rectified
+
+    The width is the mean length of the top and bottom edges, and the height
+    that of the left and right edges, so a rotated rectangle keeps its size.
+
+    >>> get_output_size([(0, 0), (30, 0), (30, 10), (0, 10)])
+    (30, 10)
+
+    Args:
+        corners: Coordinates of the corners, clockwise from the top-left
+
+    Returns:
+        Size of the rectified region, at least one pixel each way
+
+    """
+    top_left, top_right, bottom_right, bottom_left = corners
+    width = (distance(top_left, top_right) +
+             distance(bottom_left, bottom_right)) / 2
+    height = (distance(top_left, bottom_left) +
+              distance(top_right, bottom_right)) / 2
+    return max(1, round(width)), max(1, round(height))
+
+
+def is_parallelogram(corners: Sequence[Point]) -> bool:
+    """Check whether corners form a parallelogram, to within half a pixel
+
+    Args:
+        corners: Coordinates of the corners, clockwise from the top-left
+
+    Returns:
+        ``True`` if an affine transform can rectify the region
+
+    """
+    top_left, top_right, bottom_right, bottom_left = corners
+    return distance((top_right[0] + bottom_left[0] - top_left[0],
+                     top_right[1] + bottom_left[1] - top_left[1]),
+                    bottom_right) <= PARALLELOGRAM_TOLERANCE
+
+
+def get_affine_data(corners: Sequence[Point], size: Tuple[int, int]) \
+        -> Tuple[float, ...]:
+    """Get the ``Image.AFFINE`` transform that rectifies a parallelogram
+
+    Pillow's transforms map each output pixel back to the input, so the
+    output's top-left corner comes from the first corner, its top edge
+    follows the edge to the second corner, and its left edge the edge to the
+    fourth corner.
+
+    Args:
+        corners: Coordinates of the corners, clockwise from the top-left
+        size: Size of the output
+
+    Returns:
+        Data for ``Image.transform``
+
+    """
+    (x0, y0), (x1, y1), _, (x3, y3) = corners
+    width, height = size
+    return ((x1 - x0) / width, (x3 - x0) / height, x0,
+            (y1 - y0) / width, (y3 - y0) / height, y0)
+
+
+def get_perspective_data(corners: Sequence[Point], size: Tuple[int, int]) \
+        -> Tuple[float, ...]:
+    """Get the ``Image.PERSPECTIVE`` transform that rectifies a quad
+
+    The transform maps each output coordinate ``(x, y)`` to the input
+    coordinate ``((a x + b y + c) / (g x + h y + 1), (d x + e y + f) / (g x +
+    h y + 1))``. The eight coefficients are found by requiring each output
+    corner to map to the matching corner of the quad.
+
+    Args:
+        corners: Coordinates of the corners, clockwise from the top-left
+        size: Size of the output
+
+    Returns:
+        Data for ``Image.transform``, as ``(a, b, c, d, e, f, g, h)``
+
+    """
+    width, height = size
+    rows = []
+    values = []
+    for (x, y), (u, v) in zip(((0, 0), (width, 0), (width, height),
+                               (0, height)), corners):
+        rows.append([x, y, 1, 0, 0, 0, -x * u, -y * u])
+        values.append(u)
+        rows.append([0, 0, 0, x, y, 1, -x * v, -y * v])
+        values.append(v)
+    return tuple(solve_linear(rows, values))
+
+
+def solve_linear(rows: List[List[float]], values: List[float]) \
+        -> List[float]:
+    """Solve a square system of linear equations by Gaussian elimination
+
+    >>> [round(value, 6) for value in solve_linear([[2, 1], [1, 3]], [3, 5])]
+    [0.8, 1.4]
+
+    Args:
+        rows: Coefficients of each equation. Modified in place.
+        values: Right-hand side of each equation. Modified in place.
+
+    Returns:
+        The solution
+
+    Raises:
+        ValueError: If the system has no unique solution, as for a quad with
+            three corners in a line
+
+    """
+    size = len(rows)
+    for col in range(size):
+        magnitudes = [abs(row[col]) for row in rows]
+        pivot = max(range(col, size), key=magnitudes.__getitem__)
+        if abs(rows[pivot][col]) < 1e-12:
+            raise ValueError("Corners do not enclose a region")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        values[col], values[pivot] = values[pivot], values[col]
+        for row in range(col + 1, size):
+            factor = rows[row][col] / rows[col][col]
+            for k in range(col, size):
+                rows[row][k] -= factor * rows[col][k]
+            values[row] -= factor * values[col]
+    solution = [0.0] * size
+    for row in reversed(range(size)):
+        total = sum(rows[row][k] * solution[k] for k in range(row + 1, size))
+        solution[row] = (values[row] - total) / rows[row][row]
+    return solution
+
+
+def rectify(image: Image.Image, corners: Sequence[Point]) -> Image.Image:
+    """Transform a four-cornered region of an image into an upright rectangle
+
+    The cost depends only on the size of the output, so ``image`` should
+    already be cut down to the region's bounding box.
+
+    Args:
+        image: The image holding the region
+        corners: Coordinates of the region's corners in ``image``, clockwise
+            from the top-left
+
+    Returns:
+        The region as a new image of the size given by
+        :py:meth:`get_output_size`
+
+    """
+    size = get_output_size(corners)
+    if is_parallelogram(corners):
+        method, data = Image.AFFINE, get_affine_data(corners, size)
+    else:
+        method, data = Image.PERSPECTIVE, get_perspective_data(corners, size)
+    if image.mode in ("1", "P"):
+        image = image.convert("RGBA" if "transparency" in image.info
+                              else "RGB")
+    return image.transform(size, method, data, Image.BICUBIC)
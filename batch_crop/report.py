@@ -0,0 +1,112 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Record which images failed to crop, so that only they can be retried
+
+The report is a JSON object with a ``failures`` list, each entry holding the
+``in_path`` and ``out_path`` of an image along with the ``error`` type and
+its ``message``. For example:
+
+.. code-block:: json
+
+   {"failures": [{"in_path": "images/img7.ARW",
+                  "out_path": "images/img7.ARW_cropped.jpg",
+                  "error": "LibRawFileUnsupportedError",
+                  "message": "b'Unsupported file format or not RAW file'"}]}
+
+"""
+
+import json
+from typing import List, NamedTuple, Sequence, Tuple
+
+from batch_crop.writer import write_atomic
+
+
+class Failure(NamedTuple):
+    """An image that failed to crop
+
+    Attributes:
+        in_path: Path of the image
+        out_path: Path its crop was to be saved to
+        error: Name of the type of error raised
+        message: The error's message
+
+    """
+    in_path: str
+    out_path: str
+    error: str
+    message: str
+
+    @classmethod
+    def from_error(cls, in_path: str, out_path: str,
+                   error: BaseException) -> "Failure":
+        """Describe the error raised while cropping an image
+
+        Args:
+            in_path: Path of the image
+            out_path: Path its crop was to be saved to
+            error: The error
+
+        Returns:
+            The failure
+
+        """
+        return cls(in_path, out_path, type(error).__name__, str(error))
+
+
+def save_report(failures: Sequence[Failure], path: str) -> None:
+    """Save failures to a JSON error report, replacing any existing report
+
+    Args:
+        failures: The failures
+        path: Path of the report
+
+    Returns:
+        None
+
+    """
+    report = {"failures": [failure._asdict() for failure in failures]}
+    write_atomic(json.dumps(report, indent=2).encode("utf-8"), path)
+
+
+def load_report(path: str) -> List[Failure]:
+    """Load the failures from a JSON error report
+
+    Args:
+        path: Path of the report
+
+    Returns:
+        The failures
+
+    """
+    with open(path) as f:
+        report = json.load(f)
+    return [Failure(**entry) for entry in report["failures"]]
+
+
+def get_failed_paths(path: str) -> List[Tuple[str, str]]:
+    """Get the images to retry from a JSON error report
+
+    Args:
+        path: Path of the report
+
+    Returns:
+        Pairs of input path and output path
+
+    """
+    return [(failure.in_path, failure.out_path)
+            for failure in load_report(path)]
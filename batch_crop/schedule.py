@@ -0,0 +1,694 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Run crops in parallel without exceeding a memory budget
+
+Decoding a RAW image takes several times the memory of the decoded pixels,
+so sizing a pool by the number of cores alone can exhaust memory. Instead,
+each file's decode footprint is estimated from its header, and a job is only
+started once enough of the budget is free. Jobs are started largest-first so
+that the batch does not end waiting on one big file started last, except that
+the members of each compressed tar archive are started in archive order (see
+:py:class:`batch_crop.archive.CompressedTar`).
+
+"""
+
+import errno
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Executor, Future, wait, FIRST_COMPLETED
+from multiprocessing.connection import Connection
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, \
+    Sequence, Set, Tuple, Union
+
+from batch_crop.archive import get_streamed_archive, read_archive_index, \
+    ArchiveWriter, MEMBER_SEPARATOR
+from batch_crop.backends import crop_with_backend, render, DEFAULT_BACKEND
+from batch_crop.batch_crop import read_image_header, ImageHeader, \
+    Rendition
+from batch_crop.contact import ContactSheet
+from batch_crop.quad import Region
+from batch_crop.writer import OutputWriter
+
+
+# Peak bytes used per pixel while decoding and cropping a RAW image: the
+# 16-bit sensor data, LibRaw's 4-channel 16-bit working image, the 8-bit RGB
+# output, Pillow's padded RGBX copy, and the crop.
+RAW_BYTES_PER_PIXEL = 2 + 8 + 3 + 4 + 4
+
+# Peak bytes used per pixel while decoding and cropping other images: the
+# decoded image and the crop, both padded to 4 bytes per pixel by Pillow.
+PILLOW_BYTES_PER_PIXEL = 4 + 4
+
+# Budget used when the available memory cannot be determined
+FALLBACK_BUDGET = 4 * 1024 ** 3
+
+# Seconds between checks for whether submitted jobs have started, so that
+# their time limits can be counted from when they start
+START_POLL_INTERVAL = 0.05
+
+# Error numbers of I/O errors worth retrying, such as those from a network
+# share that briefly drops out. Only those defined on this platform are kept.
+TRANSIENT_ERRNOS = frozenset(
+    getattr(errno, name) for name in (
+        "EIO", "EAGAIN", "EINTR", "EBUSY", "ETIMEDOUT", "ESTALE",
+        "ECONNRESET", "ECONNABORTED", "ENETUNREACH", "EHOSTUNREACH")
+    if hasattr(errno, name))
+
+
+class Job(NamedTuple):
+    """A file to crop, with the memory needed to crop it
+
+    Attributes:
+        in_path: Path of the image to crop
+        out_path: Path to save the crop to
+        cost: Estimated peak memory, in bytes, needed to crop the image
+
+    """
+    in_path: str
+    out_path: str
+    cost: int
+
+
+def estimate_footprint(path: str) -> int:
+    """Estimate the peak memory needed to crop an image
+
+    Only the image's header is read, using
+    :py:meth:`batch_crop.batch_crop.read_image_header`.
+
+    Args:
+        path: Path to the image
+
+    Returns:
+        Estimated peak memory, in bytes
+
+    """
+    return header_footprint(read_image_header(path))
+
+
+def header_footprint(header: ImageHeader) -> int:
+    """Estimate the peak memory needed to crop an image from its header
+
+    Args:
+        header: The image's header
+
+    Returns:
+        Estimated peak memory, in bytes
+
+    """
+    width, height = header.size
+    per_pixel = RAW_BYTES_PER_PIXEL if header.format == "RAW" \
+        else PILLOW_BYTES_PER_PIXEL
+    return width * height * per_pixel
+
+
+def get_default_budget() -> int:
+    """Get a memory budget of three quarters of the currently free memory
+
+    Returns:
+        The budget, in bytes. :py:data:`FALLBACK_BUDGET` if the free memory
+        cannot be determined on this platform.
+
+    """
+    try:
+        free = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return FALLBACK_BUDGET
+    return free * 3 // 4
+
+
+def make_jobs(paths: Sequence[Tuple[str, str]],
+              read_header: Callable[[str], ImageHeader] = read_image_header) \
+        -> List[Job]:
+    """Create jobs for files, ordered largest-first
+
+    A file whose header cannot be read is given a cost of ``0``, leaving the
+    error to be reported when the file is cropped.
+
+    Members of a compressed tar archive are best read in archive order, so
+    they keep the places that largest-first ordering gives them but fill
+    those places in archive order.
+
+    Args:
+        paths: Pairs of input path and output path
+        read_header: Reads an image's header, for example from a
+            :py:class:`batch_crop.catalog.Catalog`
+
+    Returns:
+        The jobs, sorted by decreasing :py:attr:`Job.cost` apart from members
+        of compressed tar archives
+
+    """
+    jobs = []
+    for in_path, out_path in paths:
+        try:
+            cost = header_footprint(read_header(in_path))
+        except Exception:  # pylint: disable=broad-except
+            cost = 0
+        jobs.append(Job(in_path, out_path, cost))
+    jobs.sort(key=lambda job: job.cost, reverse=True)
+
+    places = {}  # type: Dict[str, List[int]]
+    for index, job in enumerate(jobs):
+        archive_path = get_streamed_archive(job.in_path)
+        if archive_path is not None:
+            places.setdefault(archive_path, []).append(index)
+    for archive_path, indices in places.items():
+        order = {archive_path + MEMBER_SEPARATOR + name: position
+                 for position, name
+                 in enumerate(read_archive_index(archive_path))}
+        members = sorted((order[jobs[index].in_path], jobs[index])
+                         for index in indices)
+        for index, (_, job) in zip(indices, members):
+            jobs[index] = job
+    return jobs
+
+
+def is_transient(error: BaseException) -> bool:
+    """Check whether an error may go away if the operation is retried
+
+    >>> is_transient(OSError(errno.EIO, "Input/output error"))
+    True
+    >>> is_transient(OSError("image file is truncated"))
+    False
+
+    Args:
+        error: The error
+
+    Returns:
+        ``True`` if ``error`` is an I/O error with an errno in
+        :py:data:`TRANSIENT_ERRNOS`
+
+    """
+    return isinstance(error, OSError) and error.errno in TRANSIENT_ERRNOS
+
+
+def call_with_retries(function: Callable, retries: int, delay: float,
+                      *args) -> object:
+    """Call a function, retrying it after transient I/O errors
+
+    The wait before each retry doubles, starting from ``delay``.
+
+    Args:
+        function: The function to call
+        retries: Number of times to retry before giving up
+        delay: Seconds to wait before the first retry
+        args: Passed to ``function``
+
+    Returns:
+        The function's return value
+
+    Raises:
+        Exception: Whatever ``function`` last raised, if it never succeeded
+            or raised an error that is not transient
+
+    """
+    for attempt in range(retries):
+        try:
+            return function(*args)
+        except OSError as error:
+            if not is_transient(error):
+                raise
+        time.sleep(delay * 2 ** attempt)
+    return function(*args)
+
+
+def make_timeout_future(timeout: float) -> Future:
+    """Create a finished future for a job that took too long
+
+    Args:
+        timeout: Seconds the job was allowed
+
+    Returns:
+        Future whose exception is a ``TimeoutError``
+
+    """
+    future = Future()  # type: Future
+    future.set_exception(TimeoutError(
+        "gave up after {:g} seconds".format(timeout)))
+    return future
+
+
+class WorkerStoppedError(Exception):
+    """Raised for a task whose worker process was stopped while running it"""
+
+
+def serve_tasks(connection: Connection) -> None:
+    """Run the tasks sent over a connection until told to stop
+
+    This is the main function of each :py:class:`WorkerPool` worker process.
+    Each task is a ``(function, args, kwargs)`` tuple, and is answered with
+    ``(True, result)`` or ``(False, exception)``.
+
+    Args:
+        connection: Receives tasks and sends back their outcomes. ``None``
+            or a closed connection stops the worker.
+
+    Returns:
+        None
+
+    """
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        function, args, kwargs = task
+        try:
+            outcome = True, function(*args, **kwargs)
+        except BaseException as error:  # pylint: disable=broad-except
+            outcome = False, error
+        try:
+            connection.send(outcome)
+        except Exception as error:  # pylint: disable=broad-except
+            connection.send((False, RuntimeError(
+                "could not send the outcome: {}".format(error))))
+
+
+class WorkerPool(Executor):
+    """Process pool whose worker running a task can be stopped
+
+    ``ProcessPoolExecutor`` offers no public way to stop a task once it has
+    started. Here each worker process is owned by a thread in this process
+    that hands it one task at a time, so :py:meth:`terminate` can stop the
+    worker running a particular task. The next task given to that thread
+    starts a fresh worker.
+
+    Attributes:
+        max_workers (int): Number of worker processes
+
+    """
+
+    def __init__(self, max_workers: int) -> None:
+        self.max_workers = max_workers
+        self._tasks = queue.Queue()  # type: queue.Queue
+        self._running = {}  # type: Dict[Future, multiprocessing.Process]
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._threads = [threading.Thread(target=self._run, daemon=True)
+                         for _ in range(max_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    # pylint: disable=arguments-differ
+    def submit(self, fn: Callable, /, *args, **kwargs) -> Future:
+        """Schedule a function to be called in a worker process
+
+        Args:
+            fn: The function, which must be picklable
+            args: Passed to ``fn``
+            kwargs: Passed to ``fn``
+
+        Returns:
+            Future for the function's result
+
+        Raises:
+            RuntimeError: If the pool has been shut down
+
+        """
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot submit to a shut down pool")
+            future = Future()  # type: Future
+            self._tasks.put((future, fn, args, kwargs))
+            return future
+
+    def terminate(self, future: Future) -> bool:
+        """Stop the worker process running a task
+
+        The task's future then holds a :py:class:`WorkerStoppedError`.
+
+        Args:
+            future: The task's future
+
+        Returns:
+            ``True`` if the task was running and its worker was stopped
+
+        """
+        with self._lock:
+            process = self._running.get(future)
+            if process is None:
+                return False
+            process.terminate()
+            return True
+
+    # pylint: disable=arguments-differ,redefined-outer-name
+    def shutdown(self, wait: bool = True, *,
+                 cancel_futures: bool = False) -> None:
+        """Stop the workers once the tasks already submitted have run
+
+        Args:
+            wait: Whether to wait for the workers to stop
+            cancel_futures: Whether to cancel the tasks not yet started
+                instead of running them
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            if not self._shutdown:
+                self._shutdown = True
+                for _ in self._threads:
+                    self._tasks.put(None)
+        if cancel_futures:
+            for future in list(self._tasks.queue):
+                if future is not None:
+                    future[0].cancel()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _run(self) -> None:
+        """Hand tasks to one worker process until the pool shuts down
+
+        Returns:
+            None
+
+        """
+        process = None  # type: Optional[multiprocessing.Process]
+        connection = None  # type: Optional[Connection]
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            future, function, args, kwargs = task
+            if process is None or connection is None:
+                connection, child = multiprocessing.Pipe()
+                process = multiprocessing.Process(
+                    target=serve_tasks, args=(child,), daemon=True)
+                process.start()
+                child.close()
+            with self._lock:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self._running[future] = process
+            try:
+                connection.send((function, args, kwargs))
+                succeeded, value = connection.recv()
+            except (EOFError, OSError):
+                process.join()
+                connection.close()
+                process, connection = None, None
+                future.set_exception(WorkerStoppedError(
+                    "worker process stopped while running the task"))
+            except Exception as error:  # pylint: disable=broad-except
+                future.set_exception(error)
+            else:
+                if succeeded:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+            finally:
+                with self._lock:
+                    del self._running[future]
+        if process is not None and connection is not None:
+            connection.send(None)
+            process.join()
+            connection.close()
+
+
+class MemoryBudgetScheduler:
+    """Admit jobs to an executor only while their total cost fits a budget
+
+    Attributes:
+        budget (int): Bytes of memory that running jobs may use in total
+        max_workers (int): Number of jobs that may run at once
+        executor (Executor): Runs the admitted jobs
+
+    """
+
+    def __init__(self, budget: int, max_workers: int,
+                 executor: Optional[Executor] = None) -> None:
+        """Create a scheduler
+
+        Args:
+            budget: Bytes of memory that running jobs may use in total
+            max_workers: Number of jobs that may run at once
+            executor: Runs the admitted jobs. Defaults to a new
+                :py:class:`WorkerPool` with ``max_workers`` workers, which
+                the scheduler shuts down when :py:meth:`run` finishes.
+
+        """
+        self.budget = budget
+        self.max_workers = max_workers
+        self._owns_executor = executor is None
+        self.executor = executor if executor is not None \
+            else WorkerPool(max_workers)
+
+    def run(self, jobs: Sequence[Job], submit: Callable[[Job], Future],
+            timeout: Optional[float] = None) -> Iterator[Tuple[Job, Future]]:
+        """Run jobs, yielding each one as it finishes
+
+        At each opportunity, the first job in ``jobs`` that fits in the
+        remaining budget is started, so order ``jobs`` largest-first (as
+        :py:meth:`make_jobs` does) to start big jobs early while letting small
+        ones fill the gaps. A job larger than the whole budget runs once
+        nothing else is running. Members of a compressed tar archive are never
+        started ahead of earlier members of the same archive in ``jobs``.
+
+        A job still running ``timeout`` seconds after it started is yielded
+        with a future holding a ``TimeoutError``. If :py:attr:`executor` is a
+        :py:class:`WorkerPool`, such as the one the scheduler creates, the
+        worker process running the job is terminated. Otherwise the job keeps
+        its worker and its memory until it finishes, if ever. Either way, it
+        counts against :py:attr:`max_workers` and the budget until its worker
+        is free.
+
+        Args:
+            jobs: The jobs to run
+            submit: Called with a job to start it on :py:attr:`executor`
+            timeout: Seconds a job may run. Defaults to no limit.
+
+        Returns:
+            Iterator of each job paired with its finished future
+
+        """
+        pending = list(jobs)
+        streams = {job: get_streamed_archive(job.in_path) for job in jobs}
+        running = {}  # type: Dict[Future, Job]
+        # Deadlines of the running jobs that have started
+        deadlines = {}  # type: Dict[Future, float]
+        # Jobs given up on that may still be holding a worker and memory
+        hung = {}  # type: Dict[Future, Job]
+        used = 0
+        try:
+            while pending or running:
+                while pending and \
+                        len(running) + len(hung) < self.max_workers:
+                    index = self.next_admissible(pending, used, not running,
+                                                 streams)
+                    if index is None:
+                        break
+                    job = pending.pop(index)
+                    future = submit(job)
+                    running[future] = job
+                    used += job.cost
+
+                wait_time = None
+                if timeout is not None:
+                    now = time.monotonic()
+                    for future in running:
+                        if future not in deadlines and future.running():
+                            deadlines[future] = now + timeout
+                    if len(deadlines) < len(running):
+                        wait_time = START_POLL_INTERVAL
+                    if deadlines:
+                        wait_time = min(
+                            wait_time or timeout,
+                            max(0.0, min(deadlines.values()) - now))
+                done, _ = wait(list(running) + list(hung), timeout=wait_time,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in hung:
+                        used -= hung.pop(future).cost
+                        continue
+                    job = running.pop(future)
+                    deadlines.pop(future, None)
+                    used -= job.cost
+                    yield job, future
+
+                if timeout is None:
+                    continue
+                now = time.monotonic()
+                for future, deadline in list(deadlines.items()):
+                    if deadline <= now and not future.done():
+                        job = running.pop(future)
+                        del deadlines[future]
+                        hung[future] = job
+                        self._stop(future)
+                        yield job, make_timeout_future(timeout)
+        finally:
+            for future in running:
+                future.cancel()
+            for future in hung:
+                self._stop(future)
+            if self._owns_executor:
+                self.executor.shutdown()
+
+    def _stop(self, future: Future) -> None:
+        """Stop a job, terminating its worker if :py:attr:`executor` can
+
+        Args:
+            future: The job's future
+
+        Returns:
+            None
+
+        """
+        if isinstance(self.executor, WorkerPool):
+            self.executor.terminate(future)
+        else:
+            future.cancel()
+
+    def next_admissible(self, pending: List[Job], used: int, idle: bool,
+                        streams: Optional[Dict[Job, Optional[str]]] = None) \
+            -> Optional[int]:
+        """Find the first pending job that may start now
+
+        Args:
+            pending: Jobs not yet started
+            used: Bytes of the budget taken by running jobs
+            idle: Whether no jobs are running
+            streams: The compressed tar archive each job reads from, if any.
+                Defaults to treating every job as independent.
+
+        Returns:
+            Index into ``pending`` of the job to start, or ``None`` if none
+            may start until a running job finishes
+
+        """
+        skipped = set()  # type: Set[str]
+        for index, job in enumerate(pending):
+            archive_path = streams.get(job) if streams is not None else None
+            if archive_path in skipped:
+                continue
+            if used + job.cost <= self.budget:
+                return index
+            if archive_path is not None:
+                skipped.add(archive_path)
+        return 0 if idle else None
+
+
+# pylint: disable=too-many-arguments
+def crop_files(box_ratio: Region,
+               paths: Sequence[Tuple[str, str]],
+               budget: Optional[int] = None, max_workers: Optional[int] = None,
+               renditions: Sequence[Rendition] = (),
+               executor: Optional[Executor] = None,
+               max_dimen: Optional[int] = None,
+               writer: Optional[Union[OutputWriter, ArchiveWriter]] = None,
+               backend: str = DEFAULT_BACKEND,
+               read_header: Callable[[str], ImageHeader] = read_image_header,
+               retries: int = 2, retry_delay: float = 1.0,
+               timeout: Optional[float] = None,
+               contact_sheet: Optional[ContactSheet] = None) \
+        -> Iterator[Tuple[Job, Future]]:
+    """Crop many files in parallel within a memory budget
+
+    Each file is cropped with
+    :py:meth:`batch_crop.backends.crop_with_backend`. If ``writer`` is given,
+    the workers only encode the outputs with
+    :py:meth:`batch_crop.backends.render`, and the outputs are handed to
+    ``writer`` in this process as each job finishes.
+
+    A file that fails does not stop the others: its error is reported through
+    its future. Transient I/O errors are first retried as described by
+    :py:meth:`call_with_retries`.
+
+    Args:
+        box_ratio: Region to crop. See :doc:`units`
+        paths: Pairs of input path and output path
+        budget: Bytes of memory the crops may use at once. Defaults to
+            :py:meth:`get_default_budget`.
+        max_workers: Number of crops that may run at once. Defaults to the
+            number of CPUs.
+        renditions: Downscaled copies of each crop to save as well
+        executor: Runs the crops. Defaults to a process pool.
+        max_dimen: If given, each crop is shrunk so that neither dimension
+            exceeds this
+        writer: Writes the outputs, for example in the background or to
+            archives
+        backend: Backend choice. See
+            :py:meth:`batch_crop.backends.parse_backend_spec`.
+        read_header: Reads an image's header to estimate its footprint
+        retries: Number of times to retry a file after a transient I/O error
+        retry_delay: Seconds to wait before the first retry
+        timeout: Seconds a file may take before it is given up on. See
+            :py:meth:`MemoryBudgetScheduler.run`.
+        contact_sheet: If given, each crop is added to it as its job
+            finishes, from memory if ``writer`` is given or else from disk
+
+    Returns:
+        Iterator of each job paired with its finished future. The future's
+        result is a :py:class:`batch_crop.backends.RenderResult` recording the
+        backend used, and its exception, if any, is that raised while
+        cropping.
+
+    """
+    if budget is None:
+        budget = get_default_budget()
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    scheduler = MemoryBudgetScheduler(budget, max_workers, executor)
+
+    def submit(job: Job) -> Future:
+        function = crop_with_backend if writer is None else render
+        return scheduler.executor.submit(
+            call_with_retries, function, retries, retry_delay, box_ratio,
+            job.in_path, job.out_path, renditions, max_dimen, backend)
+
+    for job, future in scheduler.run(make_jobs(paths, read_header), submit,
+                                     timeout):
+        hand_off_outputs(job, future, writer, contact_sheet)
+        yield job, future
+
+
+def hand_off_outputs(job: Job, future: Future,
+                     writer: Optional[Union[OutputWriter, ArchiveWriter]],
+                     contact_sheet: Optional[ContactSheet]) -> None:
+    """Pass a finished job's outputs on to the writer and contact sheet
+
+    Args:
+        job: The job
+        future: The job's finished future, whose result is a
+            :py:class:`batch_crop.backends.RenderResult`
+        writer: If given, writes the outputs held in the result
+        contact_sheet: If given, the crop is added to it, from memory if
+            ``writer`` is given or else from disk
+
+    Returns:
+        None
+
+    """
+    if future.exception() is not None:
+        return
+    outputs = future.result().outputs
+    if writer is not None:
+        for out_path, data in outputs:
+            writer.write(data, out_path, job.in_path)
+    if contact_sheet is not None:
+        label = os.path.basename(job.in_path)
+        if writer is not None:
+            contact_sheet.add(outputs[0][1], label)
+        else:
+            contact_sheet.add_file(job.out_path, label)
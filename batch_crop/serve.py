@@ -0,0 +1,341 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Serve crops over HTTP from a pool of warm workers
+
+The server keeps a pool of worker processes alive between requests, so each
+crop only pays for decoding and encoding rather than for starting Python and
+importing Pillow and rawpy. Recent results are kept in a least-recently-used
+cache keyed by the input's identity and the crop requested.
+
+Crops are requested from ``/crop`` with these query parameters:
+
+* ``box``: The ``box_ratio`` (see :doc:`units`) as ``x1,y1,x2,y2``
+* ``format``: Optional Pillow format name of the result. Defaults to ``jpeg``.
+* ``quality``: Optional encoder quality. Defaults to
+  :py:data:`batch_crop.batch_crop.DEFAULT_QUALITY`.
+* ``max``: Optional largest width or height of the result
+
+A ``GET`` request crops the file named by the ``path`` parameter, while a
+``POST`` request crops the image file sent as the request body. Cropping by
+path is only allowed when the server is given a root directory to serve
+files from, so that clients cannot read arbitrary files on the host.
+
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import cast, Hashable, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from batch_crop.api import crop_bytes, Source
+from batch_crop.batch_crop import DEFAULT_QUALITY
+
+
+# Largest request body accepted as an uploaded image, in bytes
+MAX_UPLOAD_BYTES = 256 * 1024 ** 2
+
+
+class CropCache:
+    """Thread-safe least-recently-used cache of encoded crops
+
+    Attributes:
+        max_entries (int): Number of crops to keep
+
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # type: OrderedDict
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        """Get a cached crop, marking it as recently used
+
+        Args:
+            key: Identifies the crop
+
+        Returns:
+            The encoded crop, or ``None`` if it is not cached
+
+        """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: Hashable, value: bytes) -> None:
+        """Cache a crop, evicting the least recently used if full
+
+        Args:
+            key: Identifies the crop
+            value: The encoded crop
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class CropRequestError(Exception):
+    """Raised when a crop request is malformed or not allowed
+
+    Attributes:
+        status (int): HTTP status code to respond with
+
+    """
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+def parse_box(text: str) -> Tuple[float, float, float, float]:
+    """Parse a ``box_ratio`` given as ``x1,y1,x2,y2``
+
+    >>> parse_box("0.1,0.2,0.5,0.6")
+    (0.1, 0.2, 0.5, 0.6)
+
+    Args:
+        text: The ``box_ratio``
+
+    Returns:
+        The parsed ``box_ratio``
+
+    Raises:
+        CropRequestError: If ``text`` is not four comma-separated numbers
+
+    """
+    try:
+        x1, y1, x2, y2 = (float(value) for value in text.split(","))
+    except ValueError:
+        raise CropRequestError(400, "box must be of the form x1,y1,x2,y2")
+    return x1, y1, x2, y2
+
+
+def warm_up() -> None:
+    """Do nothing, so that submitting this starts a worker process
+
+    Returns:
+        None
+
+    """
+
+
+class CropServer(ThreadingHTTPServer):
+    """HTTP server that crops images on a pool of workers
+
+    Attributes:
+        pool (Executor): Workers that crop the images
+        cache (CropCache): Recently produced crops
+        root (Optional[str]): Directory whose files may be cropped by path.
+            If ``None``, only uploaded images are cropped.
+
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, address: Tuple[str, int], pool: Executor,
+                 cache_size: int = 256, root: Optional[str] = None,
+                 workers: int = 0) -> None:
+        """Start listening on ``address``
+
+        Args:
+            address: ``(host, port)`` to listen on
+            pool: Workers that crop the images
+            cache_size: Number of crops to cache
+            root: Directory whose files may be cropped by path. If
+                ``None``, cropping by path is refused.
+            workers: Number of workers in ``pool`` to start ahead of the
+                first request
+
+        """
+        super().__init__(address, CropRequestHandler)
+        self.pool = pool
+        self.cache = CropCache(cache_size)
+        self.root = os.path.realpath(root) if root is not None else None
+        for future in [pool.submit(warm_up) for _ in range(workers)]:
+            future.result()
+
+    def check_path(self, path: str) -> str:
+        """Resolve a requested path and check that it may be cropped
+
+        Args:
+            path: The requested path. Relative paths are taken to be relative
+                to :py:attr:`root`.
+
+        Returns:
+            The resolved path
+
+        Raises:
+            CropRequestError: If no :py:attr:`root` is set, or if the path is
+                outside :py:attr:`root` or is not a file
+
+        """
+        if self.root is None:
+            raise CropRequestError(
+                403, "cropping by path requires the server to have a root")
+        resolved = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([self.root, resolved]) != self.root:
+            raise CropRequestError(403, "path is outside the served root")
+        if not os.path.isfile(resolved):
+            raise CropRequestError(404, "no such file")
+        return resolved
+
+
+class CropRequestHandler(BaseHTTPRequestHandler):
+    """Handle requests to a :py:class:`CropServer`"""
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        """Crop the file named by the ``path`` query parameter
+
+        Returns:
+            None
+
+        """
+        self._handle(upload=False)
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        """Crop the image file sent as the request body
+
+        Returns:
+            None
+
+        """
+        self._handle(upload=True)
+
+    # pylint: disable=too-many-locals
+    def _handle(self, upload: bool) -> None:
+        """Crop the requested image and send the result
+
+        Args:
+            upload: Whether the image is the request body rather than a path
+
+        Returns:
+            None
+
+        """
+        server = cast(CropServer, self.server)
+        try:
+            url = urlsplit(self.path)
+            if url.path != "/crop":
+                raise CropRequestError(404, "unknown endpoint")
+            query = {name: values[-1]
+                     for name, values in parse_qs(url.query).items()}
+            box_ratio = parse_box(query.get("box", ""))
+            image_format = query.get("format", "jpeg").lower()
+            try:
+                quality = int(query.get("quality", DEFAULT_QUALITY))
+                max_dimen = int(query["max"]) if "max" in query else None
+            except ValueError:
+                raise CropRequestError(400, "quality and max must be integers")
+
+            if upload:
+                body = self.rfile.read(self.read_length())
+                source = body  # type: Source
+                digest = hashlib.sha256(body).hexdigest()
+                identity = ("sha256", digest)  # type: Tuple[Hashable, ...]
+            else:
+                path = server.check_path(query.get("path", ""))
+                stat = os.stat(path)
+                source = path
+                identity = path, stat.st_size, stat.st_mtime_ns
+
+            key = identity, box_ratio, image_format, quality, max_dimen
+            result = server.cache.get(key)
+            cache_status = "hit"
+            if result is None:
+                cache_status = "miss"
+                try:
+                    result = server.pool.submit(
+                        crop_bytes, source, box_ratio, image_format, quality,
+                        max_dimen).result()
+                except Exception as error:  # pylint: disable=broad-except
+                    raise CropRequestError(422, "could not crop: {}".format(
+                        error))
+                server.cache.put(key, result)
+        except CropRequestError as error:
+            self.send_error(error.status, str(error))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/" + image_format)
+        self.send_header("Content-Length", str(len(result)))
+        self.send_header("X-Cache", cache_status)
+        self.end_headers()
+        self.wfile.write(result)
+
+    def read_length(self) -> int:
+        """Read the length of the request body from its headers
+
+        Returns:
+            The body's length in bytes
+
+        Raises:
+            CropRequestError: If the length is not a non-negative integer, or
+                if it exceeds :py:data:`MAX_UPLOAD_BYTES`
+
+        """
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            raise CropRequestError(400, "Content-Length must be an integer")
+        if length < 0:
+            raise CropRequestError(400, "Content-Length must not be negative")
+        if length > MAX_UPLOAD_BYTES:
+            raise CropRequestError(413, "uploads are limited to {} bytes"
+                                   .format(MAX_UPLOAD_BYTES))
+        return length
+
+
+def serve(host: str = "127.0.0.1", port: int = 8000,
+          workers: Optional[int] = None, cache_size: int = 256,
+          root: Optional[str] = None) -> None:
+    """Serve crops until interrupted
+
+    Args:
+        host: Address to listen on. Defaults to only the local machine.
+        port: Port to listen on
+        workers: Number of worker processes. Defaults to the number of CPUs.
+        cache_size: Number of crops to cache
+        root: Directory whose files may be cropped by path. If ``None``,
+            only uploaded images are cropped.
+
+    Returns:
+        None
+
+    """
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        server = CropServer((host, port), pool, cache_size, root, workers)
+        print("Serving crops on http://{}:{}/crop".format(
+            *server.server_address[:2]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
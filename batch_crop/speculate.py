@@ -0,0 +1,375 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Crop in the background while the user is still checking the selection
+
+A :py:class:`SpeculativeCropper` starts cropping as soon as a selection
+settles, staging the crops in a hidden directory next to where they will be
+saved. If the user then confirms the same region, each staged crop is moved
+into place with a single rename, and only the images not yet staged are left
+to crop.
+
+Crops are staged per region, and those of the last few regions
+(:py:data:`KEPT_REGIONS`) are kept. If the selection changes, crops that
+have not started are cancelled but those already staged stay, so going back
+to an earlier region reuses them. Older regions' crops are deleted.
+
+"""
+
+import itertools
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, wait
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, \
+    Set, Tuple
+
+from batch_crop.batch_crop import render_crop
+from batch_crop.quad import Region
+from batch_crop.writer import write_atomic
+
+
+# Name of the hidden directory, next to the outputs, that crops are staged in
+STAGING_DIR = ".batch_crop-staging"
+
+# Number of recent regions whose staged crops are kept
+KEPT_REGIONS = 3
+
+
+class StagedCrop(NamedTuple):
+    """A crop made ahead of time
+
+    Attributes:
+        region: Region the image was cropped to
+        mtime_ns: Modification time of the image when it was cropped
+        outputs: Pairs of the path each output is to be saved to and the
+            path it is staged at
+
+    """
+    region: Region
+    mtime_ns: int
+    outputs: List[Tuple[str, str]]
+
+
+def get_staged_path(path: str, slot: int = 0) -> str:
+    """Get where to stage the output that will be saved to ``path``
+
+    >>> get_staged_path("images/img1.ARW_cropped.jpg", 2)
+    'images/.batch_crop-staging/2/img1.ARW_cropped.jpg'
+
+    Args:
+        path: Path the output will be saved to
+        slot: Number identifying the region the output was cropped to, so
+            that crops of different regions do not overwrite each other
+
+    Returns:
+        The staging path, on the same file system so it can be renamed into
+        place
+
+    """
+    dir_path, name = os.path.split(path)
+    return os.path.join(dir_path, STAGING_DIR, str(slot), name)
+
+
+def stage_crop(region: Region, in_path: str, out_path: str,
+               slot: int = 0) -> List[Tuple[str, str]]:
+    """Crop an image and write the outputs to their staging paths
+
+    Args:
+        region: Region to crop. See :doc:`units`
+        in_path: Path of the image to crop
+        out_path: Path the crop will eventually be saved to
+        slot: Number identifying ``region``. See :py:meth:`get_staged_path`.
+
+    Returns:
+        Pairs of each output's final path and its staging path
+
+    """
+    outputs = []
+    for path, data in render_crop(region, in_path, out_path):
+        staged_path = get_staged_path(path, slot)
+        os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+        write_atomic(data, staged_path)
+        outputs.append((path, staged_path))
+    return outputs
+
+
+def remove_outputs(outputs: Sequence[Tuple[str, str]]) -> None:
+    """Delete staged outputs, ignoring any already gone
+
+    Args:
+        outputs: Pairs of final path and staging path
+
+    Returns:
+        None
+
+    """
+    for _, staged_path in outputs:
+        try:
+            os.remove(staged_path)
+        except FileNotFoundError:
+            pass
+
+
+class SpeculativeCropper:
+    """Stage crops in the background, ready to be committed on confirmation
+
+    Methods are meant to be called from one thread, such as the GUI's.
+
+    Attributes:
+        region (Optional[Region]): Region currently being staged
+
+    """
+
+    def __init__(self, max_workers: Optional[int] = None) -> None:
+        """Create a cropper with no work staged
+
+        Args:
+            max_workers: Number of images to crop at once. Defaults to the
+                number of CPUs.
+
+        """
+        self.region = None  # type: Optional[Region]
+        self._executor = ProcessPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        # Slot of each kept region, least recently staged first
+        self._regions = OrderedDict()  # type: OrderedDict
+        self._slots = itertools.count()
+        # Staged crops, by region and input path
+        self._staged = {}  # type: Dict[Tuple[Region, str], StagedCrop]
+        # Crops underway or waiting, by region and input path
+        self._pending = {}  # type: Dict[Tuple[Region, str], Future]
+        # Staging directories that may need removing
+        self._dirs = set()  # type: Set[str]
+
+    def stage(self, region: Region, jobs: Sequence[Tuple[str, str]]) -> None:
+        """Start cropping images to a region in the background
+
+        Crops of other regions that have not started are cancelled, but
+        those staged are kept for the last :py:data:`KEPT_REGIONS` regions.
+        Images already staged or underway for ``region`` are not cropped
+        again.
+
+        Args:
+            region: Region to crop. See :doc:`units`
+            jobs: Pairs of input path and output path
+
+        Returns:
+            None
+
+        """
+        if region != self.region:
+            self.pause()
+            self.region = region
+        slot = self._keep_region(region)
+        for in_path, out_path in jobs:
+            if (region, in_path) in self._pending or \
+                    self._is_staged(region, in_path, out_path):
+                continue
+            try:
+                mtime_ns = os.stat(in_path).st_mtime_ns
+            except OSError:
+                continue
+            self._dirs.add(os.path.join(os.path.dirname(out_path),
+                                        STAGING_DIR))
+            future = self._executor.submit(stage_crop, region, in_path,
+                                           out_path, slot)
+            self._pending[(region, in_path)] = future
+            future.add_done_callback(
+                lambda done, in_path=in_path, mtime_ns=mtime_ns:
+                self._finish(region, in_path, mtime_ns, done))
+
+    def _keep_region(self, region: Region) -> int:
+        """Mark a region as the most recent, forgetting the oldest if needed
+
+        Args:
+            region: The region
+
+        Returns:
+            The region's slot. See :py:meth:`get_staged_path`.
+
+        """
+        with self._lock:
+            if region in self._regions:
+                self._regions.move_to_end(region)
+                return self._regions[region]
+            self._regions[region] = next(self._slots)
+            forgotten = []
+            while len(self._regions) > KEPT_REGIONS:
+                forgotten.append(self._regions.popitem(last=False)[0])
+        for old_region in forgotten:
+            self._forget(lambda key, old=old_region: key[0] == old)
+        return self._regions[region]
+
+    def _forget(self, matches: Callable[[Tuple[Region, str]], bool]) \
+            -> None:
+        """Cancel crops and delete staged outputs for some images
+
+        Crops already underway are deleted once they finish.
+
+        Args:
+            matches: Called with each ``(region, in_path)`` key, returning
+                whether to forget it
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            pending = [self._pending.pop(key) for key in list(self._pending)
+                       if matches(key)]
+            staged = [self._staged.pop(key) for key in list(self._staged)
+                      if matches(key)]
+        for future in pending:
+            future.cancel()
+        for crop in staged:
+            remove_outputs(crop.outputs)
+
+    def _finish(self, region: Region, in_path: str, mtime_ns: int,
+                future: Future) -> None:
+        """Record a finished crop, or delete it if no longer wanted
+
+        Args:
+            region: Region the image was cropped to
+            in_path: Path of the image
+            mtime_ns: Modification time of the image when it was submitted
+            future: The finished crop, from :py:meth:`stage_crop`
+
+        Returns:
+            None
+
+        """
+        key = (region, in_path)
+        if future.cancelled() or future.exception() is not None:
+            with self._lock:
+                if self._pending.get(key) is future:
+                    del self._pending[key]
+            return
+        outputs = future.result()
+        with self._lock:
+            current = self._pending.get(key) is future
+            if current:
+                del self._pending[key]
+                self._staged[key] = StagedCrop(region, mtime_ns, outputs)
+        if not current:
+            remove_outputs(outputs)
+
+    def _is_staged(self, region: Region, in_path: str, out_path: str) \
+            -> bool:
+        """Check whether an image is staged for a region, unchanged
+
+        Args:
+            region: The region
+            in_path: Path of the image
+            out_path: Path its crop is to be saved to
+
+        Returns:
+            ``True`` if the staged crop can be committed
+
+        """
+        with self._lock:
+            staged = self._staged.get((region, in_path))
+        if staged is None or staged.outputs[0][0] != out_path:
+            return False
+        try:
+            return os.stat(in_path).st_mtime_ns == staged.mtime_ns
+        except OSError:
+            return False
+
+    def pause(self) -> None:
+        """Cancel crops that have not started, keeping those staged
+
+        Call this when the user starts changing the selection, so the
+        workers are free once it settles.
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            pending = list(self._pending.items())
+        for key, future in pending:
+            if future.cancel():
+                with self._lock:
+                    if self._pending.get(key) is future:
+                        del self._pending[key]
+
+    def wait(self) -> None:
+        """Wait for every crop underway to be staged
+
+        Returns:
+            None
+
+        """
+        with self._lock:
+            pending = list(self._pending.values())
+        wait(pending)
+
+    def commit(self, region: Region, jobs: Sequence[Tuple[str, str]]) \
+            -> List[Tuple[str, str]]:
+        """Move staged crops into place for the confirmed region
+
+        Crops that have not started are cancelled, and those underway are
+        waited for, so the caller can crop the rest without duplicating work.
+
+        Args:
+            region: The confirmed region
+            jobs: Pairs of input path and output path to save
+
+        Returns:
+            The jobs that were not staged and still need to be cropped
+
+        """
+        self.pause()
+        self.wait()
+        remaining = []
+        for in_path, out_path in jobs:
+            if not self._is_staged(region, in_path, out_path):
+                remaining.append((in_path, out_path))
+                continue
+            with self._lock:
+                staged = self._staged.pop((region, in_path))
+            for path, staged_path in staged.outputs:
+                os.replace(staged_path, path)
+        return remaining
+
+    def discard(self) -> None:
+        """Cancel all crops and delete every staged output
+
+        Crops already underway are deleted once they finish.
+
+        Returns:
+            None
+
+        """
+        self._forget(lambda key: True)
+        with self._lock:
+            self._regions.clear()
+        self.region = None
+
+    def close(self) -> None:
+        """Discard all work, stop the workers, and remove staging directories
+
+        Returns:
+            None
+
+        """
+        self.discard()
+        self._executor.shutdown(wait=True)
+        for dir_path in self._dirs:
+            shutil.rmtree(dir_path, ignore_errors=True)
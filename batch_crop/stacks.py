@@ -0,0 +1,353 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Crop every frame of multi-frame images and numbered image sequences
+
+:py:meth:`batch_crop.batch_crop.crop_image` crops only the first frame of an
+image. Here, every frame of a multi-frame TIFF or GIF is cropped. If asked,
+every file of a numbered sequence such as ``z0001.tif``, ``z0002.tif``, and
+so on is cropped too, with the sequence treated as one stack. Only runs of
+consecutive numbers whose images have the same dimensions form a sequence.
+Frames are decoded, cropped, and written one at a time, so stacks of
+thousands of planes never need to fit in memory.
+
+Stacks are saved as multi-frame TIFFs, except that GIF inputs are saved as
+GIFs so that their animation is kept. Pillow's GIF encoder holds all frames
+until it finishes, so only TIFF output is fully streamed.
+
+"""
+
+import os
+import re
+import tempfile
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, \
+    Sequence, Tuple
+
+from PIL import Image, ImageSequence, TiffImagePlugin
+
+from batch_crop.batch_crop import crop_image, downscale_image, \
+    is_crop_output, open_image, read_image_header
+from batch_crop.quad import Region
+
+
+# Reads the dimensions of an image, or gives None if they cannot be read
+SizeReader = Callable[[str], Optional[Tuple[int, int]]]
+
+# Matches file names ending in a frame number, capturing the text before the
+# number, the number, and the extension
+SEQUENCE_PATTERN = re.compile(r"^(.*?)(\d+)(\.[^.]+)$")
+
+
+def is_multi_frame(path: str) -> bool:
+    """Check whether an image file holds more than one frame
+
+    Only the header is read.
+
+    Args:
+        path: Path to the image
+
+    Returns:
+        ``True`` if the image has several frames
+
+    """
+    try:
+        with Image.open(path) as image:
+            return getattr(image, "n_frames", 1) > 1
+    except OSError:
+        return False
+
+
+def iter_frames(paths: Sequence[str]) -> Iterator[Image.Image]:
+    """Decode the frames of images one at a time
+
+    Each frame is only valid until the next is requested.
+
+    Args:
+        paths: Images whose frames to decode, in order. Multi-frame images
+            contribute all their frames.
+
+    Returns:
+        Iterator of the frames
+
+    """
+    for path in paths:
+        image = open_image(path)  # type: Image.Image
+        with image:
+            yield from ImageSequence.Iterator(image)
+
+
+def crop_frames(box_ratio: Region,
+                frames: Iterable[Image.Image],
+                max_dimen: Optional[int] = None) -> Iterator[Image.Image]:
+    """Crop frames one at a time
+
+    Palette frames, as in most GIFs, are converted to RGB before shrinking
+    so that they can be resampled.
+
+    Args:
+        box_ratio: Region to crop. See :doc:`units`
+        frames: The frames to crop
+        max_dimen: If given, each crop is shrunk so that neither dimension
+            exceeds this
+
+    Returns:
+        Iterator of the cropped frames
+
+    """
+    for frame in frames:
+        cropped = crop_image(box_ratio, frame)
+        if max_dimen is not None:
+            if cropped.mode == "P":
+                cropped = cropped.convert(
+                    "RGBA" if "transparency" in cropped.info else "RGB")
+            cropped = downscale_image(cropped, max_dimen)
+        yield cropped
+
+
+def save_frames(frames: Iterator[Image.Image], out_path: str) -> int:
+    """Save frames as one multi-frame image, replacing ``out_path`` at once
+
+    The format is chosen by the extension of ``out_path``: GIF for ``.gif``
+    and TIFF otherwise. TIFF frames are appended to the file one at a time.
+
+    Args:
+        frames: The frames to save
+        out_path: Where to save them
+
+    Returns:
+        The number of frames saved
+
+    """
+    dir_path, name = os.path.split(os.path.abspath(out_path))
+    fd, temp_path = tempfile.mkstemp(dir=dir_path, prefix="." + name + ".",
+                                     suffix=".tmp")
+    os.close(fd)
+    count = 0
+    try:
+        if out_path.lower().endswith(".gif"):
+            counted = _count(frames)
+            first = next(counted)
+            first.save(temp_path, "GIF", save_all=True,
+                       append_images=counted,
+                       loop=first.info.get("loop", 0))
+            count = counted.count
+        else:
+            with TiffImagePlugin.AppendingTiffWriter(temp_path, True) as tiff:
+                for frame in frames:
+                    frame.save(tiff, "TIFF")
+                    tiff.newFrame()
+                    count += 1
+        os.replace(temp_path, out_path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return count
+
+
+class _count:  # pylint: disable=invalid-name,too-few-public-methods
+    """Iterator that counts the items passed through it"""
+
+    def __init__(self, items: Iterator) -> None:
+        self._items = items
+        self.count = 0
+
+    def __iter__(self) -> "_count":
+        return self
+
+    def __next__(self):
+        item = next(self._items)
+        self.count += 1
+        return item
+
+
+def crop_stack(box_ratio: Region,
+               in_paths: Sequence[str], out_path: str,
+               max_dimen: Optional[int] = None) -> int:
+    """Crop every frame of a stack and save the crops as one image
+
+    Args:
+        box_ratio: Region to crop. See :doc:`units`
+        in_paths: The multi-frame image, or the images of a numbered
+            sequence in order
+        out_path: Where to save the cropped stack. See
+            :py:meth:`save_frames`.
+        max_dimen: If given, each crop is shrunk so that neither dimension
+            exceeds this
+
+    Returns:
+        The number of frames cropped
+
+    """
+    return save_frames(crop_frames(box_ratio, iter_frames(in_paths),
+                                   max_dimen), out_path)
+
+
+def group_sequences(paths: Sequence[str],
+                    get_size: Optional[SizeReader] = None) -> List[List[str]]:
+    """Group the files of numbered sequences together
+
+    Files in the same directory whose names differ only in a consecutive
+    trailing number form a sequence, ordered by that number. A gap in the
+    numbering, or a change in dimensions if ``get_size`` is given, starts a
+    new sequence. Other files are left alone.
+
+    >>> group_sequences(["z2.tif", "z10.tif", "z1.tif", "z3.tif", "a.tif"])
+    [['a.tif'], ['z1.tif', 'z2.tif', 'z3.tif'], ['z10.tif']]
+
+    Args:
+        paths: Paths of the files
+        get_size: Gets the dimensions of an image, or ``None`` if they cannot
+            be read
+
+    Returns:
+        Each sequence, or single file, as a list of paths
+
+    """
+    groups = defaultdict(list)  # type: Dict[Tuple[str, ...], List[str]]
+    for path in paths:
+        dir_path, name = os.path.split(path)
+        match = SEQUENCE_PATTERN.match(name)
+        if match is None:
+            groups[(path,)].append(path)
+        else:
+            prefix, _, ext = match.groups()
+            groups[(dir_path, prefix, ext.lower())].append(path)
+
+    stacks = []  # type: List[List[str]]
+    for key, members in groups.items():
+        if len(key) == 1:
+            stacks.append(members)
+            continue
+        number = None  # type: Optional[int]
+        size = None  # type: Optional[Tuple[int, int]]
+        for path in sorted(members, key=_frame_number):
+            next_number = _frame_number(path)
+            next_size = get_size(path) if get_size is not None else None
+            if number is None or next_number != number + 1 or \
+                    next_size != size:
+                stacks.append([])
+            stacks[-1].append(path)
+            number, size = next_number, next_size
+    return sorted(stacks)
+
+
+def _frame_number(path: str) -> int:
+    """Get the trailing number of a sequence file's name
+
+    Args:
+        path: Path of the file
+
+    Returns:
+        The number
+
+    """
+    return int(_split_sequence_name(os.path.basename(path))[1])
+
+
+def _split_sequence_name(name: str) -> Tuple[str, str, str]:
+    """Split a sequence file's name around its frame number
+
+    Args:
+        name: Name of the file
+
+    Returns:
+        The text before the number, the number, and the extension
+
+    Raises:
+        ValueError: If the name does not end in a frame number
+
+    """
+    match = SEQUENCE_PATTERN.match(name)
+    if match is None:
+        raise ValueError("{} is not part of a sequence".format(name))
+    prefix, number, ext = match.groups()
+    return prefix, number, ext
+
+
+def _get_size(path: str) -> Optional[Tuple[int, int]]:
+    """Get the dimensions of an image from its header
+
+    Args:
+        path: Path of the image
+
+    Returns:
+        The dimensions, or ``None`` if the header cannot be read
+
+    """
+    try:
+        return read_image_header(path).size
+    except OSError:
+        return None
+
+
+def get_stack_output_path(in_paths: Sequence[str]) -> str:
+    """Get the path to save a cropped stack to
+
+    >>> get_stack_output_path(["anim.gif"])
+    'anim.gif_cropped.gif'
+    >>> get_stack_output_path(["z0001.tif", "z0002.tif", "z0003.tif"])
+    'z0001-0003.tif_cropped.tif'
+
+    Args:
+        in_paths: The multi-frame image, or the images of a numbered
+            sequence in order
+
+    Returns:
+        The output path, next to the first input
+
+    """
+    first = in_paths[0]
+    if len(in_paths) > 1:
+        dir_path, name = os.path.split(first)
+        prefix, number, ext = _split_sequence_name(name)
+        last = _split_sequence_name(os.path.basename(in_paths[-1]))[1]
+        first = os.path.join(dir_path, "{}{}-{}{}".format(prefix, number,
+                                                          last, ext))
+    out_ext = ".gif" if first.lower().endswith(".gif") else ".tif"
+    return first + "_cropped" + out_ext
+
+
+def list_stacks(dir_path: str, extension: str, sequences: bool = False) \
+        -> List[Tuple[List[str], str]]:
+    """List the stacks to crop in a directory
+
+    Multi-frame images are stacks, as are numbered sequences (see
+    :py:meth:`group_sequences`) if ``sequences`` is set. Other files are
+    skipped.
+
+    Args:
+        dir_path: Directory to search. Subdirectories are not searched.
+        extension: Lower-case extension, including the leading ``.``
+        sequences: Whether numbered sequences are stacks. Off by default,
+            since cameras also number their files.
+
+    Returns:
+        Pairs of the stack's input paths and its output path
+
+    """
+    names = sorted(name for name in os.listdir(dir_path)
+                   if name.lower().endswith(extension)
+                   and not is_crop_output(name))
+    paths = [os.path.join(dir_path, name) for name in names]
+    groups = group_sequences(paths, _get_size) if sequences \
+        else [[path] for path in paths]
+    stacks = []
+    for in_paths in groups:
+        if len(in_paths) > 1 or is_multi_frame(in_paths[0]):
+            stacks.append((in_paths, get_stack_output_path(in_paths)))
+    return stacks
@@ -0,0 +1,322 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Watch directories and crop images as they arrive
+
+New files are noticed either through inotify (when the optional
+``inotify_simple`` package is installed) or by periodically scanning the
+watched directories. A file is only cropped once its size and modification
+time have stopped changing for a settling period, so files that are still
+being written are not read half-finished.
+
+"""
+
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from batch_crop.batch_crop import crop_file, is_crop_output, Rendition
+from batch_crop.quad import Region
+
+try:
+    import inotify_simple  # type: ignore
+except ImportError:  # pragma: no cover
+    inotify_simple = None
+
+
+def is_crop_candidate(name: str, extension: str) -> bool:
+    """Check whether a file name should be cropped
+
+    Outputs of previous crops are never candidates, even if they happen to
+    share ``extension``.
+
+    >>> is_crop_candidate("img1.ARW", ".arw")
+    True
+    >>> is_crop_candidate("img1.jpg_cropped.jpg", ".jpg")
+    False
+
+    Args:
+        name: Name or path of the file
+        extension: Lower-case extension, including the leading ``.``, of
+            files to crop
+
+    Returns:
+        ``True`` if the file should be cropped, ``False`` otherwise
+
+    """
+    return name.lower().endswith(extension) and not is_crop_output(name)
+
+
+class Debouncer:
+    """Track files until they stop changing
+
+    Attributes:
+        settle_time (float): Seconds for which a file's size and modification
+            time must remain unchanged before it is considered complete
+        pending (Dict[str, Tuple[Tuple[int, int], float]]): Maps each tracked
+            path to its last seen ``(size, mtime_ns)`` and the time at which
+            that state was first observed
+
+    """
+
+    def __init__(self, settle_time: float) -> None:
+        self.settle_time = settle_time
+        self.pending = {}  # type: Dict[str, Tuple[Tuple[int, int], float]]
+
+    def update(self, path: str, stat: os.stat_result, now: float) -> None:
+        """Record the current state of a file
+
+        Args:
+            path: Path to the file
+            stat: Result of calling ``os.stat`` on ``path``
+            now: Current time, as returned by ``time.monotonic``
+
+        Returns:
+            None
+
+        """
+        state = stat.st_size, stat.st_mtime_ns
+        previous = self.pending.get(path)
+        if previous is None or previous[0] != state:
+            self.pending[path] = state, now
+
+    def forget(self, path: str) -> None:
+        """Stop tracking a file
+
+        Args:
+            path: Path to the file
+
+        Returns:
+            None
+
+        """
+        self.pending.pop(path, None)
+
+    def ready(self, now: float) -> List[str]:
+        """Get and stop tracking the files that have settled
+
+        Empty files are never considered settled because they are usually
+        placeholders that a writer has created but not yet filled.
+
+        Args:
+            now: Current time, as returned by ``time.monotonic``
+
+        Returns:
+            Paths of the settled files
+
+        """
+        settled = [path for path, ((size, _), since) in self.pending.items()
+                   if size > 0 and now - since >= self.settle_time]
+        for path in settled:
+            del self.pending[path]
+        return settled
+
+
+class CropWatcher:
+    """Crop new files that appear in a set of directories
+
+    Attributes:
+        dirs (List[str]): Directories to watch
+        box_ratio (Region): Region to crop. See
+            :doc:`units`
+        extension (str): Lower-case extension of files to crop
+        renditions (Sequence[Rendition]): Downscaled copies to save of each
+            crop
+        poll_interval (float): Seconds between checks for new files
+        debouncer (Debouncer): Tracks files that are still being written
+        seen (Set[str]): Paths that have already been cropped or were
+            present when watching started
+        queue (List[str]): Settled files waiting for a free worker
+        in_flight (Dict[str, Future]): Crops that are currently running
+        max_in_flight (int): Number of crops that may be queued or running
+            at once. Settled files beyond this limit wait in :py:attr:`queue`.
+        executor (ThreadPoolExecutor): Workers that perform the crops
+
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, dirs: Iterable[str],
+                 box_ratio: Region,
+                 extension: str, settle_time: float = 2.0,
+                 poll_interval: float = 1.0, max_workers: int = 4,
+                 process_existing: bool = False,
+                 use_inotify: bool = True,
+                 renditions: Sequence[Rendition] = ()) -> None:
+        """Prepare to watch ``dirs``
+
+        Args:
+            dirs: Directories to watch
+            box_ratio: Region to crop. See :doc:`units`
+            extension: Extension of files to crop. Compared case-insensitively.
+            settle_time: Seconds a file must remain unchanged before cropping
+            poll_interval: Seconds between checks for new files
+            max_workers: Number of files to crop concurrently
+            process_existing: Whether to also crop files that are already
+                present and have not been cropped yet
+            use_inotify: Whether to use inotify if it is available
+            renditions: Downscaled copies to save of each crop
+
+        """
+        self.dirs = [os.path.abspath(path) for path in dirs]
+        self.box_ratio = box_ratio
+        self.extension = extension.lower()
+        self.renditions = renditions
+        self.poll_interval = poll_interval
+        self.debouncer = Debouncer(settle_time)
+        self.seen = set()  # type: Set[str]
+        self.queue = []  # type: List[str]
+        self.in_flight = {}  # type: Dict[str, Future]
+        self.max_in_flight = max_workers * 2
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._inotify = None
+        self._watch_dirs = {}  # type: Dict[int, str]
+
+        if use_inotify and inotify_simple is not None:
+            flags = inotify_simple.flags
+            mask = flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | \
+                flags.MOVED_TO
+            self._inotify = inotify_simple.INotify()
+            for path in self.dirs:
+                self._watch_dirs[self._inotify.add_watch(path, mask)] = path
+
+        now = time.monotonic()
+        for path in self.scan():
+            if process_existing and not os.path.exists(path + "_cropped.jpg"):
+                self.debouncer.update(path, os.stat(path), now)
+            else:
+                self.seen.add(path)
+
+    def scan(self) -> List[str]:
+        """List the paths of all candidate files in the watched directories
+
+        Returns:
+            Paths of files matching :py:attr:`extension`
+
+        """
+        found = []  # type: List[str]
+        for dir_path in self.dirs:
+            with os.scandir(dir_path) as entries:
+                found.extend(entry.path for entry in entries
+                             if entry.is_file() and
+                             is_crop_candidate(entry.name, self.extension))
+        return found
+
+    def changed_paths(self, timeout: float) -> List[str]:
+        """Wait for and return paths that may have changed
+
+        With inotify, this blocks until an event arrives or ``timeout``
+        elapses. Otherwise, it sleeps for ``timeout`` and re-scans.
+
+        Args:
+            timeout: Maximum number of seconds to wait
+
+        Returns:
+            Paths of candidate files that may be new or modified
+
+        """
+        if self._inotify is None:
+            time.sleep(timeout)
+            return self.scan()
+        events = self._inotify.read(timeout=int(timeout * 1000))
+        return [os.path.join(self._watch_dirs[event.wd], event.name)
+                for event in events
+                if is_crop_candidate(event.name, self.extension)]
+
+    def step(self, timeout: Optional[float] = None) -> List[str]:
+        """Check once for new files and submit the settled ones for cropping
+
+        Args:
+            timeout: Seconds to wait for changes. Defaults to
+                :py:attr:`poll_interval`.
+
+        Returns:
+            Paths of the files submitted for cropping
+
+        """
+        if timeout is None:
+            timeout = self.poll_interval
+        self._reap()
+
+        candidates = set(self.changed_paths(timeout))
+        now = time.monotonic()
+        # Files still settling must be re-examined even without new events
+        candidates.update(self.debouncer.pending)
+        for path in candidates - self.seen:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self.debouncer.forget(path)
+                continue
+            self.debouncer.update(path, stat, now)
+
+        self.queue.extend(self.debouncer.ready(now))
+        self.seen.update(self.queue)
+
+        submitted = []
+        while self.queue and len(self.in_flight) < self.max_in_flight:
+            path = self.queue.pop(0)
+            self.in_flight[path] = self.executor.submit(
+                crop_file, self.box_ratio, path, path + "_cropped.jpg",
+                self.renditions)
+            submitted.append(path)
+        return submitted
+
+    def _reap(self) -> None:
+        """Remove finished crops from :py:attr:`in_flight`
+
+        Failed crops are reported but not retried.
+
+        Returns:
+            None
+
+        """
+        for path, future in list(self.in_flight.items()):
+            if not future.done():
+                continue
+            del self.in_flight[path]
+            error = future.exception()
+            if error is not None:
+                print("Failed to crop '{}': {}".format(path, error))
+
+    def run(self) -> None:
+        """Watch and crop until interrupted
+
+        Returns:
+            None
+
+        """
+        try:
+            while True:
+                for path in self.step():
+                    print("Cropping '{}'".format(path))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Wait for running crops and release resources
+
+        Returns:
+            None
+
+        """
+        self.executor.shutdown(wait=True)
+        self._reap()
+        if self._inotify is not None:
+            self._inotify.close()
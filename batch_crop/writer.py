@@ -0,0 +1,338 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Write output files atomically, in the background
+
+Outputs are first written to a hidden temporary file in the target directory
+and then renamed over the final path. A crash therefore never leaves a
+truncated file at the final path, which would otherwise look like a finished
+crop to the "already exists" checks.
+
+How often the data is flushed to disk with ``fsync`` is set by a policy:
+
+* ``file``: Before each file is renamed into place. Safest and slowest.
+* ``batch``: Once per batch of files. The files of a batch only appear at
+  their final paths once the whole batch has been flushed.
+* ``never``: Left to the operating system. A crash may lose recent outputs,
+  but those that appear are still complete.
+
+"""
+
+import os
+import queue
+import tempfile
+import threading
+import time
+from typing import List, NamedTuple, Optional, Tuple
+
+
+# Accepted values for the fsync policy of OutputWriter
+FSYNC_POLICIES = ("file", "batch", "never")
+
+
+class WriteStats(NamedTuple):
+    """Totals of the data written by an :py:class:`OutputWriter`
+
+    Attributes:
+        files: Number of files written
+        bytes: Number of bytes written
+        seconds: Time spent writing, flushing, and renaming
+
+    """
+    files: int
+    bytes: int
+    seconds: float
+
+    @property
+    def throughput(self) -> float:
+        """Bytes written per second spent writing"""
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return "Wrote {} files ({:.1f} MB) at {:.1f} MB/s".format(
+            self.files, self.bytes / 1e6, self.throughput / 1e6)
+
+
+def write_temporary(data: bytes, path: str, fsync: bool) -> Tuple[str, int]:
+    """Write data to a new temporary file next to ``path``
+
+    Args:
+        data: The data to write
+        path: The final path the data is destined for
+        fsync: Whether to flush the data to disk before returning
+
+    Returns:
+        The path of the temporary file and its still-open file descriptor
+
+    """
+    dir_path, name = os.path.split(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=dir_path, prefix="." + name + ".",
+                                     suffix=".tmp")
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        if fsync:
+            os.fsync(fd)
+    except BaseException:
+        os.close(fd)
+        os.unlink(temp_path)
+        raise
+    return temp_path, fd
+
+
+def fsync_dir(dir_path: str) -> None:
+    """Flush a directory's entries, such as renames, to disk
+
+    Not all platforms allow opening directories, in which case this does
+    nothing.
+
+    Args:
+        dir_path: The directory
+
+    Returns:
+        None
+
+    """
+    try:
+        fd = os.open(dir_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_atomic(data: bytes, path: str, fsync: bool = False) -> None:
+    """Replace the file at ``path`` with ``data`` in a single step
+
+    Args:
+        data: The data to write
+        path: Where to write it
+        fsync: Whether to flush the file and its directory entry to disk
+
+    Returns:
+        None
+
+    """
+    temp_path, fd = write_temporary(data, path, fsync)
+    os.close(fd)
+    os.replace(temp_path, path)
+    if fsync:
+        fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+def name_source(error: OSError, source: Optional[str]) -> OSError:
+    """Mention the input an output was made from in a write error
+
+    >>> print(name_source(FileNotFoundError(2, "No such file", "out.jpg"),
+    ...                   "in.jpg"))
+    [Errno 2] No such file (cropping 'in.jpg'): 'out.jpg'
+
+    Args:
+        error: The error raised while writing the output
+        source: Path of the input, if known
+
+    Returns:
+        An error of the same type naming ``source``, or ``error`` itself if
+        ``source`` is ``None``
+
+    """
+    if source is None or error.errno is None:
+        return error
+    named = type(error)(error.errno, "{} (cropping '{}')".format(
+        error.strerror, source), error.filename)
+    named.__cause__ = error
+    return named
+
+class OutputWriter:
+    """Write files atomically on a background thread
+
+    Callers hand over encoded data with :py:meth:`write` and carry on while
+    this writes it out. At most ``queue_size`` files wait to be written, after
+    which :py:meth:`write` blocks so memory use stays bounded.
+
+    Attributes:
+        fsync (str): The fsync policy, one of :py:data:`FSYNC_POLICIES`
+        batch_size (int): Number of files per batch under the ``batch``
+            policy
+
+    """
+
+    def __init__(self, fsync: str = "batch", batch_size: int = 64,
+                 queue_size: int = 16) -> None:
+        """Start the writer thread
+
+        Args:
+            fsync: The fsync policy, one of :py:data:`FSYNC_POLICIES`
+            batch_size: Number of files per batch under the ``batch`` policy
+            queue_size: Number of files that may wait to be written
+
+        Raises:
+            ValueError: If ``fsync`` is not a known policy
+
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy '{}'".format(fsync))
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=queue_size)  # type: queue.Queue
+        self._batch = []  # type: List[Tuple[str, int, str]]
+        self._files = 0
+        self._bytes = 0
+        self._seconds = 0.0
+        self._error = None  # type: Optional[BaseException]
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, data: bytes, path: str, source: Optional[str] = None) \
+            -> None:
+        """Queue data to be written to ``path``
+
+        Args:
+            data: The data to write
+            path: Where to write it. Any existing file is replaced.
+            source: Path of the input the data was made from, if any. A
+                failure to write the data names this input.
+
+        Returns:
+            None
+
+        Raises:
+            OSError: If an earlier write failed
+
+        """
+        self._raise_error()
+        self._queue.put((data, path, source))
+
+    def close(self) -> WriteStats:
+        """Finish writing all queued files and stop the writer thread
+
+        Returns:
+            Totals of the data written
+
+        Raises:
+            OSError: If any write failed
+
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+        return self.stats()
+
+    def stats(self) -> WriteStats:
+        """Get totals of the data written so far
+
+        Returns:
+            The totals
+
+        """
+        return WriteStats(self._files, self._bytes, self._seconds)
+
+    def __enter__(self) -> "OutputWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def _run(self) -> None:
+        """Write queued files until :py:meth:`close` is called
+
+        After a failure of any kind, remaining files are discarded so that
+        callers can notice the error promptly, but the queue keeps being
+        drained so that :py:meth:`write` never blocks on a dead thread.
+
+        Returns:
+            None
+
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue
+            data, path, source = item
+            start = time.perf_counter()
+            try:
+                self._write_one(data, path)
+            except OSError as error:
+                self._error = name_source(error, source)
+            except Exception as error:  # pylint: disable=broad-except
+                self._error = error
+            self._seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        try:
+            self._flush_batch()
+        except Exception as error:  # pylint: disable=broad-except
+            self._error = self._error or error
+        self._seconds += time.perf_counter() - start
+
+    def _write_one(self, data: bytes, path: str) -> None:
+        """Write one file according to the fsync policy
+
+        Args:
+            data: The data to write
+            path: Where to write it
+
+        Returns:
+            None
+
+        """
+        temp_path, fd = write_temporary(data, path, self.fsync == "file")
+        self._files += 1
+        self._bytes += len(data)
+        if self.fsync == "batch":
+            self._batch.append((temp_path, fd, path))
+            if len(self._batch) >= self.batch_size:
+                self._flush_batch()
+            return
+        os.close(fd)
+        os.replace(temp_path, path)
+        if self.fsync == "file":
+            fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+    def _flush_batch(self) -> None:
+        """Flush the current batch to disk and rename it into place
+
+        Returns:
+            None
+
+        """
+        batch, self._batch = self._batch, []
+        try:
+            for _, fd, _ in batch:
+                os.fsync(fd)
+        except OSError:
+            for temp_path, _, _ in batch:
+                os.unlink(temp_path)
+            raise
+        finally:
+            for _, fd, _ in batch:
+                os.close(fd)
+        for temp_path, _, path in batch:
+            os.replace(temp_path, path)
+        for dir_path in {os.path.dirname(os.path.abspath(path))
+                         for _, _, path in batch}:
+            fsync_dir(dir_path)
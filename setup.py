@@ -9,5 +9,6 @@ setup(
     author='U8N WXD',
     author_email='cs.temporary@icloud.com',
     description='A Python utility for batch cropping images',
-    install_requires=['rawpy', 'Pillow']
+    python_requires='>=3.8',
+    install_requires=['rawpy', 'Pillow>=9.2']
 )
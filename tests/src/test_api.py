@@ -0,0 +1,61 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=missing-docstring
+
+
+import io
+
+import numpy as np
+from PIL import Image
+
+from batch_crop.api import crop_bytes, crop_many, crop_to_buffer
+
+
+TEST_RES = "tests/res/"
+
+
+def read_test_image() -> bytes:
+    with open(TEST_RES + "image.JPG", "rb") as f:
+        return f.read()
+
+
+def test_crop_bytes():
+    cropped = crop_bytes(read_test_image(), (0, 0, 0.5, 0.5), "png")
+    with Image.open(io.BytesIO(cropped)) as image:
+        assert image.format == "PNG"
+        assert image.size == (130, 92)
+
+
+def test_crop_file_object_and_array():
+    with open(TEST_RES + "image.JPG", "rb") as f:
+        buffer = crop_to_buffer(f, (0, 0, 1, 1), max_dimen=100)
+    with Image.open(buffer) as image:
+        assert image.size == (100, 71)
+
+    pixels = np.zeros((10, 20, 3), dtype=np.uint8)
+    with Image.open(crop_to_buffer(pixels, (0.5, 0, 1, 1))) as image:
+        assert image.size == (10, 10)
+
+
+def test_crop_many_preserves_order():
+    widths = [40, 10, 30, 20]
+    sources = [np.zeros((10, width, 3), dtype=np.uint8) for width in widths]
+    crops = list(crop_many(sources, (0, 0, 0.5, 1), max_workers=2))
+    assert len(crops) == len(widths)
+    for width, cropped in zip(widths, crops):
+        with Image.open(io.BytesIO(cropped)) as image:
+            assert image.size == (width // 2, 10)
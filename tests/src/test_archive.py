@@ -0,0 +1,145 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=missing-docstring
+
+
+import json
+import tarfile
+import zipfile
+
+import pytest
+from PIL import Image
+
+from batch_crop.archive import ArchiveWriter, list_archive_members, \
+    open_compressed_tar, read_archive_index, OPEN_COMPRESSED_TARS
+from batch_crop.batch_crop import crop_file, open_image, read_image_header
+
+
+TEST_RES = "tests/res/"
+
+
+def test_tar_shards_by_member_count(tmpdir):
+    base = str(tmpdir.join("crops"))
+    with ArchiveWriter(base, "tar", max_members=2) as writer:
+        for i in range(5):
+            writer.write(b"x" * i, "/in/{}.jpg".format(i),
+                         source="/in/{}.raw".format(i))
+
+    with open(base + ".index.json") as f:
+        index = json.load(f)
+    assert index["shards"] == ["crops-00000.tar", "crops-00001.tar",
+                               "crops-00002.tar"]
+    assert index["inputs"]["/in/3.raw"] == [
+        {"archive": "crops-00001.tar", "member": "3.jpg"}]
+    with tarfile.open(base + "-00001.tar") as archive:
+        assert archive.getnames() == ["2.jpg", "3.jpg"]
+        assert archive.extractfile("3.jpg").read() == b"xxx"
+
+
+def test_zip_shards_by_size(tmpdir):
+    base = str(tmpdir.join("crops"))
+    with ArchiveWriter(base, "zip", max_bytes=10, root="/in") as writer:
+        writer.write(b"a" * 6, "/in/a/1.jpg")
+        writer.write(b"b" * 6, "/in/b/2.jpg")
+
+    with zipfile.ZipFile(base + "-00001.zip") as archive:
+        assert archive.read("b/2.jpg") == b"b" * 6
+
+
+@pytest.mark.parametrize("archive_format", ["tar", "zip"])
+def test_shards_stay_within_size(tmpdir, archive_format):
+    base = str(tmpdir.join("crops"))
+    max_bytes = 30000
+    with ArchiveWriter(base, archive_format, max_bytes=max_bytes) as writer:
+        for i in range(20):
+            writer.write(b"x" * 3000, "/in/{}.jpg".format("a" * 120 + str(i)))
+
+    shards = [path for path in tmpdir.listdir() if path.ext != ".json"]
+    assert len(shards) > 2
+    assert all(path.size() <= max_bytes for path in shards)
+
+
+def test_crop_file_into_archive(tmpdir):
+    base = str(tmpdir.join("crops"))
+    with ArchiveWriter(base) as writer:
+        crop_file((0, 0, 0.5, 0.5), TEST_RES + "image.JPG",
+                  TEST_RES + "image.JPG_cropped.jpg", writer=writer)
+
+    assert sorted(tmpdir.listdir()) == [tmpdir.join("crops-00000.tar"),
+                                        tmpdir.join("crops.index.json")]
+    with tarfile.open(base + "-00000.tar") as archive:
+        with Image.open(archive.extractfile("image.JPG_cropped.jpg")) as image:
+            assert image.size == (130, 92)
+
+
+@pytest.mark.parametrize("mode", ["w", "w:gz", "zip"])
+def test_read_images_from_archive(tmpdir, mode):
+    path = str(tmpdir.join("shoot." + mode.replace(":", "")))
+    if mode == "zip":
+        with zipfile.ZipFile(path, "w") as archive:
+            archive.write(TEST_RES + "image.JPG", "day1/image.JPG")
+            archive.writestr("day1/notes.txt", "not an image")
+    else:
+        with tarfile.open(path, mode) as archive:
+            archive.add(TEST_RES + "image.JPG", "day1/image.JPG")
+
+    members = list_archive_members(path, ".jpg")
+    assert members == [path + "::day1/image.JPG"]
+    direct = read_archive_index(path)["day1/image.JPG"].offset is not None
+    assert direct == (mode == "w")
+
+    assert read_image_header(members[0]).size == (259, 183)
+    assert open_image(members[0], (0, 0, 0.5, 0.5)).size == (259, 183)
+
+    out_path = str(tmpdir.join("out.jpg"))
+    crop_file((0, 0, 0.5, 0.5), members[0], out_path)
+    with Image.open(out_path) as image:
+        assert image.size == (130, 92)
+
+
+def test_compressed_tar_read_in_one_pass(tmpdir, monkeypatch):
+    path = str(tmpdir.join("shoot.tar.gz"))
+    with tarfile.open(path, "w:gz") as archive:
+        for i in range(3):
+            archive.add(TEST_RES + "image.JPG", "{}.JPG".format(i))
+    opened = []
+    real_open = tarfile.open
+
+    def counting_open(*args, **kwargs):
+        opened.append(args[1])
+        return real_open(*args, **kwargs)
+
+    monkeypatch.setattr(tarfile, "open", counting_open)
+
+    for member in list_archive_members(path, ".jpg"):
+        assert read_image_header(member).size == (259, 183)
+        assert open_image(member).size == (259, 183)
+    assert opened == ["r:", "r:*"]
+
+
+def test_evicted_compressed_tars_are_closed(tmpdir):
+    archives = []
+    for i in range(OPEN_COMPRESSED_TARS + 1):
+        path = str(tmpdir.join("{}.tar.gz".format(i)))
+        with tarfile.open(path, "w:gz") as archive:
+            archive.add(TEST_RES + "image.JPG", "image.JPG")
+        archives.append(open_compressed_tar(path))
+        assert archives[-1].read("image.JPG")
+    assert archives[0]._archive is None  # pylint: disable=protected-access
+    assert archives[-1]._archive is not None  # pylint: disable=protected-access
+    # A closed archive is reopened if it is read again
+    assert archives[0].read("image.JPG")
@@ -0,0 +1,92 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=missing-docstring
+
+
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from batch_crop.backends import BACKENDS, DEFAULT_BACKEND, VipsBackend, \
+    choose_backend, orient_array, parse_backend_spec, render
+from batch_crop.batch_crop import ORIENTATION_TRANSPOSES
+
+
+TEST_RES = "tests/res/"
+
+
+@pytest.mark.parametrize("orientation", range(1, 9))
+def test_orient_array_matches_pillow(orientation):
+    pixels = np.arange(4 * 6 * 3, dtype=np.uint8).reshape((4, 6, 3))
+    expected = Image.fromarray(pixels)
+    if orientation in ORIENTATION_TRANSPOSES:
+        expected = expected.transpose(ORIENTATION_TRANSPOSES[orientation])
+    assert np.array_equal(orient_array(pixels, orientation),
+                          np.asarray(expected))
+
+
+@pytest.mark.parametrize("backend", [DEFAULT_BACKEND, "numpy"])
+def test_backends_agree_on_size(backend):
+    result = render((0, 0, 1, 0.5), TEST_RES + "image.JPG", "out.jpg",
+                    max_dimen=64, backend=backend)
+    assert result.backend == backend
+    [(path, data)] = result.outputs
+    assert path == "out.jpg"
+    with Image.open(io.BytesIO(data)) as image:
+        assert image.size == (64, 23)
+
+
+def test_numpy_shrink_averages_blocks():
+    backend = BACKENDS["numpy"]
+    frame = backend.decode(TEST_RES + "image.JPG", (0, 0, 1, 1), None)
+    shrunk = backend.shrink(backend.crop(frame, (0, 0, 1, 1)), 100)
+    assert shrunk.pixels.shape == (71, 100, 3)
+
+
+@pytest.mark.parametrize("transparency", [False, True])
+def test_numpy_decodes_palette_colors(tmpdir, transparency):
+    path = str(tmpdir.join("palette.png"))
+    image = Image.new("RGB", (8, 8), (200, 30, 40)).convert(
+        "P", palette=Image.ADAPTIVE)
+    if transparency:
+        image.info["transparency"] = 255
+    image.save(path)
+
+    frame = BACKENDS["numpy"].decode(path, (0, 0, 1, 1), None)
+    assert frame.pixels.shape == (8, 8, 4 if transparency else 3)
+    assert tuple(frame.pixels[0, 0, :3]) == (200, 30, 40)
+
+
+def test_choose_backend():
+    spec = ".arw=numpy,*=" + DEFAULT_BACKEND
+    assert choose_backend("a.ARW", spec).name == "numpy"
+    assert choose_backend("a.jpg", spec).name == DEFAULT_BACKEND
+    # libvips does not read RAW images, so they fall back to the default
+    assert choose_backend("a.arw", "auto").name == DEFAULT_BACKEND
+    with pytest.raises(ValueError):
+        parse_backend_spec("*=nonexistent")
+
+
+@pytest.mark.skipif(not VipsBackend.is_available(),
+                    reason="pyvips is not installed")
+def test_vips_backend():
+    result = render((0, 0, 0.5, 0.5), TEST_RES + "image.JPG", "out.jpg",
+                    backend="vips")
+    with Image.open(io.BytesIO(result.outputs[0][1])) as image:
+        assert image.size == (130, 92)
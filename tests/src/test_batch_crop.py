@@ -22,8 +22,14 @@ from math import isclose
 from hypothesis import given, assume
 import hypothesis.strategies as st
 
+import numpy as np
+from PIL import Image
+import pytest
+
 from batch_crop.batch_crop import coor_to_box, coors_to_ratios, \
-    ratios_to_coors, gen_ratios_config, get_ratios_from_config, open_image
+    ratios_to_coors, gen_ratios_config, get_ratios_from_config, open_image, \
+    crop_image, crop_file, orient_image, ORIENTATION_TAG, Rendition, \
+    crop_collecting_failures
 
 
 TEST_RES = "tests/res/"
@@ -133,3 +139,76 @@ def test_ratios_config_interconversion(x1: float, y1: float,
 
 def test_open_image():
     open_image(TEST_RES + "image.JPG")
+
+
+@pytest.mark.parametrize("orientation", range(1, 9))
+def test_crop_image_honors_orientation(orientation: int):
+    pixels = np.random.RandomState(orientation).randint(
+        0, 256, (32, 40, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels)
+    image.getexif()[ORIENTATION_TAG] = orientation
+    box_ratio = 0.75, 0.25, 0.25, 0.5
+
+    upright = orient_image(image, orientation)
+    box = coor_to_box(ratios_to_coors(upright.size, box_ratio))
+    expected = upright.crop(box)
+
+    cropped = crop_image(box_ratio, image)
+    assert np.array_equal(np.asarray(cropped), np.asarray(expected))
+
+
+def test_crop_file_resets_orientation(tmpdir):
+    image = Image.open(TEST_RES + "image.JPG")
+    exif = image.getexif()
+    exif[ORIENTATION_TAG] = 6
+    rotated = str(tmpdir.join("rotated.jpg"))
+    image.save(rotated, "jpeg", exif=exif.tobytes())
+
+    out_path = rotated + "_cropped.jpg"
+    crop_file((0, 0, 1, 0.5), rotated, out_path)
+
+    with Image.open(out_path) as cropped:
+        assert cropped.getexif()[ORIENTATION_TAG] == 1
+        assert cropped.size == (183, 130)
+
+
+def test_crop_file_renditions(tmpdir):
+    out_path = str(tmpdir.join("image.JPG_cropped.jpg"))
+    renditions = [Rendition("thumb", 20, "png"), Rendition("web", 100)]
+    crop_file((0, 0, 1, 1), TEST_RES + "image.JPG", out_path, renditions)
+
+    with Image.open(str(tmpdir.join("image.JPG_cropped_web.jpg"))) as web:
+        assert web.size == (100, 71)
+    with Image.open(str(tmpdir.join("image.JPG_cropped_thumb.png"))) as thumb:
+        assert thumb.format == "PNG"
+        assert thumb.size == (20, 14)
+
+
+def test_open_image_reduced_resolution(tmpdir):
+    path = str(tmpdir.join("large.jpg"))
+    Image.new("RGB", (800, 600), "blue").save(path)
+
+    assert open_image(path).size == (800, 600)
+    # Half of the width must still be at least 150 pixels, so 1/2 scale
+    assert open_image(path, (0, 0, 0.5, 0.5), 150).size == (400, 300)
+
+    out_path = path + "_cropped.jpg"
+    crop_file((0, 0, 0.5, 0.5), path, out_path, max_dimen=150)
+    with Image.open(out_path) as cropped:
+        assert cropped.size == (150, 112)
+
+
+def test_crop_collecting_failures(tmpdir):
+    good = str(tmpdir.join("good.jpg"))
+    Image.new("RGB", (40, 30), "blue").save(good)
+    bad = str(tmpdir.join("bad.jpg"))
+    tmpdir.join("bad.jpg").write("not an image")
+
+    failures = crop_collecting_failures(
+        (0.1, 0.1, 0.9, 0.9),
+        [(good, good + "_cropped.jpg"), (bad, bad + "_cropped.jpg")])
+
+    assert len(failures) == 1
+    assert failures[0].startswith(bad + ": ")
+    with Image.open(good + "_cropped.jpg") as cropped:
+        assert cropped.size == (32, 24)
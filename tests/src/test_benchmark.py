@@ -0,0 +1,56 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=missing-docstring
+
+
+from batch_crop.benchmark import benchmark_backends, format_results, \
+    load_results, save_results
+from batch_crop.quad import Quad
+
+
+TEST_RES = "tests/res/"
+
+
+def test_benchmark_backends(tmpdir):
+    results = benchmark_backends([TEST_RES + "image.JPG"], (0, 0, 0.5, 0.5),
+                                 ["numpy"], repeat=1)
+    [result] = results
+    assert (result.backend, result.format, result.files) == \
+        ("numpy", ".jpg", 1)
+    assert result.megapixels == 259 * 183 / 1e6
+    assert result.throughput > 0
+    assert "numpy" in format_results(results).splitlines()[1]
+
+    path = str(tmpdir.join("results.json"))
+    save_results(results, path)
+    assert load_results(path) == results
+
+
+def test_benchmark_skips_unreadable_files(tmpdir, capsys):
+    bad = tmpdir.join("bad.jpg")
+    bad.write("not an image")
+    results = benchmark_backends([str(bad), TEST_RES + "image.JPG"],
+                                 (0, 0, 0.5, 0.5), ["numpy"], repeat=1)
+    assert [result.files for result in results] == [1]
+    assert str(bad) in capsys.readouterr().err
+
+
+def test_benchmark_times_only_pillow_for_quads():
+    quad = Quad(((0.1, 0.2), (0.8, 0.1), (0.9, 0.7), (0.2, 0.8)))
+    results = benchmark_backends([TEST_RES + "image.JPG"], quad, ["numpy"],
+                                 repeat=1)
+    assert [result.backend for result in results] == ["pillow"]
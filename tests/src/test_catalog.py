@@ -0,0 +1,86 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=missing-docstring
+
+
+import os
+import shutil
+
+import batch_crop.catalog
+from batch_crop.catalog import Catalog
+
+
+TEST_RES = "tests/res/"
+
+
+def test_list_files_tracks_changes(tmpdir):
+    image = str(tmpdir.join("a.JPG"))
+    shutil.copy(TEST_RES + "image.JPG", image)
+    tmpdir.join("a.JPG_cropped.jpg").write("")
+    tmpdir.join("notes.txt").write("")
+
+    with Catalog(str(tmpdir.join("catalog.db"))) as catalog:
+        assert catalog.list_files(str(tmpdir), ".jpg") == [image]
+        assert catalog.lookup(image) is None
+        assert catalog.read_image_header(image).size == (259, 183)
+        assert catalog.lookup(image).size == (259, 183)
+
+        # A changed file's header is forgotten until read again
+        with open(image, "ab") as f:
+            f.write(b"\0")
+        catalog.refresh(str(tmpdir))
+        assert catalog.lookup(image) is None
+
+        os.remove(image)
+        assert catalog.list_files(str(tmpdir), ".jpg") == []
+
+
+def test_headers_persist_between_sessions(tmpdir, monkeypatch):
+    image = str(tmpdir.join("a.JPG"))
+    shutil.copy(TEST_RES + "image.JPG", image)
+    path = str(tmpdir.join("catalog.db"))
+    with Catalog(path) as catalog:
+        header = catalog.read_image_header(image)
+
+    reads = []
+
+    def read_image_header(path):
+        reads.append(path)
+
+    monkeypatch.setattr(batch_crop.catalog, "read_image_header",
+                        read_image_header)
+    with Catalog(path) as catalog:
+        assert catalog.read_image_header(image) == header
+        catalog.list_files(str(tmpdir), ".jpg")
+        assert catalog.read_image_header(image) == header
+    assert reads == []
+
+
+def test_headers_committed_in_batches(tmpdir, monkeypatch):
+    monkeypatch.setattr(batch_crop.catalog, "COMMIT_INTERVAL", 2)
+    images = [str(tmpdir.join("{}.JPG".format(i))) for i in range(3)]
+    for image in images:
+        shutil.copy(TEST_RES + "image.JPG", image)
+    path = str(tmpdir.join("catalog.db"))
+    with Catalog(path) as catalog:
+        catalog.refresh(str(tmpdir))
+        for image in images:
+            catalog.read_image_header(image)
+        # A second connection only sees committed headers
+        with Catalog(path) as other:
+            assert [other.lookup(image) is not None
+                    for image in images] == [True, True, False]
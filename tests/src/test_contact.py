@@ -0,0 +1,78 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=missing-docstring
+
+
+from PIL import Image, ImageDraw, ImageFont
+
+from batch_crop.contact import ContactSheet, fit_label, GAP
+
+
+TEST_RES = "tests/res/"
+
+
+def test_contact_sheet_pages(tmpdir):
+    with open(TEST_RES + "image.JPG", "rb") as f:
+        data = f.read()
+    base = str(tmpdir.join("sheet"))
+    sheet = ContactSheet(base, columns=2, rows=2, cell=50)
+    for index in range(5):
+        sheet.add(data, "image{}.JPG".format(index))
+    sheet.add_file(TEST_RES + "image.JPG")
+    sheet.add(b"not an image", "broken.JPG")
+    pages = sheet.close()
+
+    assert pages == [base + "-001.jpg", base + "-002.jpg"]
+    with Image.open(pages[0]) as first, Image.open(pages[1]) as second:
+        assert first.width == second.width
+        # The last page holds the 3 remaining cells in 2 rows
+        assert first.height == second.height
+
+
+def test_contact_sheet_survives_unexpected_errors(tmpdir, monkeypatch):
+    with open(TEST_RES + "image.JPG", "rb") as f:
+        data = f.read()
+    # Decoding the image now raises DecompressionBombError, not OSError
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 20000)
+    base = str(tmpdir.join("sheet"))
+    sheet = ContactSheet(base, columns=1, rows=1, cell=50, queue_size=1)
+    for index in range(3):
+        sheet.add(data, "image{}.JPG".format(index))
+    assert sheet.close() == [base + "-{:03d}.jpg".format(index)
+                             for index in range(1, 4)]
+
+
+def test_fit_label():
+    draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    font = ImageFont.load_default()
+    assert fit_label(draw, "a.JPG", font, 100) == "a.JPG"
+    label = fit_label(draw, "a_very_long_file_name_0001.JPG", font, 60)
+    assert label.startswith("...") and label.endswith(".JPG")
+    assert draw.textlength(label, font=font) <= 60
+
+
+def test_contact_sheet_leaves_room_for_labels(tmpdir):
+    with open(TEST_RES + "image.JPG", "rb") as f:
+        data = f.read()
+    base = str(tmpdir.join("sheet"))
+    sheet = ContactSheet(base, columns=1, rows=1, cell=50)
+    sheet.add(data, "a_very_long_file_name_0001.JPG")
+    [page] = sheet.close()
+
+    text_height = ImageFont.load_default().getbbox("Ag")[3]
+    with Image.open(page) as image:
+        assert image.size == (50 + 2 * GAP, 50 + text_height + 4 + 2 * GAP)
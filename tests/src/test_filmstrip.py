@@ -0,0 +1,78 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# pylint: disable=missing-docstring
+
+
+import time
+
+from batch_crop.filmstrip import make_thumbnail, ThumbnailLoader
+
+
+TEST_RES = "tests/res/"
+
+
+def poll_until(loader, path):
+    finished = []
+    deadline = time.monotonic() + 10
+    while path not in finished and time.monotonic() < deadline:
+        finished.extend(loader.poll())
+        time.sleep(0.01)
+    time.sleep(0.1)
+    return finished + loader.poll()
+
+
+def test_make_thumbnail():
+    thumbnail = make_thumbnail(TEST_RES + "image.JPG", 64)
+    assert max(thumbnail.size) == 64
+
+
+def test_loader_caches_and_reports_failures(tmpdir):
+    broken = str(tmpdir.join("broken.JPG"))
+    with open(broken, "wb") as f:
+        f.write(b"not an image")
+    loader = ThumbnailLoader(32, max_workers=1)
+    try:
+        loader.request([TEST_RES + "image.JPG", broken])
+        assert sorted(poll_until(loader, broken)) == sorted(
+            [TEST_RES + "image.JPG", broken])
+        assert max(loader.get(TEST_RES + "image.JPG").size) == 32
+        assert loader.get(broken) is None
+        assert loader.is_failed(broken)
+
+        # Already decoded, so nothing new is submitted
+        loader.request([TEST_RES + "image.JPG"])
+        time.sleep(0.1)
+        assert loader.poll() == []
+    finally:
+        loader.close()
+
+
+def test_loader_cancels_unwanted(tmpdir):
+    paths = [str(tmpdir.join("missing{}.JPG".format(index)))
+             for index in range(50)]
+    loader = ThumbnailLoader(32, max_workers=1)
+    try:
+        loader.request(paths)
+        loader.request(paths[-1:])
+        finished = poll_until(loader, paths[-1])
+        # Besides the one still wanted, only decodes that had already
+        # started finish
+        assert paths[-1] in finished
+        assert len(finished) < 10
+    finally:
+        loader.close()
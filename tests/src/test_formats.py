@@ -0,0 +1,118 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# pylint: disable=missing-docstring
+
+
+import io
+import shutil
+
+import pytest
+import rawpy
+from PIL import Image
+
+from batch_crop.batch_crop import open_image, open_source, read_image_header
+from batch_crop.formats import FORMAT_HANDLERS, FormatHandler, map_file, \
+    register_format, sniff_format, UnknownFormatError, PILLOW_DECODER, \
+    RAW_DECODER
+
+
+TEST_RES = "tests/res/"
+
+
+def test_mislabelled_image_decoded_by_contents(tmpdir):
+    path = str(tmpdir.join("actually_a_jpeg.ARW"))
+    shutil.copy(TEST_RES + "image.JPG", path)
+    assert read_image_header(path).format == "JPEG"
+    with Image.open(TEST_RES + "image.JPG") as original:
+        assert open_image(path).size == original.size
+
+
+def test_unknown_raw_fails_early(tmpdir):
+    path = str(tmpdir.join("garbage.ARW"))
+    with open(path, "wb") as f:
+        f.write(b"not an image at all")
+    empty = str(tmpdir.join("empty.JPG"))
+    open(empty, "wb").close()
+
+    with pytest.raises(UnknownFormatError):
+        read_image_header(path)
+    with pytest.raises(OSError):
+        open_image(empty)
+
+
+def test_mapped_file_reads_like_a_file(tmpdir):
+    path = str(tmpdir.join("data.bin"))
+    with open(path, "wb") as f:
+        f.write(b"0123456789")
+    with map_file(path) as mapped:
+        assert mapped.read(4) == b"0123"
+        assert mapped.seek(-2, io.SEEK_END) == 8
+        assert mapped.read() == b"89"
+        # Seeking past the end is allowed, as with a regular file
+        mapped.seek(100)
+        assert mapped.read(5) == b""
+
+
+def test_raw_files_opened_by_path(tmpdir, monkeypatch):
+    path = str(tmpdir.join("image.ARW"))
+    with open(path, "wb") as f:
+        f.write(b"II*\x00" + bytes(60))
+    opened = []
+
+    def imread(source):
+        opened.append(source)
+        raise OSError("not a real RAW file")
+
+    monkeypatch.setattr(rawpy, "imread", imread)
+    assert open_source(path) == (path, RAW_DECODER)
+    with pytest.raises(OSError):
+        read_image_header(path)
+    with pytest.raises(OSError):
+        open_image(path)
+    assert opened == [path, path]
+
+
+def test_register_format():
+    handler = FormatHandler("PPM", PILLOW_DECODER, (((0, b"P6"),),),
+                            (".ppm",))
+    source = io.BytesIO(b"P6\n1 1\n255\n\x00\x00\x00")
+    assert sniff_format(source) is None
+    register_format(handler)
+    try:
+        assert sniff_format(source, ".ppm") == handler
+        assert source.tell() == 0
+    finally:
+        FORMAT_HANDLERS.remove(handler)
+
+
+def test_register_format_with_opener(tmpdir):
+    def open_square(source):
+        side = source.read(4)[3]
+        return Image.new("L", (side, side))
+
+    handler = FormatHandler("Square", "square", (((0, b"SQR"),),),
+                            (".sqr",), open_square)
+    path = str(tmpdir.join("image.sqr"))
+    with open(path, "wb") as f:
+        f.write(b"SQR\x05")
+    register_format(handler)
+    try:
+        assert read_image_header(path).size == (5, 5)
+        assert open_image(path).size == (5, 5)
+    finally:
+        FORMAT_HANDLERS.remove(handler)
@@ -0,0 +1,110 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=missing-docstring
+
+
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from batch_crop.batch_crop import Rendition, render_crop
+from batch_crop import pipeline
+from batch_crop.pipeline import FrameRing, crop_files_pipelined, \
+    decode_frame, encode_frame
+
+
+TEST_RES = "tests/res/"
+
+
+def test_frame_round_trip_matches_render_crop():
+    box_ratio = (0.1, 0.2, 0.7, 0.9)
+    renditions = [Rendition("thumb", 32)]
+    with FrameRing(2, 1024 ** 2) as ring:
+        offset = ring.acquire()
+        frame = decode_frame(ring.name, offset, ring.slot_bytes, box_ratio,
+                             TEST_RES + "image.JPG")
+        assert frame.pixels is None
+        result = encode_frame(ring.name, offset, frame, "out.jpg",
+                              renditions, save=False)
+    assert result.outputs == render_crop(box_ratio, TEST_RES + "image.JPG",
+                                         "out.jpg", renditions)
+
+
+def test_oversized_frame_is_passed_directly():
+    with FrameRing(1, 16) as ring:
+        frame = decode_frame(ring.name, 0, ring.slot_bytes, (0, 0, 1, 1),
+                             TEST_RES + "image.JPG")
+        assert len(frame.pixels) == frame.nbytes == 259 * 183 * 3
+        assert encode_frame(ring.name, 0, frame, "out.jpg", save=False) \
+            .outputs[0][0] == "out.jpg"
+
+
+def test_crop_files_pipelined(tmpdir):
+    paths = []
+    for name in ("a.JPG", "b.JPG", "c.JPG"):
+        path = str(tmpdir.join(name))
+        shutil.copy(TEST_RES + "image.JPG", path)
+        paths.append((path, path + "_cropped.jpg"))
+    paths.append((str(tmpdir.join("missing.JPG")), "missing_cropped.jpg"))
+
+    with ThreadPoolExecutor(2) as decode, ThreadPoolExecutor(1) as encode:
+        results = list(crop_files_pipelined(
+            (0, 0, 0.5, 0.5), paths, 2, 1, slots=4,
+            executors=(decode, encode), budget=130 * 92 * 8))
+
+    assert len(results) == 4
+    for job, future in results:
+        if job.in_path.endswith("missing.JPG"):
+            assert isinstance(future.exception(), FileNotFoundError)
+            continue
+        with Image.open(job.out_path) as image:
+            assert image.size == (130, 92)
+
+
+def test_decodes_stay_within_budget(tmpdir, monkeypatch):
+    paths = []
+    for name in ("a.JPG", "b.JPG", "c.JPG"):
+        path = str(tmpdir.join(name))
+        shutil.copy(TEST_RES + "image.JPG", path)
+        paths.append((path, path + "_cropped.jpg"))
+    lock = threading.Lock()
+    state = {"active": 0, "peak": 0}
+
+    def counting_decode(*args):
+        with lock:
+            state["active"] += 1
+            state["peak"] = max(state["peak"], state["active"])
+        time.sleep(0.05)
+        try:
+            return decode_frame(*args)
+        finally:
+            with lock:
+                state["active"] -= 1
+
+    monkeypatch.setattr(pipeline, "decode_frame", counting_decode)
+    # Each decode is estimated at about 380 KB, and the ring takes about
+    # 190 KB, so the budget leaves room for only one decode at a time
+    with ThreadPoolExecutor(2) as decode, ThreadPoolExecutor(1) as encode:
+        results = list(crop_files_pipelined(
+            (0, 0, 0.5, 0.5), paths, 2, 1, slots=4,
+            executors=(decode, encode), budget=600000))
+
+    assert all(future.exception() is None for _, future in results)
+    assert state["peak"] == 1
@@ -0,0 +1,62 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=missing-docstring
+
+
+from batch_crop.plan import PlannedCrop, plan_crop, plan_crops, \
+    summarize_plan
+from batch_crop.schedule import PILLOW_BYTES_PER_PIXEL
+
+
+TEST_RES = "tests/res/"
+
+
+def test_plan_crop():
+    crop = plan_crop((0.1, 0.1, 0.9, 0.6), TEST_RES + "image.JPG", "out.jpg",
+                     max_dimen=50, throughputs={".jpg": 1.0})
+    assert crop.size == (259, 183)
+    assert crop.box == (26, 18, 233, 110)
+    assert crop.output_size == (50, 22)
+    # Decoded at a quarter of the size in each dimension
+    assert crop.decode_megapixels == 65 * 46 / 1e6
+    assert crop.seconds == crop.decode_megapixels
+    assert crop.cost == 259 * 183 * PILLOW_BYTES_PER_PIXEL
+    assert crop.problem is None
+
+
+def test_plan_flags_problems(tmpdir):
+    bad = str(tmpdir.join("bad.jpg"))
+    with open(bad, "wb") as f:
+        f.write(b"not an image")
+    image = TEST_RES + "image.JPG"
+    outside, unreadable = plan_crops((0.5, 0.5, 1.2, 1),
+                                     [(image, "a"), (bad, "b")])
+    assert outside.problem == "crop extends past the image"
+    assert plan_crop((0.5, 0.5, 0.5, 0.9), image, "b").problem == "empty crop"
+    assert unreadable.problem.startswith("unreadable")
+
+
+def test_summarize_plan():
+    crops = [PlannedCrop("", "", (0, 0), (0, 0, 0, 0), (0, 0), 1.0, cost,
+                         seconds, None)
+             for cost, seconds in ((100, 4.0), (50, 1.0), (10, 1.0))]
+    summary = summarize_plan(crops, max_workers=2, budget=120)
+    assert summary.files == 3 and summary.problems == 0
+    assert summary.decode_megapixels == 3.0
+    assert summary.peak_memory == 120
+    # The longest crop outlasts the rest of the batch split between workers
+    assert summary.seconds == 4.0
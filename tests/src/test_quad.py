@@ -0,0 +1,74 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# pylint: disable=missing-docstring
+
+
+from PIL import Image, ImageDraw, ImageStat
+
+from batch_crop.backends import render
+from batch_crop.batch_crop import crop_image, get_ratios_from_file, \
+    save_ratios_to_file
+from batch_crop.quad import get_perspective_data, quad_from_coors, \
+    rotate_box, Quad
+
+
+def test_rotated_rectangle_rectified():
+    image = Image.new("L", (400, 300), color=255)
+    corners = rotate_box((100, 100, 300, 180), 12)
+    ImageDraw.Draw(image).polygon(corners, fill=0)
+
+    cropped = crop_image(quad_from_coors(image.size, corners), image)
+    assert cropped.size == (200, 80)
+    # Only the edges pick up any of the white background
+    assert ImageStat.Stat(cropped.crop((2, 2, 198, 78))).extrema == [(0, 0)]
+
+
+def test_perspective_quad_matches_corners():
+    corners = [(10, 5), (90, 15), (80, 70), (20, 60)]
+    a, b, c, d, e, f, g, h = get_perspective_data(corners, (60, 50))
+    for (x, y), (u, v) in zip([(0, 0), (60, 0), (60, 50), (0, 50)], corners):
+        scale = g * x + h * y + 1
+        assert abs((a * x + b * y + c) / scale - u) < 1e-6
+        assert abs((d * x + e * y + f) / scale - v) < 1e-6
+
+
+def test_quad_orientation(tmpdir):
+    path = str(tmpdir.join("rotated.jpg"))
+    # Stored sideways with orientation 6, so upright it is 100 x 200
+    image = Image.new("RGB", (200, 100), color="white")
+    ImageDraw.Draw(image).rectangle((0, 0, 99, 49), fill="black")
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    image.save(path, exif=exif)
+
+    quad = Quad(((0.5, 0.0), (1.0, 0.0), (1.0, 0.5), (0.5, 0.5)))
+    outputs = render(quad, path, path + "_cropped.jpg", backend="numpy")
+    with Image.open(path) as original:
+        cropped = crop_image(quad, original)
+    assert outputs.backend == "pillow"
+    assert cropped.size == (50, 100)
+    assert ImageStat.Stat(cropped.convert("L")).mean[0] < 10
+
+
+def test_quad_config_round_trip(tmpdir):
+    path = str(tmpdir.join("quad.ini"))
+    quad = Quad(((0.1, 0.2), (0.8, 0.1), (0.9, 0.7), (0.2, 0.8)))
+    save_ratios_to_file(quad, path)
+    assert get_ratios_from_file(path) == quad
+    save_ratios_to_file((0.1, 0.2, 0.3, 0.4), path)
+    assert get_ratios_from_file(path) == (0.1, 0.2, 0.3, 0.4)
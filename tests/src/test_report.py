@@ -0,0 +1,34 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=missing-docstring
+
+
+from batch_crop.report import Failure, get_failed_paths, load_report, \
+    save_report
+
+
+def test_report_round_trip(tmpdir):
+    path = str(tmpdir.join("errors.json"))
+    failures = [Failure.from_error("a.ARW", "a.ARW_cropped.jpg",
+                                   ValueError("corrupt")),
+                Failure("b.ARW", "b.ARW_cropped.jpg", "TimeoutError", "")]
+    save_report(failures, path)
+
+    assert load_report(path) == failures
+    assert failures[0].error == "ValueError"
+    assert get_failed_paths(path) == [("a.ARW", "a.ARW_cropped.jpg"),
+                                      ("b.ARW", "b.ARW_cropped.jpg")]
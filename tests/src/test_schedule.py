@@ -0,0 +1,230 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=missing-docstring
+
+
+import errno
+import os
+import shutil
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+import pytest
+
+from batch_crop.schedule import Job, MemoryBudgetScheduler, WorkerPool, \
+    WorkerStoppedError, crop_files, call_with_retries, estimate_footprint, \
+    make_jobs, PILLOW_BYTES_PER_PIXEL
+
+
+TEST_RES = "tests/res/"
+
+
+def test_estimate_footprint():
+    assert estimate_footprint(TEST_RES + "image.JPG") == \
+        259 * 183 * PILLOW_BYTES_PER_PIXEL
+
+
+def test_compressed_tar_members_keep_archive_order(tmpdir):
+    path = str(tmpdir.join("shoot.tar.gz"))
+    with tarfile.open(path, "w:gz") as archive:
+        for name, size in (("small.jpg", (10, 10)), ("large.jpg", (40, 40))):
+            image_path = str(tmpdir.join(name))
+            Image.new("RGB", size).save(image_path)
+            archive.add(image_path, name)
+    plain = str(tmpdir.join("medium.jpg"))
+    Image.new("RGB", (20, 20)).save(plain)
+
+    jobs = make_jobs([(path + "::small.jpg", ""), (plain, ""),
+                      (path + "::large.jpg", "")])
+
+    # The plain file keeps its largest-first place, but the archive's members
+    # fill theirs in archive order
+    assert [job.in_path for job in jobs] == \
+        [path + "::small.jpg", plain, path + "::large.jpg"]
+
+
+def test_scheduler_respects_budget():
+    jobs = [Job(str(cost), "", cost) for cost in (60, 50, 40, 30, 120)]
+    lock = threading.Lock()
+    state = {"used": 0, "peak": 0}
+    started = []
+
+    def work(job: Job) -> None:
+        with lock:
+            started.append(job.cost)
+            state["used"] += job.cost
+            state["peak"] = max(state["peak"], state["used"])
+        time.sleep(0.01)
+        with lock:
+            state["used"] -= job.cost
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        scheduler = MemoryBudgetScheduler(100, 4, executor)
+        finished = [job.cost for job, _ in
+                    scheduler.run(jobs, lambda job: executor.submit(work, job))]
+
+    assert sorted(finished) == [30, 40, 50, 60, 120]
+    # Only the job larger than the whole budget may exceed it, and only alone
+    assert state["peak"] <= 120
+    assert sorted(started[:2]) == [40, 60]
+
+
+def test_crop_files(tmpdir):
+    paths = []
+    for name in ("a.JPG", "b.JPG"):
+        path = str(tmpdir.join(name))
+        shutil.copy(TEST_RES + "image.JPG", path)
+        paths.append((path, path + "_cropped.jpg"))
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(crop_files((0.1, 0.1, 0.9, 0.9), paths,
+                                  budget=10 ** 9, max_workers=2,
+                                  executor=executor))
+
+    assert len(results) == 2
+    for job, future in results:
+        assert future.exception() is None
+        assert os.path.exists(job.out_path)
+
+
+def test_call_with_retries():
+    calls = []
+
+    def flaky(fail_times: int, error: OSError) -> str:
+        calls.append(fail_times)
+        if len(calls) <= fail_times:
+            raise error
+        return "done"
+
+    transient = OSError(errno.EIO, "Input/output error")
+    assert call_with_retries(flaky, 2, 0, 2, transient) == "done"
+    assert len(calls) == 3
+
+    calls.clear()
+    with pytest.raises(OSError):
+        call_with_retries(flaky, 2, 0, 1, OSError("image file is truncated"))
+    assert len(calls) == 1
+
+
+def test_scheduler_times_out_hung_jobs():
+    release = threading.Event()
+    jobs = [Job("hung", "", 2), Job("quick", "", 1)]
+
+    def work(job: Job) -> str:
+        if job.in_path == "hung":
+            release.wait(5)
+        return job.in_path
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        scheduler = MemoryBudgetScheduler(100, 2, executor)
+        results = {job.in_path: future for job, future in scheduler.run(
+            jobs, lambda job: executor.submit(work, job), timeout=0.2)}
+        release.set()
+
+    assert results["quick"].result() == "quick"
+    assert isinstance(results["hung"].exception(), TimeoutError)
+
+
+def test_scheduler_times_jobs_from_their_start():
+    jobs = [Job(str(i), "", 1) for i in range(2)]
+
+    def work(job: Job) -> str:
+        time.sleep(0.3)
+        return job.in_path
+
+    # The executor runs one job at a time, so the second job waits to start
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        scheduler = MemoryBudgetScheduler(100, 2, executor)
+        results = [future for _, future in scheduler.run(
+            jobs, lambda job: executor.submit(work, job), timeout=0.5)]
+
+    assert sorted(future.result() for future in results) == ["0", "1"]
+
+
+def test_scheduler_counts_hung_jobs_as_workers():
+    lock = threading.Lock()
+    state = {"active": 0, "peak": 0}
+    jobs = [Job("hung", "", 2), Job("quick", "", 1)]
+
+    def work(job: Job) -> str:
+        with lock:
+            state["active"] += 1
+            state["peak"] = max(state["peak"], state["active"])
+        time.sleep(0.5 if job.in_path == "hung" else 0)
+        with lock:
+            state["active"] -= 1
+        return job.in_path
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        scheduler = MemoryBudgetScheduler(100, 1, executor)
+        results = {job.in_path: future for job, future in scheduler.run(
+            jobs, lambda job: executor.submit(work, job), timeout=0.1)}
+
+    assert results["quick"].result() == "quick"
+    assert isinstance(results["hung"].exception(), TimeoutError)
+    assert state["peak"] == 1
+
+
+def test_worker_pool_terminates_running_tasks():
+    pool = WorkerPool(1)
+    try:
+        hung = pool.submit(time.sleep, 30)
+        while not hung.running():
+            time.sleep(0.01)
+        assert pool.terminate(hung)
+        assert isinstance(hung.exception(timeout=5), WorkerStoppedError)
+        # A fresh worker takes over
+        assert pool.submit(abs, -1).result(timeout=5) == 1
+        assert not pool.terminate(hung)
+    finally:
+        pool.shutdown()
+
+
+def test_scheduler_terminates_hung_workers():
+    jobs = [Job("hung", "", 2), Job("quick", "", 1)]
+    scheduler = MemoryBudgetScheduler(100, 1)
+    start = time.monotonic()
+    results = {job.in_path: future for job, future in scheduler.run(
+        jobs, lambda job: scheduler.executor.submit(
+            time.sleep, 30 if job.in_path == "hung" else 0), timeout=0.2)}
+
+    assert time.monotonic() - start < 10
+    assert isinstance(results["hung"].exception(), TimeoutError)
+    assert results["quick"].exception() is None
+
+
+def test_crop_files_isolates_failures(tmpdir):
+    good = str(tmpdir.join("good.JPG"))
+    shutil.copy(TEST_RES + "image.JPG", good)
+    bad = str(tmpdir.join("bad.JPG"))
+    # A valid header followed by truncated image data
+    with open(TEST_RES + "image.JPG", "rb") as f:
+        tmpdir.join("bad.JPG").write_binary(f.read(2000))
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = {job.in_path: future for job, future in crop_files(
+            (0, 0, 1, 1), [(bad, bad + "_cropped.jpg"),
+                           (good, good + "_cropped.jpg")],
+            budget=10 ** 9, max_workers=2, executor=executor)}
+
+    assert results[bad].exception() is not None
+    assert results[good].exception() is None
+    assert os.path.exists(good + "_cropped.jpg")
+    assert not os.path.exists(bad + "_cropped.jpg")
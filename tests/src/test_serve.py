@@ -0,0 +1,110 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=missing-docstring,redefined-outer-name
+
+
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+import pytest
+from PIL import Image
+
+from batch_crop.serve import CropCache, CropRequestError, CropServer, \
+    MAX_UPLOAD_BYTES
+
+
+TEST_RES = "tests/res/"
+
+
+@pytest.fixture
+def server():
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        crop_server = CropServer(("127.0.0.1", 0), pool, cache_size=4,
+                                 root=TEST_RES)
+        thread = threading.Thread(target=crop_server.serve_forever)
+        thread.start()
+        yield "http://127.0.0.1:{}/crop?".format(crop_server.server_port)
+        crop_server.shutdown()
+        crop_server.server_close()
+        thread.join()
+
+
+def test_cache_evicts_least_recently_used():
+    cache = CropCache(2)
+    cache.put("a", b"1")
+    cache.put("b", b"2")
+    assert cache.get("a") == b"1"
+    cache.put("c", b"3")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1"
+
+
+def test_crop_path_is_cached(server):
+    query = urlencode({"path": "image.JPG", "box": "0,0,0.5,0.5"})
+    with urlopen(server + query) as response:
+        assert response.headers["X-Cache"] == "miss"
+        with Image.open(io.BytesIO(response.read())) as image:
+            assert image.size == (130, 92)
+    with urlopen(server + query) as response:
+        assert response.headers["X-Cache"] == "hit"
+
+
+def test_crop_upload(server):
+    with open(TEST_RES + "image.JPG", "rb") as f:
+        data = f.read()
+    request = Request(server + urlencode({"box": "0,0,1,1", "format": "png"}),
+                      data=data)
+    with urlopen(request) as response:
+        assert response.headers["Content-Type"] == "image/png"
+
+
+def test_rejects_paths_outside_root(server):
+    query = urlencode({"path": "../../setup.py", "box": "0,0,1,1"})
+    with pytest.raises(HTTPError) as error:
+        urlopen(server + query)
+    assert error.value.code == 403
+
+
+def test_absolute_paths_inside_root(server):
+    query = urlencode({"path": os.path.abspath(TEST_RES + "image.JPG"),
+                       "box": "0,0,1,1"})
+    with urlopen(server + query) as response:
+        assert response.status == 200
+
+
+def test_rejects_oversized_uploads(server):
+    request = Request(server + urlencode({"box": "0,0,1,1"}), data=b"",
+                      headers={"Content-Length": str(MAX_UPLOAD_BYTES + 1)})
+    with pytest.raises(HTTPError) as error:
+        urlopen(request)
+    assert error.value.code == 413
+
+
+def test_rejects_paths_without_root():
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        crop_server = CropServer(("127.0.0.1", 0), pool)
+        try:
+            with pytest.raises(CropRequestError) as error:
+                crop_server.check_path(TEST_RES + "image.JPG")
+            assert error.value.status == 403
+        finally:
+            crop_server.server_close()
@@ -0,0 +1,83 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# pylint: disable=missing-docstring
+
+
+import os
+import shutil
+
+import pytest
+
+from batch_crop.speculate import get_staged_path, SpeculativeCropper, \
+    KEPT_REGIONS
+
+
+TEST_RES = "tests/res/"
+
+
+@pytest.fixture(name="jobs")
+def fixture_jobs(tmpdir):
+    jobs = []
+    for index in range(3):
+        path = str(tmpdir.join("image{}.JPG".format(index)))
+        shutil.copy(TEST_RES + "image.JPG", path)
+        jobs.append((path, path + "_cropped.jpg"))
+    return jobs
+
+
+def test_commit_staged_crops(jobs):
+    cropper = SpeculativeCropper(max_workers=2)
+    try:
+        cropper.stage((0.1, 0.1, 0.5, 0.5), jobs)
+        cropper.wait()
+        assert all(os.path.exists(get_staged_path(out)) for _, out in jobs)
+        assert not any(os.path.exists(out) for _, out in jobs)
+
+        # The last image changed after it was staged
+        os.utime(jobs[2][0], ns=(0, 0))
+        remaining = cropper.commit((0.1, 0.1, 0.5, 0.5), jobs)
+        assert remaining == jobs[2:]
+        assert all(os.path.exists(out) for _, out in jobs[:2])
+    finally:
+        cropper.close()
+    assert not os.path.exists(os.path.dirname(get_staged_path(jobs[0][1])))
+
+
+def test_recent_regions_are_kept(jobs):
+    first, second = (0.1, 0.1, 0.5, 0.5), (0.2, 0.2, 0.6, 0.6)
+    cropper = SpeculativeCropper(max_workers=2)
+    try:
+        cropper.stage(first, jobs)
+        cropper.wait()
+        cropper.stage(second, jobs[:1])
+        cropper.wait()
+        assert all(os.path.exists(get_staged_path(out, 0)) for _, out in jobs)
+        assert os.path.exists(get_staged_path(jobs[0][1], 1))
+
+        # Going back to the first region reuses its crops
+        cropper.stage(first, jobs)
+        assert cropper.commit((0, 0, 1, 1), jobs) == jobs
+        assert cropper.commit(first, jobs) == []
+        assert all(os.path.exists(out) for _, out in jobs)
+
+        # Crops of regions older than KEPT_REGIONS are deleted
+        for index in range(KEPT_REGIONS):
+            cropper.stage((0, 0, 0.5, 0.1 * (index + 1)), [])
+        assert not os.path.exists(get_staged_path(jobs[0][1], 1))
+    finally:
+        cropper.close()
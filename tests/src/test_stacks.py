@@ -0,0 +1,76 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# pylint: disable=missing-docstring
+
+
+from PIL import Image, ImageSequence
+
+from batch_crop.stacks import crop_stack, list_stacks
+
+
+def make_frames(count):
+    return [Image.new("L", (40, 20), color=index * 10)
+            for index in range(count)]
+
+
+def test_crop_multi_frame_tiff(tmpdir):
+    in_path = str(tmpdir.join("stack.tif"))
+    frames = make_frames(3)
+    frames[0].save(in_path, save_all=True, append_images=frames[1:])
+    out_path = str(tmpdir.join("out.tif"))
+
+    assert crop_stack((0, 0, 0.5, 1), [in_path], out_path) == 3
+    with Image.open(out_path) as image:
+        assert image.n_frames == 3
+        for index, frame in enumerate(ImageSequence.Iterator(image)):
+            assert frame.size == (20, 20)
+            assert frame.getpixel((0, 0)) == index * 10
+    assert sorted(tmpdir.listdir()) == [tmpdir.join("out.tif"),
+                                        tmpdir.join("stack.tif")]
+
+
+def test_crop_gif_keeps_format(tmpdir):
+    in_path = str(tmpdir.join("anim.gif"))
+    frames = make_frames(2)
+    frames[0].save(in_path, save_all=True, append_images=frames[1:])
+    [(in_paths, out_path)] = list_stacks(str(tmpdir), ".gif")
+
+    assert crop_stack((0, 0, 1, 0.5), in_paths, out_path,
+                      max_dimen=20) == 2
+    with Image.open(out_path) as image:
+        assert image.format == "GIF"
+        assert image.n_frames == 2
+        assert image.size == (20, 5)
+
+
+def test_list_stacks_sequences(tmpdir):
+    for index, frame in enumerate(make_frames(3), start=8):
+        frame.save(str(tmpdir.join("z{:02d}.tif".format(index))))
+    make_frames(1)[0].save(str(tmpdir.join("single.tif")))
+    # Neither a gap in the numbering nor a different size joins a sequence
+    make_frames(1)[0].save(str(tmpdir.join("z12.tif")))
+    Image.new("L", (10, 10)).save(str(tmpdir.join("z13.tif")))
+
+    assert list_stacks(str(tmpdir), ".tif") == []
+    [(in_paths, out_path)] = list_stacks(str(tmpdir), ".tif", sequences=True)
+    assert in_paths == [str(tmpdir.join(name))
+                        for name in ("z08.tif", "z09.tif", "z10.tif")]
+    assert out_path == str(tmpdir.join("z08-10.tif_cropped.tif"))
+    assert crop_stack((0, 0, 1, 1), in_paths, out_path) == 3
+    with Image.open(out_path) as image:
+        assert image.n_frames == 3
@@ -0,0 +1,60 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=missing-docstring
+
+
+import os
+import shutil
+
+from batch_crop.watch import CropWatcher, Debouncer
+
+
+TEST_RES = "tests/res/"
+
+
+def test_debouncer_waits_for_settle(tmpdir):
+    path = str(tmpdir.join("img.jpg"))
+    with open(path, "wb") as f:
+        f.write(b"partial")
+
+    debouncer = Debouncer(settle_time=1.0)
+    debouncer.update(path, os.stat(path), now=0.0)
+    assert debouncer.ready(now=0.5) == []
+
+    with open(path, "ab") as f:
+        f.write(b" and more")
+    debouncer.update(path, os.stat(path), now=0.9)
+    assert debouncer.ready(now=1.5) == []
+    assert debouncer.ready(now=2.0) == [path]
+    assert debouncer.pending == {}
+
+
+def test_watcher_crops_new_files_only(tmpdir):
+    old = str(tmpdir.join("old.JPG"))
+    shutil.copy(TEST_RES + "image.JPG", old)
+
+    watcher = CropWatcher([str(tmpdir)], (0.1, 0.1, 0.6, 0.6), ".jpg",
+                          settle_time=0.0, max_workers=2, use_inotify=False)
+    new = str(tmpdir.join("new.JPG"))
+    shutil.copy(TEST_RES + "image.JPG", new)
+
+    assert watcher.step(timeout=0) == [new]
+    assert watcher.step(timeout=0) == []
+    watcher.close()
+
+    assert os.path.exists(new + "_cropped.jpg")
+    assert not os.path.exists(old + "_cropped.jpg")
@@ -0,0 +1,72 @@
+# This file is part of batch_crop: A Python utility for batch cropping images
+# Copyright (C) 2018  U8N WXD <cs.temporary@icloud.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# pylint: disable=missing-docstring
+
+
+import os
+
+import pytest
+
+from batch_crop.writer import OutputWriter, write_atomic
+
+
+def test_write_atomic_replaces_file(tmpdir):
+    path = str(tmpdir.join("out.jpg"))
+    write_atomic(b"old", path)
+    write_atomic(b"new", path, fsync=True)
+
+    with open(path, "rb") as f:
+        assert f.read() == b"new"
+    assert os.listdir(str(tmpdir)) == ["out.jpg"]
+
+
+@pytest.mark.parametrize("policy", ["file", "batch", "never"])
+def test_output_writer(tmpdir, policy):
+    paths = [str(tmpdir.join("{}.jpg".format(i))) for i in range(5)]
+    with OutputWriter(policy, batch_size=2, queue_size=1) as writer:
+        for i, path in enumerate(paths):
+            writer.write(bytes([i]) * 10, path)
+    stats = writer.stats()
+
+    assert stats.files == 5
+    assert stats.bytes == 50
+    assert sorted(os.listdir(str(tmpdir))) == sorted(map(os.path.basename,
+                                                         paths))
+    with open(paths[3], "rb") as f:
+        assert f.read() == bytes([3]) * 10
+
+
+def test_output_writer_reports_errors(tmpdir):
+    writer = OutputWriter("never")
+    writer.write(b"data", str(tmpdir.join("missing", "out.jpg")), "in.jpg")
+    with pytest.raises(OSError) as error:
+        writer.close()
+    assert "in.jpg" in str(error.value)
+
+
+def test_output_writer_survives_unexpected_errors(tmpdir):
+    writer = OutputWriter("never", queue_size=1)
+    writer.write("not bytes", str(tmpdir.join("bad.jpg")))
+    with pytest.raises(TypeError):
+        for i in range(5):
+            writer.write(b"data", str(tmpdir.join("{}.jpg".format(i))))
+        writer.close()
+
+
+def test_rejects_unknown_policy():
+    with pytest.raises(ValueError):
+        OutputWriter("sometimes")